@@ -0,0 +1,842 @@
+"""
+PQBACKUP container format shared by backup_tool.py and decrypt_backup.py
+
+Version 2 of the format encrypts the archive in fixed-size segments so neither
+side ever holds more than one segment in memory, whatever the archive size.
+Each segment is sealed with an AEAD cipher under its own nonce (STREAM
+construction): the nonce carries a segment counter and a "last segment" flag,
+and the complete header is bound as associated data, so reordering, dropping,
+truncating or tampering with segments or header fields is detected.
+
+Layout:
+
+    [ PQBACKUP ][ 0x00 ][ VERSION ][ FIELDS_LEN ][ FIELDS ][ SEGMENT ]...[ FINAL SEGMENT ]
+       8 bytes   1 byte   1 byte     2 bytes      variable
+
+FIELDS is a sequence of (tag: 1 byte, length: 2 bytes, value) records. Every
+segment but the last holds exactly segment_size bytes of plaintext followed by
+a 16 byte tag; the final segment is always shorter (possibly empty).
+
+An optional codec field (zstd or lz4) means the plaintext is one compressed
+stream of the archive, compressed before and decompressed after encryption.
+
+With a subkey salt field the KDF salt is a long-lived master salt shared by
+many archives: the password-derived master key is expanded with HKDF and the
+per-archive subkey salt into that archive's key. Decrypting a batch of such
+archives then costs one memory-hard KDF run instead of one per archive.
+
+A cipher field names the AEAD the segments are sealed with. AES-256-GCM is
+the default and the field is left out for it; ChaCha20-Poly1305 is several
+times faster on hosts without AES instructions. Both take 12 byte nonces and
+add 16 byte tags, so the layout is the same either way.
+
+A KDF parameters field holds the Argon2id time cost, memory cost and lanes
+the archive was keyed with (as calibrated for the encrypting host); without
+it the fixed defaults below apply.
+
+Because every segment but the last has the same sealed size, plaintext offset
+n lives in segment n // segment_size at a computable file offset. Archives
+without a codec are zips whose central directory sits, encrypted, in the last
+segments: it is the member index, mapping each path to the plaintext range
+of its data. SegmentReader uses it to restore single files by decrypting only
+the final segment, the directory and the segments the file occupies.
+
+With a hash tree field, the final segment is followed by a trailer of
+SHA-256 leaf hashes, one for the header and one per sealed segment, plus the
+Merkle root over them:
+
+    ...[ FINAL SEGMENT ][ LEAF HASH ]...[ ROOT ][ LEAF COUNT: 8 bytes ][ PQTREE01 ]
+
+It covers ciphertext only, so corruption can be located (and audited by
+sampling) without the password and in parallel; the AEAD tags still provide
+the authenticity guarantee once the archive is decrypted.
+
+Version 1 files (one GCM pass over the whole archive) store the KDF type length
+right after the magic bytes. That length is never zero, which is what the 0x00
+marker relies on to tell the two layouts apart.
+"""
+
+import hashlib
+import io
+import os
+import struct
+import time
+from collections import OrderedDict
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+MAGIC = b'PQBACKUP'
+VERSIONED_MARKER = 0
+FORMAT_VERSION = 2
+
+DEFAULT_SEGMENT_SIZE = 1024 * 1024  # 1 MiB of plaintext per segment
+MAX_SEGMENT_SIZE = 64 * 1024 * 1024
+TAG_SIZE = 16
+SALT_SIZE = 32
+NONCE_PREFIX_SIZE = 7  # + 4 byte counter + 1 byte last flag = 12 byte AEAD nonce
+
+# Header field tags
+FIELD_KDF = 0x01
+FIELD_SALT = 0x02
+FIELD_NONCE_PREFIX = 0x03
+FIELD_SEGMENT_SIZE = 0x04
+FIELD_CODEC = 0x05
+FIELD_SUBKEY_SALT = 0x06
+FIELD_HASH_TREE = 0x07
+FIELD_KDF_PARAMS = 0x08
+FIELD_CIPHER = 0x09
+
+HASH_TREE_ALGORITHM = b'sha256'
+HASH_SIZE = 32
+TRAILER_MAGIC = b'PQTREE01'
+TRAILER_FOOTER_SIZE = HASH_SIZE + 8 + len(TRAILER_MAGIC)
+
+# AEAD cipher suites for segments; an archive without a cipher field uses AES-256-GCM
+CIPHER_AES_GCM = 'aes-256-gcm'
+CIPHER_CHACHA20 = 'chacha20-poly1305'
+CIPHERS = (CIPHER_AES_GCM, CIPHER_CHACHA20)
+CIPHER_NAMES = {CIPHER_AES_GCM: 'AES-256-GCM', CIPHER_CHACHA20: 'ChaCha20-Poly1305'}
+CIPHER_BENCHMARK_SIZE = 4 * 1024 * 1024
+
+# Stream codecs applied to the whole archive; deflate happens per zip member instead
+CODECS = ('deflate', 'zstd', 'lz4')
+DEFAULT_CODEC_LEVELS = {'zstd': 9, 'lz4': 0}
+ZSTD_WINDOW_LOG = 27  # 128 MiB window for long-distance matching
+
+# Key derivation parameters of version 1 files, and of version 2 files
+# without a KDF parameters field
+ARGON2_TIME_COST = 3
+ARGON2_MEMORY_COST = 65536  # 64 MB
+ARGON2_PARALLELISM = 4
+PBKDF2_ITERATIONS = 500000
+
+# Argon2id (time cost, memory cost in KiB, lanes); the field stores them as three 32-bit integers
+ARGON2_DEFAULT_PARAMS = (ARGON2_TIME_COST, ARGON2_MEMORY_COST, ARGON2_PARALLELISM)
+KDF_PARAMS_FORMAT = '>III'
+# Accepted range for parameters read from a header, so a crafted file
+# cannot make the KDF allocate or spin without bound
+ARGON2_MAX_TIME_COST = 64
+ARGON2_MAX_MEMORY_COST = 4 * 1024 * 1024  # 4 GiB
+ARGON2_MAX_PARALLELISM = 255
+
+
+def check_kdf_params(params: Tuple[int, int, int]):
+    time_cost, memory_cost, parallelism = params
+    if not (1 <= time_cost <= ARGON2_MAX_TIME_COST and 1 <= parallelism <= ARGON2_MAX_PARALLELISM
+            and 8 * parallelism <= memory_cost <= ARGON2_MAX_MEMORY_COST):
+        raise ValueError(f"Argon2id parameters out of range: time_cost={time_cost}, "
+                         f"memory_cost={memory_cost} KiB, parallelism={parallelism}")
+
+
+def derive_key(password: str, kdf_type: bytes, salt: bytes,
+               params: Optional[Tuple[int, int, int]] = None) -> bytes:
+    """Derive the 256-bit archive key from a password; params override the Argon2id defaults"""
+    if kdf_type == b'ARGON2ID':
+        try:
+            from argon2.low_level import hash_secret_raw, Type
+        except ImportError:
+            raise ImportError("argon2-cffi required to decrypt this file. Install: pip install argon2-cffi")
+
+        time_cost, memory_cost, parallelism = params or ARGON2_DEFAULT_PARAMS
+        return hash_secret_raw(
+            secret=password.encode(),
+            salt=salt,
+            time_cost=time_cost,
+            memory_cost=memory_cost,
+            parallelism=parallelism,
+            hash_len=32,
+            type=Type.ID
+        )
+    elif kdf_type == b'PBKDF2SHA512':
+        from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.backends import default_backend
+
+        kdf = PBKDF2HMAC(
+            algorithm=hashes.SHA512(),
+            length=32,
+            salt=salt,
+            iterations=PBKDF2_ITERATIONS,
+            backend=default_backend()
+        )
+        return kdf.derive(password.encode())
+    else:
+        raise ValueError(f"Unknown KDF type: {kdf_type}")
+
+
+def hkdf(key: bytes, info: bytes, length: int = 32, salt: Optional[bytes] = None) -> bytes:
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+    return HKDF(algorithm=hashes.SHA256(), length=length, salt=salt, info=info).derive(key)
+
+
+def aead(cipher: str, key: bytes):
+    """AEAD object for a cipher suite (encrypt/decrypt(nonce, data, associated data))"""
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+
+    if cipher == CIPHER_AES_GCM:
+        return AESGCM(key)
+    if cipher == CIPHER_CHACHA20:
+        return ChaCha20Poly1305(key)
+    raise ValueError(f"Unsupported cipher: {cipher}")
+
+
+def cipher_throughput(size: int = CIPHER_BENCHMARK_SIZE, rounds: int = 3) -> Dict[str, float]:
+    """MB/s sealing size bytes in segments with each cipher suite, best of rounds"""
+    plaintext = os.urandom(DEFAULT_SEGMENT_SIZE)
+    nonce = bytes(12)
+    results = {}
+    for cipher in CIPHERS:
+        sealer = aead(cipher, os.urandom(32))
+        sealer.encrypt(nonce, plaintext, MAGIC)  # warm up
+        best = float('inf')
+        for _ in range(rounds):
+            started = time.perf_counter()
+            for _ in range(max(1, size // len(plaintext))):
+                sealer.encrypt(nonce, plaintext, MAGIC)
+            best = min(best, time.perf_counter() - started)
+        results[cipher] = max(1, size // len(plaintext)) * len(plaintext) / 1024 / 1024 / max(best, 1e-9)
+    return results
+
+
+_fastest_cipher: Optional[str] = None
+
+
+def fastest_cipher() -> str:
+    """
+    Cipher suite that seals fastest on this host, measured once per process.
+    ChaCha20-Poly1305 has to win clearly, so timing noise on a host with AES
+    instructions does not flip archives between suites from run to run.
+    """
+    global _fastest_cipher
+    if _fastest_cipher is None:
+        throughput = cipher_throughput()
+        faster = throughput[CIPHER_CHACHA20] > throughput[CIPHER_AES_GCM] * 1.1
+        _fastest_cipher = CIPHER_CHACHA20 if faster else CIPHER_AES_GCM
+    return _fastest_cipher
+
+
+class KeyCache:
+    """
+    Password-derived keys for one session.
+
+    Master keys are memoized per (KDF type, salt, parameters), so archives
+    sharing a master salt only pay for the memory-hard KDF once.
+    """
+
+    def __init__(self, password: str):
+        self._password = password
+        self._master_keys: Dict[Tuple[bytes, bytes, Optional[Tuple[int, int, int]]], bytes] = {}
+        self.kdf_runs = 0
+        self.kdf_seconds = 0.0
+
+    def master_key(self, kdf_type: bytes, salt: bytes, params: Optional[Tuple[int, int, int]] = None) -> bytes:
+        key = self._master_keys.get((kdf_type, salt, params))
+        if key is None:
+            started = time.perf_counter()
+            key = derive_key(self._password, kdf_type, salt, params)
+            self.kdf_seconds += time.perf_counter() - started
+            self._master_keys[(kdf_type, salt, params)] = key
+            self.kdf_runs += 1
+        return key
+
+    def archive_key(self, header: 'ContainerHeader') -> bytes:
+        """Key for one version 2 archive"""
+        master_key = self.master_key(header.kdf_type, header.salt, header.kdf_params)
+        if header.subkey_salt is None:
+            return master_key
+        return hkdf(master_key, b'pqbackup archive key', salt=header.subkey_salt)
+
+
+def read_exact(f: BinaryIO, size: int) -> bytes:
+    """Read up to size bytes, only returning less at end of file"""
+    data = f.read(size)
+    if len(data) == size or not data:
+        return data
+    chunks = [data]
+    remaining = size - len(data)
+    while remaining:
+        chunk = f.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+class ContainerHeader:
+    """Parsed or to-be-written version 2 header"""
+
+    def __init__(self, kdf_type: bytes, salt: bytes, nonce_prefix: bytes,
+                 segment_size: int = DEFAULT_SEGMENT_SIZE, version: int = FORMAT_VERSION,
+                 codec: Optional[str] = None, subkey_salt: Optional[bytes] = None, hash_tree: bool = False,
+                 kdf_params: Optional[Tuple[int, int, int]] = None, cipher: str = CIPHER_AES_GCM):
+        if not 0 < segment_size <= MAX_SEGMENT_SIZE:
+            raise ValueError(f"Segment size must be between 1 and {MAX_SEGMENT_SIZE} bytes")
+        if codec not in (None, 'zstd', 'lz4'):
+            raise ValueError(f"Unsupported stream codec: {codec}")
+        if cipher not in CIPHERS:
+            raise ValueError(f"Unsupported cipher: {cipher}")
+        if kdf_params is not None:
+            if kdf_type != b'ARGON2ID':
+                raise ValueError(f"KDF parameters are only defined for Argon2id, not {kdf_type.decode(errors='replace')}")
+            check_kdf_params(kdf_params)
+        self.codec = codec
+        self.subkey_salt = subkey_salt
+        self.hash_tree = hash_tree
+        # Argon2id cost chosen at encryption time; None means ARGON2_DEFAULT_PARAMS
+        self.kdf_params = kdf_params
+        self.cipher = cipher
+        self.kdf_type = kdf_type
+        self.salt = salt
+        self.nonce_prefix = nonce_prefix
+        self.segment_size = segment_size
+        self.version = version
+        # Exact header bytes, used as associated data for every segment
+        self.raw = self._serialize()
+
+    @classmethod
+    def create(cls, kdf_type: bytes, segment_size: int = DEFAULT_SEGMENT_SIZE,
+               codec: Optional[str] = None, master_salt: Optional[bytes] = None,
+               hash_tree: bool = False, kdf_params: Optional[Tuple[int, int, int]] = None,
+               cipher: str = CIPHER_AES_GCM) -> 'ContainerHeader':
+        """
+        New header with a fresh nonce prefix. Without master_salt the archive
+        gets its own KDF salt; with it, a fresh subkey salt.
+        """
+        if master_salt is None:
+            return cls(kdf_type, os.urandom(SALT_SIZE), os.urandom(NONCE_PREFIX_SIZE), segment_size, codec=codec,
+                       hash_tree=hash_tree, kdf_params=kdf_params, cipher=cipher)
+        return cls(kdf_type, master_salt, os.urandom(NONCE_PREFIX_SIZE), segment_size, codec=codec,
+                   subkey_salt=os.urandom(SALT_SIZE), hash_tree=hash_tree, kdf_params=kdf_params, cipher=cipher)
+
+    def _serialize(self) -> bytes:
+        records = [
+            (FIELD_KDF, self.kdf_type),
+            (FIELD_SALT, self.salt),
+            (FIELD_NONCE_PREFIX, self.nonce_prefix),
+            (FIELD_SEGMENT_SIZE, self.segment_size.to_bytes(4, 'big')),
+        ]
+        if self.codec:
+            records.append((FIELD_CODEC, self.codec.encode()))
+        if self.subkey_salt is not None:
+            records.append((FIELD_SUBKEY_SALT, self.subkey_salt))
+        if self.hash_tree:
+            records.append((FIELD_HASH_TREE, HASH_TREE_ALGORITHM))
+        if self.kdf_params is not None:
+            records.append((FIELD_KDF_PARAMS, struct.pack(KDF_PARAMS_FORMAT, *self.kdf_params)))
+        if self.cipher != CIPHER_AES_GCM:
+            # Left out for the default so AES-GCM archives stay readable by older versions
+            records.append((FIELD_CIPHER, self.cipher.encode()))
+        fields = b''.join(
+            tag.to_bytes(1, 'big') + len(value).to_bytes(2, 'big') + value
+            for tag, value in records
+        )
+        return (MAGIC + bytes([VERSIONED_MARKER, self.version])
+                + len(fields).to_bytes(2, 'big') + fields)
+
+    @classmethod
+    def read(cls, f: BinaryIO) -> 'ContainerHeader':
+        """Parse a header, leaving f positioned at the first segment"""
+        preamble = read_exact(f, len(MAGIC) + 2)
+        if preamble[:len(MAGIC)] != MAGIC or len(preamble) < len(MAGIC) + 2:
+            raise ValueError("Not a PQBACKUP file")
+        if preamble[len(MAGIC)] != VERSIONED_MARKER:
+            raise ValueError("Legacy (version 1) PQBACKUP file has no versioned header")
+        version = preamble[len(MAGIC) + 1]
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported PQBACKUP format version: {version}")
+
+        fields_len = int.from_bytes(read_exact(f, 2), 'big')
+        fields = read_exact(f, fields_len)
+        if len(fields) != fields_len:
+            raise ValueError("Truncated PQBACKUP header")
+
+        values = {}
+        pos = 0
+        while pos < len(fields):
+            if pos + 3 > len(fields):
+                raise ValueError("Malformed PQBACKUP header")
+            tag = fields[pos]
+            length = int.from_bytes(fields[pos + 1:pos + 3], 'big')
+            values[tag] = fields[pos + 3:pos + 3 + length]
+            pos += 3 + length
+
+        unknown = set(values) - {FIELD_KDF, FIELD_SALT, FIELD_NONCE_PREFIX, FIELD_SEGMENT_SIZE, FIELD_CODEC,
+                                 FIELD_SUBKEY_SALT, FIELD_HASH_TREE, FIELD_KDF_PARAMS, FIELD_CIPHER}
+        if unknown:
+            raise ValueError(f"Unsupported PQBACKUP header fields: {sorted(unknown)}")
+        try:
+            header = cls(
+                kdf_type=values[FIELD_KDF],
+                salt=values[FIELD_SALT],
+                nonce_prefix=values[FIELD_NONCE_PREFIX],
+                segment_size=int.from_bytes(values[FIELD_SEGMENT_SIZE], 'big'),
+                version=version,
+                codec=values[FIELD_CODEC].decode() if FIELD_CODEC in values else None,
+                subkey_salt=values.get(FIELD_SUBKEY_SALT),
+                hash_tree=FIELD_HASH_TREE in values,
+                kdf_params=(struct.unpack(KDF_PARAMS_FORMAT, values[FIELD_KDF_PARAMS])
+                            if FIELD_KDF_PARAMS in values else None),
+                cipher=values[FIELD_CIPHER].decode(errors='replace') if FIELD_CIPHER in values else CIPHER_AES_GCM
+            )
+        except KeyError as e:
+            raise ValueError(f"PQBACKUP header is missing field {e}")
+        except struct.error:
+            raise ValueError("Malformed PQBACKUP KDF parameters")
+        if len(header.nonce_prefix) != NONCE_PREFIX_SIZE:
+            raise ValueError("Malformed PQBACKUP nonce prefix")
+        if header.subkey_salt is not None and len(header.subkey_salt) != SALT_SIZE:
+            raise ValueError("Malformed PQBACKUP subkey salt")
+        if header.hash_tree and values[FIELD_HASH_TREE] != HASH_TREE_ALGORITHM:
+            raise ValueError(f"Unsupported hash tree algorithm: {values[FIELD_HASH_TREE].decode(errors='replace')}")
+        # Authenticate exactly what is on disk, not a re-serialization of it
+        header.raw = preamble + fields_len.to_bytes(2, 'big') + fields
+        return header
+
+    def nonce(self, counter: int, final: bool) -> bytes:
+        if counter >= 2 ** 32:
+            raise ValueError("Too many segments for a single archive")
+        return self.nonce_prefix + counter.to_bytes(4, 'big') + (b'\x01' if final else b'\x00')
+
+
+def leaf_hash(data) -> bytes:
+    return hashlib.sha256(b'\x00' + bytes(data)).digest()
+
+
+def tree_root(leaves: List[bytes]) -> bytes:
+    """Merkle root over leaf hashes (an odd node is carried up unchanged)"""
+    level = list(leaves) or [leaf_hash(b'')]
+    while len(level) > 1:
+        level = [hashlib.sha256(b'\x01' + level[i] + level[i + 1]).digest() if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+    return level[0]
+
+
+class HashTreeTrailer:
+    """Leaf hashes and root stored after the final segment"""
+
+    def __init__(self, leaves: List[bytes], root: bytes, offset: int):
+        self.leaves = leaves
+        self.root = root
+        # Where the trailer starts, i.e. where the segments end
+        self.offset = offset
+
+    @staticmethod
+    def serialize(leaves: List[bytes]) -> bytes:
+        return b''.join(leaves) + tree_root(leaves) + len(leaves).to_bytes(8, 'big') + TRAILER_MAGIC
+
+    @classmethod
+    def read(cls, f: BinaryIO) -> 'HashTreeTrailer':
+        """Parse the trailer at the end of f; the file position is left unchanged"""
+        position = f.tell()
+        try:
+            size = f.seek(0, io.SEEK_END)
+            if size < TRAILER_FOOTER_SIZE:
+                raise ValueError("Archive too short for its hash tree trailer")
+            f.seek(size - TRAILER_FOOTER_SIZE)
+            footer = read_exact(f, TRAILER_FOOTER_SIZE)
+            if footer[-len(TRAILER_MAGIC):] != TRAILER_MAGIC:
+                raise ValueError("Hash tree trailer missing (archive truncated?)")
+            count = int.from_bytes(footer[HASH_SIZE:HASH_SIZE + 8], 'big')
+            offset = size - TRAILER_FOOTER_SIZE - count * HASH_SIZE
+            if offset < 0:
+                raise ValueError("Malformed hash tree trailer")
+            f.seek(offset)
+            table = read_exact(f, count * HASH_SIZE)
+        finally:
+            f.seek(position)
+        leaves = [table[i:i + HASH_SIZE] for i in range(0, len(table), HASH_SIZE)]
+        return cls(leaves, footer[:HASH_SIZE], offset)
+
+
+def data_end(f: BinaryIO, header: ContainerHeader) -> int:
+    """
+    Offset just past the final segment (f holds the archive from its header on).
+
+    With a hash tree it follows from the file size and the authenticated
+    header alone: the trailer holds a leaf for the header and one per segment,
+    so its length is fixed by the segment count. The trailer itself is not
+    authenticated and is never read here, so damage to it fails verification,
+    not decryption. A wrong size still fails, as the final segment then does
+    not authenticate.
+    """
+    position = f.tell()
+    end = f.seek(0, io.SEEK_END)
+    f.seek(position)
+    if not header.hash_tree:
+        return end
+    sealed_size = header.segment_size + TAG_SIZE
+    # end = header + full * sealed_size + last + (full + 2) leaves + footer
+    available = end - len(header.raw) - 2 * HASH_SIZE - TRAILER_FOOTER_SIZE
+    full, last = divmod(available, sealed_size + HASH_SIZE)
+    if available < 0 or not TAG_SIZE <= last < sealed_size:
+        raise ValueError("Archive size does not fit its segments and hash tree (truncated or extended)")
+    return len(header.raw) + full * sealed_size + last
+
+
+class EncryptingWriter(io.RawIOBase):
+    """
+    Write-only stream that encrypts everything written to it into segments.
+
+    The header is written on construction and the final (short) segment on
+    close(), so the output is only a valid archive once the writer is closed.
+    At most one segment of plaintext is buffered at any time.
+
+    With resume (a checkpoint() taken before a crash), fileobj must be open
+    for reading and writing and already hold the header and at least that
+    many segments: they are rehashed for the hash tree, anything after them
+    is cut off, and writing continues where the checkpoint was taken. The
+    segments after the checkpoint are sealed again under the nonces they had
+    before the crash, so resuming is only safe when the plaintext from the
+    checkpoint on is exactly what was written the first time (a finished
+    file, never a stream rebuilt from a live tree).
+
+    Leaving a with block on an exception aborts instead of closing: no final
+    segment is sealed from a half-written buffer.
+    """
+
+    def __init__(self, fileobj: BinaryIO, key: bytes, header: ContainerHeader,
+                 resume: Optional[Tuple[int, bytes]] = None):
+        super().__init__()
+        self._fileobj = fileobj
+        self._aead = aead(header.cipher, key)
+        # Separate key for checkpoints, whose nonces are random rather than counters
+        self._checkpoint_aead = aead(header.cipher, hkdf(key, b'pqbackup checkpoint'))
+        self.header = header
+        self._buffer = bytearray()
+        self.segments_written = 0
+        self.bytes_in = 0
+        self.bytes_out = len(header.raw)
+        # Time spent sealing segments, for run metrics
+        self.seal_seconds = 0.0
+        # Exception that broke a write; the writer refuses any further data
+        self.error: Optional[BaseException] = None
+        self._leaves = [leaf_hash(header.raw)] if header.hash_tree else None
+        if resume is None:
+            fileobj.write(header.raw)
+        else:
+            self._resume(*resume)
+
+    def _resume(self, segments: int, sealed_buffer: bytes):
+        from cryptography.exceptions import InvalidTag
+
+        nonce, sealed = sealed_buffer[:12], sealed_buffer[12:]
+        try:
+            self._buffer = bytearray(self._checkpoint_aead.decrypt(nonce, sealed, self.header.raw))
+        except InvalidTag:
+            raise ValueError("Checkpoint does not authenticate (wrong password or damaged checkpoint)")
+        sealed_size = self.header.segment_size + TAG_SIZE
+        self._fileobj.seek(len(self.header.raw))
+        for counter in range(segments):
+            sealed = read_exact(self._fileobj, sealed_size)
+            if len(sealed) < sealed_size:
+                raise ValueError(f"Interrupted archive is missing segment {counter}")
+            if self._leaves is not None:
+                self._leaves.append(leaf_hash(sealed))
+        # Segments sealed after the checkpoint are written again
+        self._fileobj.truncate()
+        self.segments_written = segments
+        self.bytes_in = segments * self.header.segment_size + len(self._buffer)
+        self.bytes_out = len(self.header.raw) + segments * sealed_size
+
+    def checkpoint(self) -> Tuple[int, bytes]:
+        """
+        Resume point: the number of segments written and the plaintext still
+        buffered, sealed so it can be stored next to the archive. Only valid
+        once the underlying file has been flushed and synced.
+        """
+        nonce = os.urandom(12)
+        return self.segments_written, nonce + self._checkpoint_aead.encrypt(nonce, bytes(self._buffer),
+                                                                             self.header.raw)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.closed:
+            if self.error is not None:
+                raise ValueError(f"write to EncryptingWriter after it failed: {self.error!r}") from self.error
+            raise ValueError("write to closed EncryptingWriter")
+        size = self.header.segment_size
+        self._buffer += data
+        self.bytes_in += len(data)
+        if len(self._buffer) >= size:
+            view = memoryview(self._buffer)
+            offset = 0
+            try:
+                while len(self._buffer) - offset >= size:
+                    self._seal(view[offset:offset + size], final=False)
+                    offset += size
+            except BaseException as e:
+                # Part of a segment may have reached the file; nothing after it can be trusted
+                view.release()
+                self.error = e
+                self.abort()
+                raise
+            view.release()
+            del self._buffer[:offset]
+        return len(data)
+
+    def _seal(self, plaintext, final: bool):
+        started = time.perf_counter()
+        nonce = self.header.nonce(self.segments_written, final)
+        sealed = self._aead.encrypt(nonce, bytes(plaintext), self.header.raw)
+        if self._leaves is not None:
+            self._leaves.append(leaf_hash(sealed))
+        self.seal_seconds += time.perf_counter() - started
+        self._fileobj.write(sealed)
+        self.bytes_out += len(sealed)
+        self.segments_written += 1
+
+    def abort(self):
+        """
+        Close without sealing the final segment. Used when writing fails part
+        way: a final segment sealed from whatever happened to be buffered
+        would use the nonce the real final segment needs on a resume.
+        """
+        self._buffer = bytearray()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def __del__(self):
+        # Garbage collection must not finish an archive nobody closed
+        if not self.closed:
+            self.abort()
+
+    def close(self):
+        if not self.closed:
+            self._seal(self._buffer, final=True)
+            self._buffer = bytearray()
+            if self._leaves is not None:
+                trailer = HashTreeTrailer.serialize(self._leaves)
+                self._fileobj.write(trailer)
+                self.bytes_out += len(trailer)
+        super().close()
+
+
+def iter_decrypted_segments(f: BinaryIO, key: bytes, header: ContainerHeader) -> Iterator[bytes]:
+    """Authenticate and decrypt segments one at a time, yielding plaintext"""
+    from cryptography.exceptions import InvalidTag
+
+    opener = aead(header.cipher, key)
+    sealed_size = header.segment_size + TAG_SIZE
+    # Readers of hash tree archives must stop where the trailer starts
+    remaining = data_end(f, header) - f.tell() if header.hash_tree else None
+    counter = 0
+    while True:
+        if remaining is None:
+            sealed = read_exact(f, sealed_size)
+        else:
+            sealed = read_exact(f, min(sealed_size, remaining))
+            remaining -= len(sealed)
+        final = len(sealed) < sealed_size
+        if len(sealed) < TAG_SIZE:
+            raise ValueError(f"Archive truncated before segment {counter}")
+        try:
+            plaintext = opener.decrypt(header.nonce(counter, final), sealed, header.raw)
+        except InvalidTag:
+            raise ValueError(
+                f"Authentication failed for segment {counter} (wrong password or corrupted/truncated file)"
+            )
+        yield plaintext
+        if final:
+            return
+        counter += 1
+
+
+class SegmentReader(io.RawIOBase):
+    """
+    Seekable read-only view of a segmented archive's plaintext.
+
+    Segments are located by arithmetic, authenticated and decrypted on
+    demand, and the most recent few are kept. The final segment is checked on
+    construction, which proves the archive was not cut short. Only meaningful
+    without a codec: a compressed stream cannot be entered in the middle.
+    """
+
+    def __init__(self, f: BinaryIO, key: bytes, header: ContainerHeader, cached_segments: int = 4):
+        super().__init__()
+        self._f = f
+        self._aead = aead(header.cipher, key)
+        self.header = header
+        self._data_start = f.tell()
+        self._sealed_size = header.segment_size + TAG_SIZE
+        full, self._last_size = divmod(data_end(f, header) - self._data_start, self._sealed_size)
+        if self._last_size < TAG_SIZE:
+            raise ValueError(f"Archive truncated before segment {full}")
+        self.segment_count = full + 1
+        self.size = full * header.segment_size + self._last_size - TAG_SIZE
+        self._decrypted = set()
+        self._cache: OrderedDict = OrderedDict()
+        self._cached_segments = cached_segments
+        self._pos = 0
+        self._segment(full)
+
+    def _segment(self, counter: int) -> bytes:
+        from cryptography.exceptions import InvalidTag
+
+        if counter in self._cache:
+            self._cache.move_to_end(counter)
+            return self._cache[counter]
+        final = counter == self.segment_count - 1
+        self._f.seek(self._data_start + counter * self._sealed_size)
+        sealed = read_exact(self._f, self._last_size if final else self._sealed_size)
+        try:
+            plaintext = self._aead.decrypt(self.header.nonce(counter, final), sealed, self.header.raw)
+        except InvalidTag:
+            raise ValueError(
+                f"Authentication failed for segment {counter} (wrong password or corrupted/truncated file)"
+            )
+        self._decrypted.add(counter)
+        self._cache[counter] = plaintext
+        if len(self._cache) > self._cached_segments:
+            self._cache.popitem(last=False)
+        return plaintext
+
+    @property
+    def segments_decrypted(self) -> int:
+        """Distinct segments touched so far"""
+        return len(self._decrypted)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, b) -> int:
+        # Fill b completely (up to end of data), crossing segment boundaries
+        view = memoryview(b).cast('B')
+        filled = 0
+        while filled < len(view) and self._pos < self.size:
+            counter, offset = divmod(self._pos, self.header.segment_size)
+            chunk = self._segment(counter)[offset:offset + len(view) - filled]
+            view[filled:filled + len(chunk)] = chunk
+            filled += len(chunk)
+            self._pos += len(chunk)
+        return filled
+
+
+def _import_codec(codec: str):
+    try:
+        if codec == 'zstd':
+            import zstandard
+            return zstandard
+        import lz4.frame
+        return lz4.frame
+    except ImportError:
+        package = 'zstandard' if codec == 'zstd' else 'lz4'
+        raise ImportError(f"{package} required for the {codec} codec. Install: pip install {package}")
+
+
+class CompressingWriter(io.RawIOBase):
+    """
+    Compress everything written into one zstd or lz4 stream before passing it
+    on to an EncryptingWriter. zstd runs with worker threads and long-distance
+    matching, so repeats far apart in the archive are still found.
+    """
+
+    def __init__(self, inner: EncryptingWriter, codec: str, level: Optional[int] = None, threads: int = 0):
+        super().__init__()
+        module = _import_codec(codec)
+        self._inner = inner
+        level = DEFAULT_CODEC_LEVELS[codec] if level is None else level
+        if codec == 'zstd':
+            params = module.ZstdCompressionParameters.from_level(
+                level, threads=threads, enable_ldm=True, window_log=ZSTD_WINDOW_LOG
+            )
+            self._compressor = module.ZstdCompressor(compression_params=params).compressobj()
+            self._prefix = b''
+        else:
+            self._compressor = module.LZ4FrameCompressor(compression_level=level)
+            self._prefix = self._compressor.begin()
+        self.bytes_in = 0
+        self.compress_seconds = 0.0
+
+    @property
+    def header(self) -> ContainerHeader:
+        return self._inner.header
+
+    @property
+    def segments_written(self) -> int:
+        return self._inner.segments_written
+
+    @property
+    def bytes_compressed(self) -> int:
+        return self._inner.bytes_in
+
+    @property
+    def bytes_out(self) -> int:
+        return self._inner.bytes_out
+
+    @property
+    def seal_seconds(self) -> float:
+        return self._inner.seal_seconds
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed CompressingWriter")
+        started = time.perf_counter()
+        out = self._compressor.compress(bytes(data))
+        self.compress_seconds += time.perf_counter() - started
+        if self._prefix:
+            out = self._prefix + out
+            self._prefix = b''
+        if out:
+            self._inner.write(out)
+        self.bytes_in += len(data)
+        return len(data)
+
+    def abort(self):
+        self._inner.abort()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self._inner.write(self._prefix + self._compressor.flush())
+            self._inner.close()
+        super().close()
+
+
+def iter_decompressed(blocks: Iterator[bytes], codec: str) -> Iterator[bytes]:
+    """Undo CompressingWriter on a stream of decrypted blocks"""
+    module = _import_codec(codec)
+    if codec == 'zstd':
+        decompressor = module.ZstdDecompressor(max_window_size=2 ** ZSTD_WINDOW_LOG).decompressobj()
+    else:
+        decompressor = module.LZ4FrameDecompressor()
+    for block in blocks:
+        if block:
+            out = decompressor.decompress(block)
+            if out:
+                yield out
+    if not decompressor.eof:
+        raise ValueError(f"Archive ends in the middle of its {codec} stream")
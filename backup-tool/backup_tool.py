@@ -4,18 +4,40 @@ Secure Backup Tool with Post-Quantum Encryption
 Supports selective file/folder backup with multiple cloud storage backends
 """
 
+import io
 import os
+import re
 import sys
 import json
 import yaml
 import zipfile
 import hashlib
+import shutil
 import argparse
+import contextlib
+import time
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import BinaryIO, Callable, List, Dict, Iterable, Iterator, Optional, Set, Tuple
 import logging
 
+from backup_format import (
+    CIPHER_AES_GCM, CIPHER_NAMES, CIPHERS, CODECS, SALT_SIZE, ContainerHeader, CompressingWriter, EncryptingWriter,
+    DEFAULT_SEGMENT_SIZE, KeyCache, fastest_cipher
+)
+from change_journal import ChangeJournal, ChangeWatcher, settings_fingerprint
+from duplicates import DEFAULT_MIN_SIZE, DUPLICATES_MEMBER, DuplicateFinder, parse_references
+from kdf_calibration import DEFAULT_MEMORY_BUDGET, DEFAULT_TARGET_SECONDS, calibrate, load_calibration, save_calibration
+from metrics import RunMetrics, StageMetrics
+from parallel_zip import CompressionPolicy, ParallelZipCompressor
+from repository import Repository
+from run_checkpoint import PARTIAL_SUFFIX, DEFAULT_INTERVAL, RunCheckpoint, commit_rename, fsync_file, run_fingerprint
+from solid_blocks import DEFAULT_BLOCK_SIZE, DEFAULT_MAX_FILE_SIZE, SolidPacker
+from uploads import (
+    DEFAULT_CONCURRENCY, DEFAULT_PART_SIZE, AzureUploader, S3Uploader, StreamingUpload, TeeWriter,
+    UploadCheckpoint, UploadEngine
+)
+
 # PQ encryption using liboqs via oqs library
 try:
     import oqs
@@ -35,6 +57,10 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+# Archive member listing paths removed since the previous incremental backup
+DELETED_PATHS_MEMBER = '.backup-deleted.json'
+
+
 class BackupConfig:
     """Handles configuration loading from file or environment variables"""
     
@@ -58,10 +84,37 @@ class BackupConfig:
                 'include_paths': [],
                 'exclude_patterns': [],
                 'output_dir': './backups',
-                'compression_level': 9
+                'compression_level': 9,
+                'compression_workers': 0,
+                'codec': 'deflate',
+                'codec_level': None,
+                'adaptive_compression': True,
+                'solid_blocks': False,
+                'solid_block_size': DEFAULT_BLOCK_SIZE,
+                'solid_file_limit': DEFAULT_MAX_FILE_SIZE,
+                'duplicate_detection': False,
+                'duplicate_min_size': DEFAULT_MIN_SIZE,
+                'mode': 'archive',
+                'repository_path': None,
+                'incremental': False,
+                'manifest_path': None,
+                'change_journal': False,
+                'journal_path': None,
+                'pipeline': False,
+                'resumable': True,
+                'checkpoint_interval': DEFAULT_INTERVAL
             },
             'encryption': {
                 'algorithm': 'Kyber1024',  # Post-quantum KEM
+                'segment_size': DEFAULT_SEGMENT_SIZE,
+                'key_hierarchy': True,
+                'master_key_path': None,
+                'hash_tree': True,
+                'cipher': 'auto',
+                'kdf_params': None,
+                'kdf_calibration_path': None,
+                'kdf_target_seconds': DEFAULT_TARGET_SECONDS,
+                'kdf_memory_budget': DEFAULT_MEMORY_BUDGET,
                 'password_file': None,
                 'use_env_password': True
             },
@@ -75,8 +128,21 @@ class BackupConfig:
                 'aws': {
                     'enabled': False,
                     'bucket_name': None,
-                    'region': 'us-east-1'
+                    'region': 'us-east-1',
+                    'endpoint_url': None
+                },
+                'upload': {
+                    'part_size': DEFAULT_PART_SIZE,
+                    'concurrency': DEFAULT_CONCURRENCY,
+                    'checkpoints': True,
+                    'streaming': False,
+                    'keep_local_copy': True
                 }
+            },
+            'metrics': {
+                'json_path': None,
+                'prometheus_path': None,
+                'progress': False
             }
         }
     
@@ -91,6 +157,7 @@ class BackupConfig:
             'AZURE_CONTAINER': ('storage', 'azure', 'container_name'),
             'AWS_BUCKET_NAME': ('storage', 'aws', 'bucket_name'),
             'AWS_REGION': ('storage', 'aws', 'region'),
+            'AWS_ENDPOINT_URL': ('storage', 'aws', 'endpoint_url'),
         }
         
         for env_var, config_path in env_mappings.items():
@@ -132,9 +199,24 @@ class PostQuantumEncryption:
     to someone's public key and they decrypt with their private key.
     """
     
-    def __init__(self, algorithm: str = 'Kyber1024'):
+    def __init__(self, algorithm: str = 'Kyber1024', segment_size: int = DEFAULT_SEGMENT_SIZE,
+                 codec: Optional[str] = None, codec_level: Optional[int] = None, codec_threads: int = 0):
         # We accept the algorithm parameter for compatibility but use Argon2id for PQ-resistant KDF
         self.algorithm = algorithm
+        self.segment_size = segment_size
+        # Optional zstd/lz4 stream compression inside the container
+        self.codec = codec
+        self.codec_level = codec_level
+        self.codec_threads = codec_threads
+        # Shared KDF salt for the key hierarchy; None gives each archive its own
+        self.master_salt: Optional[bytes] = None
+        # Append ciphertext hashes for verify_backup.py
+        self.hash_tree = False
+        # Argon2id (time cost, memory cost KiB, parallelism) recorded in the header; None keeps the defaults
+        self.kdf_params: Optional[Tuple[int, int, int]] = None
+        # AEAD sealing the segments, recorded in the header
+        self.cipher = CIPHER_AES_GCM
+        self._key_caches: Dict[str, KeyCache] = {}
         
         # Check if argon2-cffi is available for quantum-resistant KDF
         try:
@@ -144,89 +226,81 @@ class PostQuantumEncryption:
         except ImportError:
             logger.warning("argon2-cffi not installed, using PBKDF2-HMAC-SHA512 (still secure)")
             self.use_argon2 = False
+        
+        # Argon2id is memory-hard and quantum-resistant; PBKDF2-HMAC-SHA512
+        # with a very high iteration count is the fallback
+        self.kdf_type = b'ARGON2ID' if self.use_argon2 else b'PBKDF2SHA512'
     
-    def encrypt_file(self, input_path: str, output_path: str, password: str):
+    @property
+    def kdf_seconds(self) -> float:
+        """Time spent in the password KDF so far"""
+        return sum(keys.kdf_seconds for keys in self._key_caches.values())
+    
+    def open_writer(self, fileobj, password: str, header: Optional[ContainerHeader] = None,
+                    resume: Optional[Tuple[int, bytes]] = None) -> EncryptingWriter:
         """
-        Encrypt file using password-based encryption with quantum-resistant KDF
+        Start a PQBACKUP (version 2) container on fileobj.
+
+        Returns a writer that encrypts whatever is written to it in fixed-size,
+        individually authenticated segments; closing it finishes the archive.
+        With a codec set, data is compressed on its way into the encryptor and
+        the codec is recorded in the header.
+
+        With a master salt set, the memory-hard KDF runs once per password and
+        each archive is keyed through its own random subkey salt.
+
+        header and resume (an EncryptingWriter checkpoint) continue an
+        interrupted archive already in fileobj instead of starting a new one.
         """
-        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-        from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-        from cryptography.hazmat.primitives import hashes
-        from cryptography.hazmat.backends import default_backend
-        
-        # Generate salt
-        salt = os.urandom(32)  # Larger salt for PQ resistance
-        
-        # Derive encryption key using quantum-resistant parameters
-        if self.use_argon2:
-            # Argon2id is memory-hard and quantum-resistant
-            # Parameters: time_cost=3, memory_cost=64MB, parallelism=4
-            hasher = self.argon2.PasswordHasher(
-                time_cost=3,
-                memory_cost=65536,  # 64 MB
-                parallelism=4,
-                hash_len=32,
-                salt_len=32
-            )
-            # Use low-level API to get raw key
-            from argon2.low_level import hash_secret_raw, Type
-            key = hash_secret_raw(
-                secret=password.encode(),
-                salt=salt,
-                time_cost=3,
-                memory_cost=65536,
-                parallelism=4,
-                hash_len=32,
-                type=Type.ID
-            )
-            kdf_type = b'ARGON2ID'
-        else:
-            # Fallback: PBKDF2-HMAC-SHA512 with very high iteration count
-            kdf = PBKDF2HMAC(
-                algorithm=hashes.SHA512(),  # SHA512 for extra security
-                length=32,
-                salt=salt,
-                iterations=500000,  # Very high iteration count
-                backend=default_backend()
-            )
-            key = kdf.derive(password.encode())
-            kdf_type = b'PBKDF2SHA512'
-        
-        # Encrypt file with AES-256-GCM
-        iv = os.urandom(16)
-        cipher = Cipher(
-            algorithms.AES(key),
-            modes.GCM(iv),
-            backend=default_backend()
-        )
-        encryptor = cipher.encryptor()
-        
-        with open(input_path, 'rb') as f:
-            plaintext = f.read()
-        
-        ciphertext = encryptor.update(plaintext) + encryptor.finalize()
+        # Fresh 32 byte salt or subkey salt (larger salt for PQ resistance) and nonce prefix
+        header = header or ContainerHeader.create(self.kdf_type, self.segment_size, self.codec, self.master_salt,
+                                                  self.hash_tree,
+                                                  self.kdf_params if self.use_argon2 else None, self.cipher)
+        keys = self._key_caches.setdefault(password, KeyCache(password))
+        key = keys.archive_key(header)
         
-        # Write encrypted file with metadata
-        with open(output_path, 'wb') as f:
-            # Header format:
-            # - Magic bytes: "PQBACKUP" (8 bytes)
-            # - KDF type length (1 byte)
-            # - KDF type (variable, e.g., "ARGON2ID" or "PBKDF2SHA512")
-            # - Salt (32 bytes)
-            # - IV (16 bytes)
-            # - GCM tag (16 bytes)
-            # - Encrypted data (variable)
-            
-            f.write(b'PQBACKUP')
-            f.write(len(kdf_type).to_bytes(1, 'big'))
-            f.write(kdf_type)
-            f.write(salt)
-            f.write(iv)
-            f.write(encryptor.tag)
-            f.write(ciphertext)
+        writer = EncryptingWriter(fileobj, key, header, resume)
+        if self.codec:
+            return CompressingWriter(writer, self.codec, self.codec_level, self.codec_threads)
+        return writer
+    
+    def encrypt_file(self, input_path: str, output_path: str, password: str,
+                     resume: Optional[Tuple[int, bytes]] = None,
+                     on_segment: Optional[Callable[[EncryptingWriter, BinaryIO], None]] = None) -> EncryptingWriter:
+        """
+        Encrypt file using password-based encryption with quantum-resistant KDF.
+
+        The input is streamed through the AEAD cipher one segment at a time, so memory
+        use is bounded by the segment size rather than the archive size.
+        Returns the closed writer, which carries the byte and timing counters.
+
+        resume (an EncryptingWriter checkpoint) continues an interrupted
+        output_path. on_segment(writer, output file) is called after every
+        segment-sized block, the points a crash-safe run can checkpoint at.
+        """
+        with open(input_path, 'rb') as src, open(output_path, 'r+b' if resume else 'wb') as dst:
+            if resume:
+                writer = self.open_writer(dst, password, ContainerHeader.read(dst), resume)
+                src.seek(writer.bytes_in)
+            else:
+                writer = self.open_writer(dst, password)
+            with writer:
+                if on_segment is None:
+                    shutil.copyfileobj(src, writer, self.segment_size)
+                else:
+                    for block in iter(lambda: src.read(self.segment_size), b''):
+                        writer.write(block)
+                        on_segment(writer, dst)
         
-        kdf_name = kdf_type.decode() if isinstance(kdf_type, bytes) else kdf_type
-        logger.info(f"File encrypted with AES-256-GCM + {kdf_name} (quantum-resistant)")
+        kdf_name = writer.header.kdf_type.decode()
+        logger.info(
+            f"File encrypted with {CIPHER_NAMES[writer.header.cipher]} + {kdf_name} (quantum-resistant, "
+            f"{writer.segments_written} segments of {self.segment_size // 1024} KiB)"
+        )
+        if self.codec:
+            logger.info(f"Compressed with {self.codec}: {writer.bytes_in / 1024 / 1024:.2f} MB -> "
+                        f"{writer.bytes_compressed / 1024 / 1024:.2f} MB")
+        return writer
 
 
 
@@ -278,64 +352,440 @@ class SimpleEncryption:
         logger.info("File encrypted with AES-256-GCM")
 
 
+class FileManifest:
+    """
+    Persistent record of what the previous backup contained.
+
+    Maps each archived path (relative to root_path) to its size, mtime, inode
+    and SHA-256 content hash. Files whose size, mtime and inode are unchanged
+    are trusted without being read again; anything else is hashed, so a file
+    that was merely touched is not archived a second time.
+    """
+    
+    VERSION = 1
+    
+    def __init__(self, path: Path, entries: Optional[Dict[str, Dict]] = None, backup_time: Optional[str] = None):
+        self.path = path
+        self.entries = entries or {}
+        self.backup_time = backup_time
+    
+    @classmethod
+    def load(cls, path: Path) -> 'FileManifest':
+        if not path.exists():
+            return cls(path)
+        with open(path, 'r') as f:
+            data = json.load(f)
+        if data.get('version') != cls.VERSION:
+            logger.warning(f"Ignoring manifest with unsupported version: {path}")
+            return cls(path)
+        return cls(path, data.get('files', {}), data.get('backup_time'))
+    
+    @staticmethod
+    def hash_file(file_path: Path) -> str:
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    def diff(self, files: List[Path], root_path: Path,
+             touched: Optional[Set[str]] = None) -> Tuple[List[Path], List[str], 'FileManifest']:
+        """
+        Compare collected files against this manifest.
+
+        Returns the files that are new or changed, the relative paths that no
+        longer exist, and the manifest describing the current tree. With
+        touched (paths the change journal saw change since this manifest was
+        saved), other files keep their entry without even a stat.
+        """
+        changed = []
+        current = {}
+        
+        for file_path in files:
+            previous = None
+            try:
+                rel_path = file_path.relative_to(root_path).as_posix()
+                previous = self.entries.get(rel_path)
+                if touched is not None and previous and str(file_path) not in touched:
+                    current[rel_path] = previous
+                    continue
+                st = file_path.stat()
+                entry = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'inode': st.st_ino}
+                
+                if previous and all(previous.get(k) == v for k, v in entry.items()):
+                    entry['sha256'] = previous['sha256']
+                else:
+                    entry['sha256'] = self.hash_file(file_path)
+                    if not previous or previous.get('sha256') != entry['sha256']:
+                        changed.append(file_path)
+            except (OSError, ValueError) as e:
+                # Unreadable is not deleted: keep the last known entry (new files
+                # stay out of the manifest), so the next run retries it
+                logger.error(f"Failed to read {file_path}: {e}")
+                if previous:
+                    current[rel_path] = previous
+                continue
+            current[rel_path] = entry
+        
+        deleted = sorted(set(self.entries) - set(current))
+        return changed, deleted, FileManifest(self.path, current)
+    
+    def revert(self, rel_paths: Iterable[str], previous: 'FileManifest'):
+        """
+        Put back the previous entry of paths that did not make it into the
+        archive after all (dropping paths that are new), so the next run
+        sees them as changed and archives them.
+        """
+        for rel_path in rel_paths:
+            if rel_path in previous.entries:
+                self.entries[rel_path] = previous.entries[rel_path]
+            else:
+                self.entries.pop(rel_path, None)
+    
+    def save(self, backup_time: str):
+        """Write atomically; the manifest lists file names, so keep it private"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'version': self.VERSION, 'backup_time': backup_time, 'files': self.entries}, f)
+        os.replace(tmp_path, self.path)
+
+
+class ExcludeMatcher:
+    """
+    All exclude patterns compiled into one regular expression.
+
+    Patterns follow glob rules: "*", "?" and "[...]" stay within one path
+    component and "**" spans any number of them. Relative patterns match the end
+    of a path (like Path.match), so "*.log" excludes every .log file; patterns
+    starting with "/" are anchored at the filesystem root. Patterns ending in
+    "/**" also exclude the directory itself, which lets the walker prune it
+    without listing anything below it.
+    """
+    
+    def __init__(self, patterns: List[str]):
+        file_regexes = []
+        dir_regexes = []
+        for pattern in patterns:
+            file_regexes.append(self._translate(pattern))
+            if pattern.endswith('/**') and pattern.rstrip('/*'):
+                dir_regexes.append(self._translate(pattern[:-3]))
+        self._file_re = self._combine(file_regexes)
+        self._dir_re = self._combine(dir_regexes)
+    
+    @staticmethod
+    def _combine(regexes: List[str]):
+        if not regexes:
+            return None
+        return re.compile('|'.join(f'(?:{r})' for r in regexes))
+    
+    @staticmethod
+    def _translate_component(component: str) -> str:
+        out = []
+        i = 0
+        while i < len(component):
+            c = component[i]
+            if c == '*':
+                out.append('[^/]*')
+            elif c == '?':
+                out.append('[^/]')
+            elif c == '[' and component.find(']', i + 2) != -1:
+                # Character class; a ']' right after '[' is a literal member
+                end = component.find(']', i + 2)
+                body = component[i + 1:end].replace('\\', '\\\\')
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                out.append('[' + body + ']')
+                i = end
+            else:
+                out.append(re.escape(c))
+            i += 1
+        return ''.join(out)
+    
+    def _translate(self, pattern: str) -> str:
+        anchored = pattern.startswith('/')
+        components = [c for c in pattern.strip('/').split('/') if c]
+        parts = []
+        for index, component in enumerate(components):
+            last = index == len(components) - 1
+            if component == '**':
+                parts.append('[^/]+(?:/[^/]+)*' if last else '(?:[^/]+/)*')
+            else:
+                parts.append(self._translate_component(component) + ('' if last else '/'))
+        return ('^/' if anchored else '(?:^|/)') + ''.join(parts) + '$'
+    
+    def excludes_file(self, path: str) -> bool:
+        return self._file_re is not None and self._file_re.search(path) is not None
+    
+    def prunes_dir(self, path: str) -> bool:
+        return self._dir_re is not None and self._dir_re.search(path) is not None
+
+
+def walk_files(top: Path, matcher: ExcludeMatcher) -> Iterator[Path]:
+    """
+    Yield files under top, skipping excluded files and never descending into
+    excluded directories. Symlinked directories are not followed.
+    """
+    stack = [str(top)]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as e:
+            logger.warning(f"Cannot read directory {directory}: {e}")
+            continue
+        
+        subdirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if not matcher.prunes_dir(entry.path):
+                        subdirs.append(entry.path)
+                elif entry.is_file() and not matcher.excludes_file(entry.path):
+                    yield Path(entry.path)
+            except OSError as e:
+                logger.warning(f"Cannot stat {entry.path}: {e}")
+        # Reversed so directories are visited in name order
+        stack.extend(reversed(subdirs))
+
+
 class BackupManager:
     """Main backup management class"""
     
     def __init__(self, config: BackupConfig):
         self.config = config
         self.backup_time = datetime.now().strftime('%Y%m%d_%H%M%S')
+        # Small metadata files added to the archive next to the backed up files
+        self.metadata_members: Dict[str, bytes] = {}
+        # Archive names of files that could not be read into the archive
+        self.failed_members: List[str] = []
+        self._upload_engine: Optional[UploadEngine] = None
+        # Set by collect_files when the change journal is enabled
+        self.journal: Optional[ChangeJournal] = None
+        self.metrics = RunMetrics(self.backup_time, progress=bool(config.get('metrics', 'progress', default=False)))
     
-    def collect_files(self) -> List[Path]:
-        """Collect all files to backup based on configuration"""
+    def _include_roots(self) -> List[Path]:
         root_path = Path(self.config.get('backup', 'root_path'))
-        include_paths = self.config.get('backup', 'include_paths', default=[])
+        return [root_path / include_path.lstrip('/')
+                for include_path in self.config.get('backup', 'include_paths', default=[])]
+    
+    def change_journal(self) -> ChangeJournal:
+        return ChangeJournal(*self._journal_args(), walk_files)
+    
+    def change_watcher(self) -> ChangeWatcher:
+        return ChangeWatcher(*self._journal_args())
+    
+    def _journal_args(self):
+        output_dir = Path(self.config.get('backup', 'output_dir'))
+        journal_dir = Path(self.config.get('backup', 'journal_path', default=None) or output_dir / 'change-journal')
+        exclude_patterns = self.config.get('backup', 'exclude_patterns', default=[])
+        fingerprint = settings_fingerprint(self.config.get('backup', 'root_path'),
+                                           self.config.get('backup', 'include_paths', default=[]),
+                                           exclude_patterns)
+        return journal_dir, self._include_roots(), ExcludeMatcher(exclude_patterns), fingerprint
+    
+    def collect_files(self) -> List[Path]:
+        """
+        Collect all files to backup based on configuration.
+
+        With change_journal enabled and the watcher running, the previous
+        file list is updated from the journal instead of walking the tree.
+        """
+        if self.config.get('backup', 'change_journal', default=False):
+            self.journal = self.change_journal()
+            reason = self.journal.capture()
+            if reason:
+                logger.info(f"Change journal not used ({reason}); scanning everything")
+            files = self.journal.replay()
+            if files is None:
+                files = self._scan_files()
+            else:
+                logger.info(f"Collected {len(files)} files for backup")
+            self.journal.save(files)
+            return files
+        return self._scan_files()
+    
+    def _scan_files(self) -> List[Path]:
         exclude_patterns = self.config.get('backup', 'exclude_patterns', default=[])
         
         collected_files = []
+        matcher = ExcludeMatcher(exclude_patterns)
         
-        for include_path in include_paths:
-            full_path = root_path / include_path.lstrip('/')
-            
+        for full_path in self._include_roots():
             if full_path.is_file():
                 collected_files.append(full_path)
             elif full_path.is_dir():
-                for item in full_path.rglob('*'):
-                    if item.is_file():
-                        # Check exclude patterns
-                        if not any(item.match(pattern) for pattern in exclude_patterns):
-                            collected_files.append(item)
+                # Excluded directories are pruned instead of walked and filtered
+                collected_files.extend(walk_files(full_path, matcher))
             else:
                 logger.warning(f"Path not found: {full_path}")
         
         logger.info(f"Collected {len(collected_files)} files for backup")
         return collected_files
     
-    def create_zip(self, files: List[Path]) -> str:
-        """Create compressed zip archive"""
+    def _iter_members(self, files: List[Path]) -> Iterator[Tuple[Path, str]]:
+        """Pair each file with its archive name (path relative to root_path)"""
+        root_path = Path(self.config.get('backup', 'root_path'))
+        
+        for file_path in files:
+            try:
+                yield file_path, file_path.relative_to(root_path).as_posix()
+            except ValueError as e:
+                logger.error(f"Failed to add {file_path}: {e}")
+    
+    def _compression_workers(self) -> int:
+        """Configured compression worker count; 0 or unset means one per CPU core"""
+        workers = self.config.get('backup', 'compression_workers', default=0)
+        return int(workers) if workers else (os.cpu_count() or 1)
+    
+    def _solid_packer(self) -> Optional[SolidPacker]:
+        if not self.config.get('backup', 'solid_blocks', default=False):
+            return None
+        return SolidPacker(
+            self.config.get('backup', 'solid_block_size', default=DEFAULT_BLOCK_SIZE),
+            self.config.get('backup', 'solid_file_limit', default=DEFAULT_MAX_FILE_SIZE)
+        )
+    
+    def _write_zipfile(self, fileobj, members, compression_level: Optional[int],
+                       policy: Optional[CompressionPolicy]) -> int:
+        """Single-threaded zipfile path; compression_level None stores every member. Returns bytes read"""
+        method = zipfile.ZIP_STORED if compression_level is None else zipfile.ZIP_DEFLATED
+        with zipfile.ZipFile(fileobj, 'w', method, compresslevel=compression_level) as zipf:
+            for source, arcname in members:
+                try:
+                    level = compression_level
+                    if isinstance(source, bytes):
+                        if policy:
+                            method, level = policy.choose(Path(arcname), io.BytesIO(source), len(source))
+                        zipf.writestr(arcname, source, compress_type=method, compresslevel=level)
+                        continue
+                    if policy:
+                        with open(source, 'rb') as f:
+                            method, level = policy.choose(source, f, os.fstat(f.fileno()).st_size)
+                    zipf.write(source, arcname, compress_type=method, compresslevel=level)
+                    logger.debug(f"Added to archive: {arcname}")
+                except Exception as e:
+                    if getattr(fileobj, 'error', None) is not None:
+                        # The output itself failed; skipping the member would hide it
+                        raise
+                    if zipf.filelist and zipf.filelist[-1].filename == arcname:
+                        # Read failed part way: leave the partial member out of the central directory
+                        zipf.NameToInfo.pop(zipf.filelist.pop().filename, None)
+                    logger.error(f"Failed to add {arcname}: {e}")
+                    self.failed_members.append(arcname)
+            for arcname, data in self.metadata_members.items():
+                zipf.writestr(arcname, data)
+        return sum(info.file_size for info in zipf.infolist())
+    
+    def write_archive(self, fileobj, files: List[Path], run: Optional[RunCheckpoint] = None,
+                      commit: Optional[Callable] = None) -> int:
+        """
+        Compress files into a zip archive written to fileobj; returns the uncompressed bytes archived.
+
+        With run, members committed by an interrupted attempt are skipped and
+        commit(zip writer) is called at a member boundary every
+        checkpoint_interval bytes of output.
+        """
+        compression_level = self.config.get('backup', 'compression_level', default=9)
+        workers = self._compression_workers()
+        members = self._iter_members(files)
+        metadata_members = self.metadata_members
+        writer, on_member = None, None
+        if run:
+            done = run.done_members()
+            members = (member for member in members if member[1] not in done)
+            metadata_members = {name: data for name, data in metadata_members.items() if name not in done}
+            writer = run.zip_writer(fileobj)
+            if done:
+                logger.info(f"Resuming after {len(done)} archived members "
+                            f"({writer.offset / 1024 / 1024:.2f} MB of zip)")
+            interval = self.config.get('backup', 'checkpoint_interval', default=DEFAULT_INTERVAL)
+            committed = [writer.offset]
+            
+            def on_member(zip_writer):
+                if zip_writer.offset - committed[0] >= interval:
+                    commit(zip_writer)
+                    committed[0] = zip_writer.offset
+        packer = self._solid_packer()
+        if packer:
+            # Small files travel in shared blocks; large ones stay regular members
+            members = packer.pack(members)
+        
+        policy = None
+        if self.config.get('backup', 'codec', default='deflate') != 'deflate':
+            # The whole stream is compressed inside the container, so members are stored
+            bytes_in = self._write_zipfile(fileobj, members, None, None)
+        else:
+            if self.config.get('backup', 'adaptive_compression', default=True):
+                # Store already-compressed content, pick the deflate level per file
+                policy = CompressionPolicy(compression_level)
+            
+            if workers > 1 or run:
+                # Chunks are deflated on a thread pool and reassembled in deterministic order;
+                # checkpointed runs need this writer even on one worker
+                compressor = ParallelZipCompressor(workers, compression_level, policy=policy)
+                self.failed_members += compressor.write_archive(fileobj, members, metadata_members, writer, on_member)
+                bytes_in = compressor.bytes_in
+                logger.info(f"Compressed {compressor.files_written} files on {workers} workers "
+                            f"({compressor.bytes_in / 1024 / 1024:.2f} MB -> {compressor.bytes_out / 1024 / 1024:.2f} MB)")
+            else:
+                bytes_in = self._write_zipfile(fileobj, members, compression_level, policy)
+        
+        if packer:
+            self.failed_members += packer.failed
+            logger.info(f"Solid packing: {packer.files_packed} small files "
+                        f"({packer.bytes_packed / 1024 / 1024:.2f} MB) in {packer.blocks_written} blocks")
+        if policy:
+            logger.info(f"Adaptive compression: {policy.summary()}")
+        return bytes_in
+    
+    def create_zip(self, files: List[Path], run: Optional[RunCheckpoint] = None) -> str:
+        """
+        Create compressed zip archive.
+
+        It is written as <name>.partial and renamed once complete. With run,
+        an interrupted attempt is continued from its last checkpoint.
+        """
         output_dir = Path(self.config.get('backup', 'output_dir'))
         output_dir.mkdir(parents=True, exist_ok=True)
         
         zip_filename = f"backup_{self.backup_time}.zip"
         zip_path = output_dir / zip_filename
+        partial_path = output_dir / (zip_filename + PARTIAL_SUFFIX)
+        if run and zip_path.exists():
+            logger.info(f"Archive of the interrupted run is complete: {zip_path}")
+            return str(zip_path)
         
-        compression_level = self.config.get('backup', 'compression_level', default=9)
-        root_path = Path(self.config.get('backup', 'root_path'))
-        
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=compression_level) as zipf:
-            for file_path in files:
-                try:
-                    # Store relative path in zip
-                    arcname = file_path.relative_to(root_path)
-                    zipf.write(file_path, arcname)
-                    logger.debug(f"Added to archive: {arcname}")
-                except Exception as e:
-                    logger.error(f"Failed to add {file_path}: {e}")
+        resume = run is not None and run.zip_offset > 0
+        if resume and not partial_path.exists():
+            logger.warning(f"{partial_path} is gone; compressing from the start")
+            run.reset_output()
+            resume = False
+        with self.metrics.stage('compress') as stage, open(partial_path, 'r+b' if resume else 'wb') as f:
+            commit = None
+            if run:
+                f.truncate(run.zip_offset)
+                f.seek(run.zip_offset)
+                
+                def commit(zip_writer):
+                    fsync_file(f)
+                    run.commit_zip(zip_writer)
+            stage.progress = f.tell
+            stage.bytes_in = self.write_archive(f, files, run, commit)
+            stage.files = len(files)
+            fsync_file(f)
+        commit_rename(partial_path, zip_path)
+        if run:
+            run.set_stage('encrypt')
+        stage.bytes_out = zip_path.stat().st_size
         
         logger.info(f"Created archive: {zip_path} ({zip_path.stat().st_size / 1024 / 1024:.2f} MB)")
         return str(zip_path)
     
-    def encrypt_backup(self, zip_path: str) -> str:
-        """Encrypt the backup archive (Post-Quantum only).
+    def prompt_password(self) -> str:
+        """Prompt for the encryption password.
 
         The encryption password is prompted interactively at runtime and is never read from
         config files or environment variables. If a password exists in the configuration
@@ -358,14 +808,134 @@ class BackupManager:
             if password != confirm:
                 print('Passwords do not match; please try again.')
                 continue
-            break
-
-        encrypted_path = zip_path + '.encrypted'
+            return password
+    
+    def _create_encryptor(self) -> PostQuantumEncryption:
         algorithm = self.config.get('encryption', 'algorithm', default='Kyber1024')
+        segment_size = self.config.get('encryption', 'segment_size', default=DEFAULT_SEGMENT_SIZE)
+        codec = self.config.get('backup', 'codec', default='deflate')
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec '{codec}', expected one of: {', '.join(CODECS)}")
 
         # Enforce post-quantum encryption only; fail fast if PQ unavailable
-        encryptor = PostQuantumEncryption(algorithm)
-        encryptor.encrypt_file(zip_path, encrypted_path, password)
+        encryptor = PostQuantumEncryption(
+            algorithm, segment_size,
+            codec=None if codec == 'deflate' else codec,
+            codec_level=self.config.get('backup', 'codec_level'),
+            codec_threads=self._compression_workers()
+        )
+        if self.config.get('encryption', 'key_hierarchy', default=True):
+            encryptor.master_salt = self.master_salt(encryptor.kdf_type)
+        encryptor.hash_tree = self.config.get('encryption', 'hash_tree', default=True)
+        encryptor.kdf_params = self.kdf_params()
+        encryptor.cipher = self.cipher()
+        return encryptor
+    
+    def cipher(self) -> str:
+        """AEAD for new archives: encryption.cipher, or with auto the fastest on this host"""
+        configured = self.config.get('encryption', 'cipher', default='auto')
+        if configured == 'auto':
+            cipher = fastest_cipher()
+            logger.info(f"Using {CIPHER_NAMES[cipher]}, the fastest AEAD on this host")
+            return cipher
+        if configured not in CIPHERS:
+            raise ValueError(f"Unknown cipher '{configured}', expected auto or one of: {', '.join(CIPHERS)}")
+        return configured
+    
+    def kdf_calibration_path(self) -> Path:
+        configured = self.config.get('encryption', 'kdf_calibration_path')
+        if configured:
+            return Path(configured)
+        return Path(self.config.get('backup', 'output_dir')) / 'kdf-calibration.json'
+    
+    def kdf_params(self) -> Optional[Tuple[int, int, int]]:
+        """Argon2id cost for new archives: kdf_params from the config, else the saved calibration"""
+        configured = self.config.get('encryption', 'kdf_params')
+        if configured:
+            return (int(configured['time_cost']), int(configured['memory_cost']), int(configured['parallelism']))
+        return load_calibration(self.kdf_calibration_path())
+    
+    def calibrate_kdf(self) -> Tuple[int, int, int]:
+        """Benchmark Argon2id on this host and save the parameters new archives will use"""
+        target = float(self.config.get('encryption', 'kdf_target_seconds', default=DEFAULT_TARGET_SECONDS))
+        budget = int(self.config.get('encryption', 'kdf_memory_budget', default=DEFAULT_MEMORY_BUDGET))
+        logger.info(f"Calibrating Argon2id for {target:.2f}s within {budget / 1024 / 1024:.0f} MB...")
+        params, seconds = calibrate(target, budget)
+        time_cost, memory_cost, parallelism = params
+        path = self.kdf_calibration_path()
+        save_calibration(path, params, seconds, target)
+        logger.info(f"Argon2id: time_cost={time_cost}, memory_cost={memory_cost // 1024} MiB, "
+                    f"parallelism={parallelism} unlocks in {seconds:.2f}s; saved to {path}")
+        if self.config.get('encryption', 'kdf_params'):
+            logger.warning("encryption.kdf_params in the config still takes precedence over the calibration")
+        return params
+    
+    def master_key_path(self) -> Path:
+        configured = self.config.get('encryption', 'master_key_path')
+        if configured:
+            return Path(configured)
+        return Path(self.config.get('backup', 'output_dir')) / 'master-key.json'
+    
+    def master_salt(self, kdf_type: bytes) -> bytes:
+        """
+        Long-lived KDF salt shared by this host's archives (not a secret).
+
+        Losing the file only means later archives start a new master salt;
+        every archive still carries the salt it was encrypted with.
+        """
+        path = self.master_key_path()
+        if path.exists():
+            with open(path, 'r') as f:
+                stored = json.load(f)
+            if stored.get('kdf') == kdf_type.decode():
+                return bytes.fromhex(stored['salt'])
+            logger.warning(f"Master salt in {path} is for {stored.get('kdf')}; starting a new one")
+        
+        salt = os.urandom(SALT_SIZE)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': 1, 'kdf': kdf_type.decode(), 'salt': salt.hex()}, f, indent=2)
+        os.replace(tmp_path, path)
+        logger.info(f"Created master salt: {path}")
+        return salt
+    
+    def encrypt_backup(self, zip_path: str, run: Optional[RunCheckpoint] = None) -> str:
+        """
+        Encrypt the backup archive (Post-Quantum only).
+
+        Output is written as <name>.partial and renamed once complete. With
+        run, the position is checkpointed every checkpoint_interval bytes and
+        an interrupted attempt is continued (not with a zstd/lz4 codec, whose
+        stream cannot be resumed).
+        """
+        password = self.prompt_password()
+
+        encrypted_path = zip_path + '.encrypted'
+        partial_path = encrypted_path + PARTIAL_SUFFIX
+        encryptor = self._create_encryptor()
+        resume, on_segment = None, None
+        if run and not encryptor.codec:
+            if run.encryption and os.path.exists(partial_path):
+                resume = run.encryption
+                logger.info(f"Resuming encryption after {resume[0]} segments")
+            interval = self.config.get('backup', 'checkpoint_interval', default=DEFAULT_INTERVAL)
+            committed = [0]
+            
+            def on_segment(writer, dst):
+                if writer.bytes_out - committed[0] >= interval:
+                    fsync_file(dst)
+                    run.commit_encryption(writer.checkpoint())
+                    committed[0] = writer.bytes_out
+        with self.metrics.stage('encrypt') as stage:
+            stage.progress = lambda: os.path.getsize(partial_path)
+            writer = encryptor.encrypt_file(zip_path, partial_path, password, resume, on_segment)
+        commit_rename(Path(partial_path), Path(encrypted_path))
+        if run:
+            run.set_stage('finish')
+        stage.bytes_in = writer.bytes_in
+        stage.bytes_out = writer.bytes_out
+        self.metrics.record('kdf', encryptor.kdf_seconds)
 
         # Remove unencrypted zip
         os.remove(zip_path)
@@ -373,82 +943,490 @@ class BackupManager:
 
         return encrypted_path
     
-    def upload_to_azure(self, file_path: str):
-        """Upload encrypted backup to Azure Blob Storage"""
-        if not self.config.get('storage', 'azure', 'enabled'):
-            return
+    def write_encrypted_archive(self, files: List[Path], sink, password: str,
+                                encryptor: Optional[PostQuantumEncryption] = None) -> EncryptingWriter:
+        """
+        Compress files straight into the encryptor and on to sink.
+
+        sink is any writable binary file object (local file, upload stream).
+        The zip is written as a stream (members use data descriptors), so no
+        plaintext ever touches the disk and every byte is written only once.
+        The writer's source_bytes is set to the uncompressed bytes archived.
+
+        The stream is never resumed: the zip is rebuilt from the live tree, and
+        plaintext that changed since an interrupted attempt must not be sealed
+        again under that attempt's nonces.
+        """
+        encryptor = encryptor or self._create_encryptor()
+        writer = encryptor.open_writer(sink, password)
+        with writer:
+            writer.source_bytes = self.write_archive(writer, files)
         
-        if BlobServiceClient is None:
-            logger.error("azure-storage-blob not installed. Install with: pip install azure-storage-blob")
-            return
+        return writer
+    
+    def _record_fused_stages(self, stage: StageMetrics, files: List[Path], encryptor: PostQuantumEncryption,
+                             writer):
+        """
+        Split a pipeline stage into kdf, compress and encrypt. Compression is
+        what remains of the stage once the KDF and sealing are taken out (for
+        deflate that includes reading the files).
+        """
+        stage.files = len(files)
+        stage.bytes_in = writer.source_bytes
+        stage.bytes_out = writer.bytes_out
+        kdf_seconds = encryptor.kdf_seconds
+        self.metrics.record('kdf', kdf_seconds)
+        compressed = writer.bytes_compressed if encryptor.codec else writer.bytes_in
+        compress_seconds = (writer.compress_seconds if encryptor.codec
+                            else stage.wall_seconds - kdf_seconds - writer.seal_seconds)
+        self.metrics.record('compress', max(compress_seconds, 0.0), writer.source_bytes, compressed, stage.files)
+        self.metrics.record('encrypt', writer.seal_seconds, compressed, writer.bytes_out)
+    
+    def pipeline_backup(self, files: List[Path], run: Optional[RunCheckpoint] = None) -> str:
+        """
+        Single-pass collect -> compress -> encrypt into the output directory.
+
+        The archive is written as <name>.partial and renamed once complete.
+        With run, an interrupted attempt keeps its selection and manifest, but
+        the archive is written again under a fresh header and nonce prefix.
+        """
+        password = self.prompt_password()
+        encryptor = self._create_encryptor()
+
+        output_dir = Path(self.config.get('backup', 'output_dir'))
+        output_dir.mkdir(parents=True, exist_ok=True)
+        encrypted_path = output_dir / f"backup_{self.backup_time}.zip.encrypted"
+        partial_path = output_dir / (encrypted_path.name + PARTIAL_SUFFIX)
         
-        connection_string = self.config.get('storage', 'azure', 'connection_string')
-        container_name = self.config.get('storage', 'azure', 'container_name')
+        if run and partial_path.exists():
+            logger.info("Writing the interrupted archive again from the start under a fresh nonce prefix")
+        with self.metrics.stage('archive') as stage, open(partial_path, 'wb') as sink:
+            stage.progress = sink.tell
+            writer = self.write_encrypted_archive(files, sink, password, encryptor)
+            fsync_file(sink)
+        commit_rename(partial_path, encrypted_path)
+        if run:
+            run.set_stage('finish')
+        self._record_fused_stages(stage, files, encryptor, writer)
         
-        if not connection_string:
-            logger.error("Azure connection string not provided")
-            return
+        logger.info(
+            f"Encrypted backup: {encrypted_path} ({encrypted_path.stat().st_size / 1024 / 1024:.2f} MB, "
+            f"{writer.bytes_in / 1024 / 1024:.2f} MB zip stream, no plaintext written to disk)"
+        )
+        return str(encrypted_path)
+    
+    def streaming_backup(self, files: List[Path]) -> str:
+        """
+        Pipeline backup that uploads while it encrypts.
+
+        The container stream is fanned out to a multipart upload per backend
+        (and to the local file unless keep_local_copy is off), so the upload
+        finishes about when the last segment is sealed. A backend that fails
+        mid-stream is aborted without stopping the others and retried from
+        the local copy through the checkpointed upload path.
+        """
+        self.check_streaming_destination()
+        password = self.prompt_password()
+        encryptor = self._create_encryptor()
+        keep_local = self.config.get('storage', 'upload', 'keep_local_copy', default=True)
+        name = f"backup_{self.backup_time}.zip.encrypted"
+        object_name = f"{self.backup_time}/{name}"
+        
+        streams, failed = [], []
+        for uploader in self.upload_engine().uploaders:
+            try:
+                streams.append(StreamingUpload(uploader, object_name))
+            except Exception as e:
+                logger.error(f"Could not start {uploader.label} upload of {object_name}: {e}")
+                failed.append(uploader)
+        
+        output_dir = Path(self.config.get('backup', 'output_dir'))
+        output_dir.mkdir(parents=True, exist_ok=True)
+        encrypted_path = output_dir / name
+        partial_path = output_dir / (name + PARTIAL_SUFFIX)
+        started = time.perf_counter()
+        with self.metrics.stage('stream') as stage:
+            try:
+                with (open(partial_path, 'wb') if keep_local else contextlib.nullcontext()) as local:
+                    sink = TeeWriter(([local] if keep_local else []) + streams)
+                    stage.progress = lambda: sink.bytes_written
+                    writer = self.write_encrypted_archive(files, sink, password, encryptor)
+                if keep_local:
+                    commit_rename(partial_path, encrypted_path)
+            except BaseException:
+                for stream in streams:
+                    stream.abort()
+                raise
+            failed += [stream.uploader for stream in streams if not stream.finish()]
+        elapsed = time.perf_counter() - started
+        self._record_fused_stages(stage, files, encryptor, writer)
         
-        blob_name = f"{self.backup_time}/{Path(file_path).name}"
+        size_mb = sink.bytes_written / 1024 / 1024
+        logger.info(
+            f"Encrypted and streamed {size_mb:.2f} MB to {len(streams) - len(failed)} backend(s) "
+            f"in {elapsed:.2f}s ({size_mb / elapsed if elapsed else 0:.1f} MB/s end to end)"
+        )
+        if failed:
+            if not keep_local:
+                raise RuntimeError(f"Streaming upload to {', '.join(u.label for u in failed)} failed "
+                                   "and no local copy was kept")
+            logger.warning(f"Retrying {', '.join(u.label for u in failed)} from {encrypted_path}")
+            with self.metrics.stage('upload') as stage:
+                stage.bytes_in = sink.bytes_written
+                stage.ok = self.upload_engine().upload(
+                    [(str(encrypted_path), object_name)],
+                    checkpoint=self.config.get('storage', 'upload', 'checkpoints', default=True),
+                    uploaders=failed
+                )
+        return str(encrypted_path) if keep_local else streams[0].uploader.location(object_name)
+    
+    def check_streaming_destination(self):
+        """Fail before any work when a streaming run would have nowhere to write"""
+        if (not self.config.get('storage', 'upload', 'keep_local_copy', default=True)
+                and not self.upload_engine().uploaders):
+            raise ValueError("Streaming upload with keep_local_copy off needs an enabled storage backend")
+    
+    def upload_engine(self) -> UploadEngine:
+        """Uploaders for every enabled backend, built once so clients and connections are reused"""
+        if self._upload_engine is not None:
+            return self._upload_engine
         
+        part_size = self.config.get('storage', 'upload', 'part_size', default=DEFAULT_PART_SIZE)
+        concurrency = self.config.get('storage', 'upload', 'concurrency', default=DEFAULT_CONCURRENCY)
+        uploaders = []
+        if self.config.get('storage', 'azure', 'enabled'):
+            connection_string = self.config.get('storage', 'azure', 'connection_string')
+            if not connection_string:
+                logger.error("Azure connection string not provided")
+            else:
+                try:
+                    uploaders.append(AzureUploader(connection_string,
+                                                   self.config.get('storage', 'azure', 'container_name'),
+                                                   part_size, concurrency))
+                except ImportError as e:
+                    logger.error(str(e))
+        if self.config.get('storage', 'aws', 'enabled'):
+            bucket_name = self.config.get('storage', 'aws', 'bucket_name')
+            if not bucket_name:
+                logger.error("AWS bucket name not provided")
+            else:
+                try:
+                    uploaders.append(S3Uploader(bucket_name,
+                                                self.config.get('storage', 'aws', 'region'),
+                                                self.config.get('storage', 'aws', 'endpoint_url'),
+                                                part_size, concurrency))
+                except ImportError as e:
+                    logger.error(str(e))
+        
+        self._upload_engine = UploadEngine(uploaders)
+        return self._upload_engine
+    
+    def upload(self, items: List[Tuple[str, str]], checkpoint: bool = False) -> bool:
+        """
+        Upload (file path, object name) pairs to all enabled backends at once.
+
+        Failures are logged; returns True only if every object reached every backend.
+        With checkpoint, progress is saved next to each file for resume_uploads.
+        """
         try:
-            blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-            blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_name)
-            
-            with open(file_path, 'rb') as data:
-                blob_client.upload_blob(data, overwrite=True)
-            
-            logger.info(f"Uploaded to Azure: {container_name}/{blob_name}")
+            return self.upload_engine().upload(items, checkpoint)
         except Exception as e:
-            logger.error(f"Azure upload failed: {e}")
+            logger.error(f"Upload failed: {e}")
+            return False
     
-    def upload_to_s3(self, file_path: str):
-        """Upload encrypted backup to AWS S3"""
-        if not self.config.get('storage', 'aws', 'enabled'):
-            return
+    def resume_uploads(self) -> bool:
+        """Finish checkpointed uploads left in the output directory by earlier runs"""
+        output_dir = self.config.get('backup', 'output_dir')
+        items = UploadCheckpoint.pending_items(output_dir) if os.path.isdir(output_dir) else []
+        if not items:
+            logger.info("No interrupted uploads to resume")
+            return True
+        logger.info(f"Resuming {len(items)} interrupted upload(s)")
+        return self.upload(items, checkpoint=True)
+    
+    def repository_path(self) -> Path:
+        output_dir = Path(self.config.get('backup', 'output_dir'))
+        return Path(self.config.get('backup', 'repository_path', default=None) or output_dir / 'repository')
+    
+    def repository_backup(self, files: List[Path]) -> str:
+        """
+        Store files in the deduplicating repository and record a snapshot.
+
+        Only chunks the repository has not seen before are written (and
+        uploaded); the snapshot itself is a small encrypted index.
+        """
+        root_path = Path(self.config.get('backup', 'root_path'))
+        repo_path = self.repository_path()
+        password = self.prompt_password()
         
-        if boto3 is None:
-            logger.error("boto3 not installed. Install with: pip install boto3")
-            return
+        if (repo_path / 'config').exists():
+            repo = Repository.open(repo_path, password)
+        else:
+            encryptor = self._create_encryptor()
+            kdf_type = b'ARGON2ID' if encryptor.use_argon2 else b'PBKDF2SHA512'
+            compression_level = self.config.get('backup', 'compression_level', default=9)
+            repo = Repository.init(repo_path, password, kdf_type, compression_level,
+                                   encryptor.kdf_params if encryptor.use_argon2 else None)
         
-        bucket_name = self.config.get('storage', 'aws', 'bucket_name')
-        region = self.config.get('storage', 'aws', 'region')
+        stats = repo.backup(files, root_path, f"backup_{self.backup_time}")
+        logger.info(
+            f"Snapshot backup_{self.backup_time}: {stats['files']} files "
+            f"({stats['reused_files']} unchanged since last snapshot), {stats['chunks']} chunks read, "
+            f"{stats['new_chunks']} new ({stats['bytes_new'] / 1024 / 1024:.2f} of "
+            f"{stats['bytes_in'] / 1024 / 1024:.2f} MB stored)"
+        )
         
-        if not bucket_name:
-            logger.error("AWS bucket name not provided")
-            return
+        # Only new objects need to reach cloud storage, plus any a failed run left behind
+        if not self.config.get('storage', 'local_only'):
+            pending = repo.pending_uploads()
+            if pending:
+                logger.info(f"Retrying {len(pending)} repository objects a previous upload did not send")
+            objects = set(pending) | {object_path.relative_to(repo_path).as_posix()
+                                      for object_path in stats['new_objects']}
+            # Recorded first, so a crash during the upload leaves them pending too
+            repo.set_pending_uploads(list(objects))
+            items = {name: (str(repo_path / name), 'repository/' + name)
+                     for name in sorted(objects) if (repo_path / name).exists()}
+            chunks = [item for name, item in items.items() if not name.startswith('snapshots/')]
+            snapshots = [item for name, item in items.items() if name.startswith('snapshots/')]
+            with self.metrics.stage('upload') as stage:
+                stage.bytes_in = sum(os.path.getsize(path) for path, _ in items.values())
+                # Snapshots only go up once every chunk they may reference is there
+                stage.ok = self.upload(chunks) and self.upload(snapshots)
+            if stage.ok:
+                repo.set_pending_uploads([])
+            else:
+                raise RuntimeError(f"Upload of {len(objects)} repository objects failed; "
+                                   f"they are retried on the next run")
         
-        object_key = f"{self.backup_time}/{Path(file_path).name}"
+        return str(stats['new_objects'][-1])
+    
+    def manifest_path(self) -> Path:
+        output_dir = Path(self.config.get('backup', 'output_dir'))
+        return Path(self.config.get('backup', 'manifest_path', default=None) or output_dir / 'manifest.json')
+    
+    def select_incremental(self, files: List[Path]) -> Tuple[List[Path], Optional[FileManifest]]:
+        """
+        Reduce files to those new or changed since the previous run.
+
+        Deleted paths are recorded in the archive as DELETED_PATHS_MEMBER. Returns
+        the files to archive and the manifest to save once the backup succeeds,
+        or no manifest at all when nothing changed.
+        """
+        root_path = Path(self.config.get('backup', 'root_path'))
+        previous = FileManifest.load(self.manifest_path())
+        touched = self.journal.changed_since(previous.backup_time) if self.journal else None
+        changed, deleted, current = previous.diff(files, root_path, touched)
+        logger.info(f"Incremental backup: {len(changed)} new or changed, {len(deleted)} deleted, "
+                    f"{len(current.entries) - len(changed)} unchanged")
         
-        try:
-            s3_client = boto3.client('s3', region_name=region)
-            s3_client.upload_file(file_path, bucket_name, object_key)
-            
-            logger.info(f"Uploaded to S3: s3://{bucket_name}/{object_key}")
-        except Exception as e:
-            logger.error(f"S3 upload failed: {e}")
+        if not changed and not deleted:
+            # Still record refreshed stat data so touched files are not re-hashed next time
+            current.save(self.backup_time)
+            if self.journal:
+                self.journal.commit(self.backup_time)
+            return [], None
+        if deleted:
+            self.metadata_members[DELETED_PATHS_MEMBER] = json.dumps(deleted, indent=1).encode()
+        return changed, current
     
     def run_backup(self):
-        """Execute complete backup process"""
+        """Execute complete backup process; stage metrics are logged and exported even if it fails"""
+        success = False
+        try:
+            result = self._run_backup()
+            success = True
+            return result
+        finally:
+            self.finish_metrics(success)
+    
+    def finish_metrics(self, success: bool):
+        """Log the per-stage table and write the configured JSON and Prometheus files"""
+        self.metrics.finish(success)
+        if self.metrics.stages:
+            logger.info(f"Stage metrics:\n{self.metrics.summary()}")
+        json_path = self.config.get('metrics', 'json_path')
+        prometheus_path = self.config.get('metrics', 'prometheus_path')
+        try:
+            if json_path:
+                self.metrics.write_json(json_path)
+                logger.info(f"Wrote run metrics: {json_path}")
+            if prometheus_path:
+                self.metrics.write_prometheus(prometheus_path)
+                logger.info(f"Wrote Prometheus metrics: {prometheus_path}")
+        except OSError as e:
+            logger.error(f"Could not write run metrics: {e}")
+    
+    def _streaming(self) -> bool:
+        return (self.config.get('backup', 'pipeline', default=False) and not self.config.get('storage', 'local_only')
+                and self.config.get('storage', 'upload', 'streaming', default=False))
+    
+    def _resumable(self) -> bool:
+        """
+        Whether archive runs are checkpointed. A zstd/lz4 stream, solid
+        blocks and streaming uploads hold state that cannot be persisted, so
+        those runs start over after a crash (their output is still atomic).
+        """
+        return (self.config.get('backup', 'resumable', default=True)
+                and self.config.get('backup', 'mode', default='archive') == 'archive'
+                and self.config.get('backup', 'codec', default='deflate') == 'deflate'
+                and not self.config.get('backup', 'solid_blocks', default=False)
+                and not self._streaming())
+    
+    def interrupted_run(self) -> Optional[RunCheckpoint]:
+        """
+        Checkpoint of a run that did not finish, to continue instead of
+        starting a new backup. Its backup time is taken over, so the archive
+        keeps its name. A run that can no longer be resumed as it was
+        (settings changed, or never got past file selection) is discarded.
+        """
+        output_dir = Path(self.config.get('backup', 'output_dir'))
+        run = RunCheckpoint.find(output_dir)
+        if run is None:
+            return None
+        if (output_dir / f"backup_{run.backup_time}.zip.encrypted").exists():
+            # Renamed into place just before the crash
+            run.set_stage('finish')
+        if run.stage == 'select' or (run.stage != 'finish' and (
+                not self._resumable() or run.fingerprint != run_fingerprint(self.config.config))):
+            logger.warning(f"Interrupted backup {run.backup_time} cannot be resumed with the current "
+                           f"settings; discarding it and starting over")
+            run.discard()
+            return None
+        logger.info(f"Resuming interrupted backup {run.backup_time} ({run.stage} stage)")
+        self.backup_time = run.backup_time
+        self.metrics.backup_time = run.backup_time
+        return run
+    
+    def start_run(self, files: List[Path], manifest: Optional[FileManifest]) -> Optional[RunCheckpoint]:
+        """Freeze the selection of a checkpointed run; None if this run is not resumable"""
+        if not self._resumable():
+            return None
+        output_dir = Path(self.config.get('backup', 'output_dir'))
+        run = RunCheckpoint.start(output_dir, self.backup_time, run_fingerprint(self.config.config))
+        if manifest is not None:
+            FileManifest(run.manifest_path, manifest.entries).save(self.backup_time)
+        run.save_selection(files, self.metadata_members)
+        return run
+    
+    def resume_selection(self, run: RunCheckpoint) -> Tuple[List[Path], Optional[FileManifest]]:
+        """Files, metadata members and manifest the interrupted run selected"""
+        files, self.metadata_members = run.load_selection()
+        manifest = None
+        if run.manifest_path.exists():
+            stored = FileManifest.load(run.manifest_path)
+            manifest = FileManifest(self.manifest_path(), stored.entries)
+        logger.info(f"Resumed selection of {len(files)} files")
+        return files, manifest
+    
+    def unarchived_paths(self) -> Set[str]:
+        """Files that failed to archive, plus duplicates whose stored copy was one of them"""
+        failed = set(self.failed_members)
+        if DUPLICATES_MEMBER in self.metadata_members:
+            references = parse_references(self.metadata_members[DUPLICATES_MEMBER])
+            failed.update(path for path, reference in references.items() if reference['source'] in failed)
+        return failed
+    
+    def select_duplicates(self, files: List[Path]) -> List[Path]:
+        """
+        Drop files whose content is already in the list (hardlinks, identical
+        copies); they are recorded in DUPLICATES_MEMBER and recreated on restore.
+        """
+        finder = DuplicateFinder(
+            self.config.get('backup', 'duplicate_min_size', default=DEFAULT_MIN_SIZE),
+            self._compression_workers()
+        )
+        with self.metrics.stage('duplicates') as stage:
+            stage.files = len(files)
+            unique, references = finder.find(list(self._iter_members(files)))
+            stage.bytes_in = finder.bytes_hashed
+        logger.info(f"Duplicate detection: {finder.summary()}")
+        if references:
+            self.metadata_members[DUPLICATES_MEMBER] = finder.serialize(references)
+        return [path for path, _ in unique]
+    
+    def _run_backup(self):
         logger.info("Starting backup process...")
         
-        # Collect files
-        files = self.collect_files()
-        if not files:
-            logger.warning("No files to backup")
-            return
+        if self._streaming():
+            self.check_streaming_destination()
         
-        # Create zip
-        zip_path = self.create_zip(files)
+        run = self.interrupted_run()
+        if run:
+            files, manifest = self.resume_selection(run)
+        else:
+            # Collect files
+            with self.metrics.stage('collect') as stage:
+                files = self.collect_files()
+                stage.files = len(files)
+            repository = self.config.get('backup', 'mode', default='archive') == 'repository'
+            incremental = self.config.get('backup', 'incremental', default=False) and not repository
+            # An incremental run with nothing left to archive may still have deletions to record
+            if not files and not incremental:
+                logger.warning("No files to backup")
+                return
+            
+            if repository:
+                snapshot_path = self.repository_backup(files)
+                logger.info(f"Backup completed: {snapshot_path}")
+                return snapshot_path
+            
+            manifest = None
+            if incremental:
+                with self.metrics.stage('incremental') as stage:
+                    stage.files = len(files)
+                    files, manifest = self.select_incremental(files)
+                if manifest is None:
+                    logger.info("No changes since the last backup; nothing to do")
+                    return
+                if not files:
+                    logger.info("Only deletions since the last backup; archiving the deletion record")
+            
+            if self.config.get('backup', 'duplicate_detection', default=False):
+                files = self.select_duplicates(files)
+            
+            run = self.start_run(files, manifest)
         
-        # Encrypt
-        encrypted_path = self.encrypt_backup(zip_path)
+        pipeline = self.config.get('backup', 'pipeline', default=False)
+        streaming = self._streaming()
+        if run and run.stage == 'finish':
+            # Archive was complete; only the manifest and the upload are left
+            encrypted_path = str(Path(self.config.get('backup', 'output_dir')) /
+                                 f"backup_{self.backup_time}.zip.encrypted")
+        elif streaming:
+            # Encrypted stream goes to the local file and the cloud at once
+            encrypted_path = self.streaming_backup(files)
+        elif pipeline:
+            # Zip stream goes straight into the encryptor
+            encrypted_path = self.pipeline_backup(files, run)
+        else:
+            # Create zip
+            zip_path = self.create_zip(files, run)
+            
+            # Encrypt
+            encrypted_path = self.encrypt_backup(zip_path, run)
         
-        # Upload to cloud storage
-        if not self.config.get('storage', 'local_only'):
-            self.upload_to_azure(encrypted_path)
-            self.upload_to_s3(encrypted_path)
+        # Only advance the manifest once the archive is safely written
+        if manifest is not None:
+            if self.failed_members:
+                manifest.revert(self.unarchived_paths(), FileManifest.load(self.manifest_path()))
+            manifest.save(self.backup_time)
+            if self.journal:
+                self.journal.commit(self.backup_time)
+        
+        # Upload to cloud storage (default object name: <backup_time>/<file name>)
+        if not self.config.get('storage', 'local_only') and not streaming:
+            engine = self.upload_engine()
+            with self.metrics.stage('upload') as stage:
+                stage.bytes_in = os.path.getsize(encrypted_path)
+                stage.progress = lambda: sum(uploader.bytes_sent for uploader in engine.uploaders)
+                stage.ok = self.upload([(encrypted_path, f"{self.backup_time}/{Path(encrypted_path).name}")],
+                                       checkpoint=self.config.get('storage', 'upload', 'checkpoints', default=True))
+                stage.bytes_out = stage.bytes_in * len(engine.uploaders) if stage.ok else 0
         
+        if run:
+            # A failed upload is finished with --resume from its own checkpoint
+            run.finish()
         logger.info(f"Backup completed: {encrypted_path}")
         return encrypted_path
 
@@ -457,6 +1435,20 @@ def main():
     parser = argparse.ArgumentParser(description='Secure Backup Tool with Post-Quantum Encryption')
     parser.add_argument('-c', '--config', help='Path to configuration file (YAML or JSON)')
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose logging')
+    parser.add_argument('--resume', action='store_true',
+                        help='Only finish interrupted uploads (sends the missing parts), no new backup')
+    parser.add_argument('--watch', action='store_true',
+                        help='Run the change watcher (inotify) that lets later backups skip the full scan')
+    parser.add_argument('--metrics-json', metavar='PATH', help='Write per-stage run metrics as JSON')
+    parser.add_argument('--prometheus', metavar='PATH',
+                        help='Write run metrics as a Prometheus textfile (node_exporter textfile collector)')
+    parser.add_argument('--progress', action='store_true', help='Show live progress of each stage on stderr')
+    parser.add_argument('--calibrate-kdf', action='store_true',
+                        help='Benchmark Argon2id on this host and save the cost new archives use, then exit')
+    parser.add_argument('--kdf-target', type=float, metavar='SECONDS',
+                        help='Unlock time to calibrate for (default: encryption.kdf_target_seconds, 1.0)')
+    parser.add_argument('--kdf-memory', type=int, metavar='MB',
+                        help='Memory budget to calibrate within (default: encryption.kdf_memory_budget, 256 MB)')
     
     args = parser.parse_args()
     
@@ -465,7 +1457,29 @@ def main():
     
     try:
         config = BackupConfig(args.config)
+        metrics_config = config.config.setdefault('metrics', {})
+        if args.metrics_json:
+            metrics_config['json_path'] = args.metrics_json
+        if args.prometheus:
+            metrics_config['prometheus_path'] = args.prometheus
+        if args.progress:
+            metrics_config['progress'] = True
+        encryption_config = config.config.setdefault('encryption', {})
+        if args.kdf_target:
+            encryption_config['kdf_target_seconds'] = args.kdf_target
+        if args.kdf_memory:
+            encryption_config['kdf_memory_budget'] = args.kdf_memory * 1024 * 1024
         backup_manager = BackupManager(config)
+        if args.calibrate_kdf:
+            backup_manager.calibrate_kdf()
+            return
+        if args.watch:
+            backup_manager.change_watcher().run()
+            return
+        if args.resume:
+            if not backup_manager.resume_uploads():
+                sys.exit(1)
+            return
         backup_manager.run_backup()
     except Exception as e:
         logger.error(f"Backup failed: {e}")
@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+"""
+Performance benchmarks for backup_tool.py
+
+Each benchmark builds its own synthetic data in a temporary directory, so
+results are comparable between hosts and runs:
+
+    python benchmark.py compression --size-mb 512 --workers 1 2 4 8 16 32
+    python benchmark.py walk --entries 1000000
+    python benchmark.py solid --files 200000
+    python benchmark.py ciphers --size-mb 256
+    python benchmark.py chunking --size-mb 64
+    python benchmark.py suite --save baseline.json
+    python benchmark.py suite --baseline baseline.json --threshold 0.15
+
+The suite runs the backup and restore stages one at a time and end to end on
+four synthetic trees, records MB/s, files/s and peak RSS per stage, and exits
+non-zero when a stage regresses past the threshold against a saved baseline.
+It also reports the sealing throughput of each AEAD cipher suite, the
+comparison `encryption.cipher: auto` makes at startup, and times the
+content-defined chunker and a first backup into a deduplicating repository
+(`mode: repository`).
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import platform
+import zipfile
+import argparse
+import tempfile
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from parallel_zip import ParallelZipCompressor
+from metrics import PeakRss
+from repository import ContentDefinedChunker, Repository
+from solid_blocks import SolidPacker
+from backup_format import CIPHER_NAMES, ContainerHeader, cipher_throughput, fastest_cipher
+from backup_tool import BackupConfig, BackupManager, ExcludeMatcher, walk_files
+from decrypt_backup import BackupDecryptor, extract_zip
+
+WORDS = [b'backup', b'archive', b'segment', b'encrypt', b'restore', b'config', b'python',
+         b'quantum', b'deflate', b'worker', b'the', b'of', b'and', b'a', b'to', b'in']
+
+
+class CountingSink:
+    """Write-only sink that discards data but counts it"""
+
+    def __init__(self):
+        self.bytes_written = 0
+
+    def write(self, data) -> int:
+        self.bytes_written += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def make_text(size: int, rng: random.Random) -> bytes:
+    """Compressible, text-like data"""
+    out = bytearray()
+    while len(out) < size:
+        line = b' '.join(rng.choice(WORDS) for _ in range(12))
+        out += line + b' %d\n' % rng.randrange(1_000_000)
+    return bytes(out[:size])
+
+
+def generate_mixed_tree(root: Path, total_bytes: int, seed: int = 1) -> List[Path]:
+    """Half compressible text, half random bytes, as files of 256 KiB to 64 MiB"""
+    rng = random.Random(seed)
+    files = []
+    written = 0
+    while written < total_bytes:
+        size = min(rng.choice([256 * 1024, 4 * 1024 * 1024, 64 * 1024 * 1024]), total_bytes - written)
+        path = root / f"file_{len(files):05d}.{'txt' if len(files) % 2 == 0 else 'bin'}"
+        with open(path, 'wb') as f:
+            if len(files) % 2 == 0:
+                f.write(make_text(size, rng))
+            else:
+                f.write(rng.randbytes(size))
+        files.append(path)
+        written += size
+    return files
+
+
+def bench_compression(args):
+    """Deflate throughput of ParallelZipCompressor as the worker count grows"""
+    with tempfile.TemporaryDirectory(prefix='backup-bench-') as tmp:
+        root = Path(tmp)
+        files = generate_mixed_tree(root, args.size_mb * 1024 * 1024)
+        members = [(p, p.name) for p in files]
+        total_mb = sum(p.stat().st_size for p in files) / 1024 / 1024
+        print(f"Compressing {len(files)} files, {total_mb:.0f} MB, level {args.level}, "
+              f"{os.cpu_count()} CPUs")
+
+        # Reference: the single-threaded zipfile path used with compression_workers: 1
+        sink = CountingSink()
+        started = time.perf_counter()
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED, compresslevel=args.level) as zipf:
+            for path, arcname in members:
+                zipf.write(path, arcname)
+        baseline = time.perf_counter() - started
+        print(f"{'zipfile':>8} {baseline:8.2f}s {total_mb / baseline:9.1f} MB/s {'1.00x':>7} "
+              f"ratio {sink.bytes_written / 1024 / 1024 / total_mb:.3f}")
+
+        for workers in args.workers:
+            sink = CountingSink()
+            compressor = ParallelZipCompressor(workers, args.level)
+            started = time.perf_counter()
+            compressor.write_archive(sink, members)
+            elapsed = time.perf_counter() - started
+            print(f"{workers:>8} {elapsed:8.2f}s {total_mb / elapsed:9.1f} MB/s "
+                  f"{baseline / elapsed:6.2f}x ratio {sink.bytes_written / 1024 / 1024 / total_mb:.3f}")
+
+
+def generate_project_tree(root: Path, entries: int) -> int:
+    """
+    Source trees with vendored dependencies: per project a few source files and
+    a node_modules directory holding about 90% of all entries. Returns the
+    number of files and directories created.
+    """
+    created = 0
+    project = 0
+    while created < entries:
+        src = root / f"project_{project:04d}" / 'src'
+        src.mkdir(parents=True)
+        created += 2
+        for i in range(100):
+            (src / f"module_{i}.py").touch()
+        created += 100
+        package = 0
+        while created < entries and package < 100:
+            pkg = root / f"project_{project:04d}" / 'node_modules' / f"pkg_{package}" / 'lib'
+            pkg.mkdir(parents=True)
+            created += 3 if package == 0 else 2
+            for i in range(45):
+                (pkg / f"file_{i}.js").touch()
+            created += 45
+            package += 1
+        project += 1
+    return created
+
+
+def bench_walk(args):
+    """collect_files: rglob + per-pattern Path.match versus the pruning walker"""
+    patterns = args.exclude
+    with tempfile.TemporaryDirectory(prefix='backup-bench-') as tmp:
+        root = Path(tmp)
+        started = time.perf_counter()
+        created = generate_project_tree(root, args.entries)
+        print(f"Generated {created} entries in {time.perf_counter() - started:.1f}s; "
+              f"excludes: {' '.join(patterns)}")
+
+        # Previous implementation: walk everything, test every file against every pattern
+        started = time.perf_counter()
+        found = [p for p in root.rglob('*') if p.is_file() and not any(p.match(pat) for pat in patterns)]
+        elapsed = time.perf_counter() - started
+        print(f"{'rglob + Path.match':>20} {elapsed:8.2f}s {created / elapsed:12.0f} entries/s {len(found):>9} files")
+
+        started = time.perf_counter()
+        found = list(walk_files(root, ExcludeMatcher(patterns)))
+        pruned = time.perf_counter() - started
+        print(f"{'scandir + pruning':>20} {pruned:8.2f}s {created / pruned:12.0f} entries/s {len(found):>9} files "
+              f"({elapsed / pruned:.1f}x)")
+
+
+def generate_small_files(root: Path, count: int, seed: int = 1) -> List[Path]:
+    """
+    Dotfile and source-sized text files of 100 bytes to 8 KiB. Lines draw on
+    a few thousand identifiers, so there is cross-file redundancy without the
+    pathological match chains of make_text's tiny vocabulary.
+    """
+    rng = random.Random(seed)
+    vocabulary = [bytes(rng.choice(b'abcdefghijklmnopqrstuvwxyz_') for _ in range(rng.randrange(2, 12)))
+                  for _ in range(3000)]
+    files = []
+    for i in range(count):
+        directory = root / f"dir_{i // 500:04d}"
+        if i % 500 == 0:
+            directory.mkdir()
+        path = directory / f"file_{i}.{rng.choice(['py', 'txt', 'conf', 'md'])}"
+        with open(path, 'wb') as f:
+            size = rng.randrange(100, 8192)
+            data = bytearray()
+            while len(data) < size:
+                data += b' '.join(rng.choice(vocabulary) for _ in range(rng.randrange(3, 12))) + b'\n'
+            f.write(data[:size])
+        files.append(path)
+    return files
+
+
+def bench_solid(args):
+    """One zip member per small file versus solid blocks"""
+    with tempfile.TemporaryDirectory(prefix='backup-bench-') as tmp:
+        root = Path(tmp)
+        files = generate_small_files(root, args.files)
+        members = [(p, p.relative_to(root).as_posix()) for p in files]
+        total_mb = sum(p.stat().st_size for p in files) / 1024 / 1024
+        print(f"Archiving {len(files)} small files, {total_mb:.1f} MB, level {args.level}, {args.workers} workers")
+
+        results = {}
+        for label, source in (('per-file', lambda: members), ('solid', lambda: SolidPacker().pack(members))):
+            sink = CountingSink()
+            started = time.perf_counter()
+            ParallelZipCompressor(args.workers, args.level).write_archive(sink, source())
+            elapsed = time.perf_counter() - started
+            results[label] = elapsed
+            print(f"{label:>8} {elapsed:8.2f}s {len(files) / elapsed:10.0f} files/s "
+                  f"ratio {sink.bytes_written / 1024 / 1024 / total_mb:.3f}")
+        print(f"solid blocks: {results['per-file'] / results['solid']:.1f}x files/s")
+
+
+def print_ciphers(size_mb: int) -> Dict[str, float]:
+    results = cipher_throughput(size_mb * 1024 * 1024)
+    for cipher, mb_per_s in results.items():
+        print(f"{CIPHER_NAMES[cipher]:>18} {mb_per_s:9.1f} MB/s")
+    print(f"encryption.cipher: auto picks {CIPHER_NAMES[fastest_cipher()]}")
+    return results
+
+
+def bench_ciphers(args):
+    """Sealing throughput of each AEAD cipher suite in 1 MiB segments"""
+    print(f"Sealing {args.size_mb} MB in 1 MiB segments, best of 3")
+    print_ciphers(args.size_mb)
+
+
+def bench_chunking(args):
+    """Content-defined chunking throughput, vectorized gear scan versus the per-byte loop"""
+    data = random.Random(1).randbytes(args.size_mb * 1024 * 1024)
+    chunker = ContentDefinedChunker(os.urandom(256 * 8))
+    print(f"Chunking {args.size_mb} MB of random data")
+    results = {}
+    for label, gear_table in (('numpy', chunker._gear_table), ('per-byte', None)):
+        if label == 'numpy' and gear_table is None:
+            print(f"{label:>9} not installed")
+            continue
+        chunker._gear_table = gear_table
+        started = time.perf_counter()
+        count = sum(1 for _ in chunker.chunks(io.BytesIO(data)))
+        results[label] = time.perf_counter() - started
+        print(f"{label:>9} {results[label]:8.2f}s {args.size_mb / results[label]:9.1f} MB/s {count:>7} chunks")
+    if len(results) == 2:
+        print(f"numpy: {results['per-byte'] / results['numpy']:.1f}x")
+
+
+def measure(run: Callable[[], None], data_bytes: int, files: int, repeat: int = 1) -> Dict[str, float]:
+    """Best of repeat runs: seconds, MB/s, files/s and peak RSS in MB"""
+    best = None
+    peak = 0
+    for _ in range(repeat):
+        with PeakRss() as rss:
+            started = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+        peak = max(peak, rss.peak)
+    return {
+        'seconds': round(best, 4),
+        'mb_per_s': round(data_bytes / 1024 / 1024 / best, 2),
+        'files_per_s': round(files / best, 1),
+        'peak_rss_mb': round(peak / 1024 / 1024, 1),
+    }
+
+
+def text_pool(size: int, seed: int = 1) -> bytes:
+    """
+    Text to cut files from: lines over a few hundred identifiers, very
+    compressible without make_text's pathological deflate match chains
+    """
+    rng = random.Random(seed)
+    vocabulary = [bytes(rng.choice(b'abcdefghijklmnopqrstuvwxyz_') for _ in range(rng.randrange(2, 12)))
+                  for _ in range(300)]
+    out = bytearray()
+    while len(out) < size:
+        out += b' '.join(rng.choice(vocabulary) for _ in range(rng.randrange(3, 12))) + b'\n'
+    return bytes(out[:size])
+
+
+def write_from_pool(path: Path, size: int, pool: bytes, rng: random.Random):
+    with open(path, 'wb') as f:
+        while size > 0:
+            start = rng.randrange(len(pool) // 2)
+            piece = pool[start:start + min(size, len(pool) - start)]
+            f.write(piece)
+            size -= len(piece)
+
+
+def generate_suite_tree(root: Path, kind: str, size_mb: int, tiny_files: int, seed: int = 1) -> List[Path]:
+    """
+    tiny: many small text files; huge: two large files (one text, one random);
+    random: incompressible 8 MiB files; text: highly compressible 8 MiB files
+    """
+    root.mkdir(parents=True)
+    if kind == 'tiny':
+        return generate_small_files(root, tiny_files, seed)
+    rng = random.Random(seed)
+    pool = text_pool(4 * 1024 * 1024, seed)
+    total = size_mb * 1024 * 1024
+    if kind == 'huge':
+        sizes = [total // 2, total - total // 2]
+    else:
+        sizes = [8 * 1024 * 1024] * (total // (8 * 1024 * 1024)) or [total]
+    files = []
+    for i, size in enumerate(sizes):
+        path = root / f"file_{i:05d}.{'bin' if kind == 'random' or (kind == 'huge' and i) else 'txt'}"
+        if kind == 'random' or (kind == 'huge' and i):
+            with open(path, 'wb') as f:
+                for offset in range(0, size, 8 * 1024 * 1024):
+                    f.write(rng.randbytes(min(8 * 1024 * 1024, size - offset)))
+        else:
+            write_from_pool(path, size, pool, rng)
+        files.append(path)
+    return files
+
+
+SUITE_DATASETS = ('tiny', 'huge', 'random', 'text')
+SUITE_PASSWORD = 'benchmark-password'
+SUITE_CIPHER_MB = 64
+
+
+def bench_dataset(root: Path, kind: str, args) -> Dict[str, Dict[str, float]]:
+    """Time every stage on one tree; each stage consumes the previous one's output"""
+    out = root / f"{kind}-out"
+    config = BackupConfig(None)
+    config.config['backup'].update(root_path=str(root), include_paths=[kind], output_dir=str(out),
+                                   compression_workers=args.workers)
+    manager = BackupManager(config)
+    encryptor = manager._create_encryptor()
+    decryptor = BackupDecryptor(SUITE_PASSWORD)
+
+    files = manager.collect_files()
+    data_bytes = sum(p.stat().st_size for p in files)
+    results = {}
+    state = {}
+
+    results['collect'] = measure(lambda: state.update(files=manager.collect_files()), data_bytes, len(files),
+                                 args.repeat)
+    results['zip'] = measure(lambda: state.update(zip=manager.create_zip(state['files'])), data_bytes,
+                             len(files), args.repeat)
+    zip_bytes = os.path.getsize(state['zip'])
+    encrypted = state['zip'] + '.encrypted'
+    # Key derivation is timed on its own so the stages below show data throughput
+    results['kdf'] = measure(lambda: encryptor.open_writer(CountingSink(), SUITE_PASSWORD), 0, 0)
+    results['encrypt'] = measure(lambda: encryptor.encrypt_file(state['zip'], encrypted, SUITE_PASSWORD),
+                                 zip_bytes, len(files), args.repeat)
+    with open(encrypted, 'rb') as f:
+        # Warm the decryptor's key cache too
+        decryptor.keys.archive_key(ContainerHeader.read(f))
+    decrypted = str(out / 'decrypted' / 'backup.zip')
+    os.makedirs(os.path.dirname(decrypted))
+    results['decrypt'] = measure(lambda: decryptor.decrypt_file(encrypted, decrypted), zip_bytes, len(files),
+                                 args.repeat)
+    results['extract'] = measure(lambda: extract_zip(decrypted), data_bytes, len(files), args.repeat)
+
+    def chunk():
+        chunker = ContentDefinedChunker(os.urandom(256 * 8))
+        for path in files:
+            with open(path, 'rb') as f:
+                for _ in chunker.chunks(f):
+                    pass
+
+    def repository_backup():
+        repo_path = out / 'repository'
+        shutil.rmtree(repo_path, ignore_errors=True)
+        # Cheapest Argon2id cost, so the stage shows chunking, compression and sealing
+        repo = Repository.init(repo_path, SUITE_PASSWORD, b'ARGON2ID', kdf_params=(1, 8, 1))
+        repo.backup(files, root, 'benchmark')
+
+    results['chunk'] = measure(chunk, data_bytes, len(files), args.repeat)
+    results['repository'] = measure(repository_backup, data_bytes, len(files), args.repeat)
+
+    def backup():
+        with open(out / 'pipeline.zip.encrypted', 'wb') as sink:
+            manager.write_encrypted_archive(manager.collect_files(), sink, SUITE_PASSWORD)
+
+    def restore():
+        shutil.rmtree(out / 'restored', ignore_errors=True)
+        decryptor.restore_direct(str(out / 'pipeline.zip.encrypted'), str(out / 'restored'))
+
+    results['backup_end_to_end'] = measure(backup, data_bytes, len(files), args.repeat)
+    results['restore_end_to_end'] = measure(restore, data_bytes, len(files), args.repeat)
+    shutil.rmtree(out)
+    return results
+
+
+def compare(results: Dict, baseline: Dict, threshold: float, rss_threshold: float) -> List[str]:
+    """Stages whose throughput dropped or peak RSS grew past the thresholds"""
+    regressions = []
+    for dataset, stages in results.items():
+        for stage, current in stages.items():
+            previous = baseline.get(dataset, {}).get(stage)
+            if not previous:
+                continue
+            # Collection reads metadata only, so it is judged by files/s; key derivation by time
+            if stage == 'kdf':
+                if current['seconds'] > previous['seconds'] * (1 + threshold):
+                    regressions.append(f"{dataset}/{stage}: {current['seconds']:.2f}s "
+                                       f"(baseline {previous['seconds']:.2f}s)")
+                continue
+            metric, unit = ('files_per_s', 'files/s') if stage == 'collect' else ('mb_per_s', 'MB/s')
+            if previous[metric] and current[metric] < previous[metric] * (1 - threshold):
+                regressions.append(f"{dataset}/{stage}: {current[metric]:.1f} {unit} "
+                                   f"(baseline {previous[metric]:.1f})")
+            if previous['peak_rss_mb'] and current['peak_rss_mb'] > previous['peak_rss_mb'] * (1 + rss_threshold):
+                regressions.append(f"{dataset}/{stage}: peak RSS {current['peak_rss_mb']:.0f} MB "
+                                   f"(baseline {previous['peak_rss_mb']:.0f})")
+    return regressions
+
+
+def bench_suite(args):
+    """Per-stage and end-to-end backup/restore throughput on synthetic trees, with a JSON baseline"""
+    # Stage logging would drown the table
+    logging.getLogger().setLevel(logging.WARNING)
+    for name in ('backup_tool', 'decrypt_backup'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    print("AEAD throughput:")
+    ciphers = print_ciphers(SUITE_CIPHER_MB)
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='backup-bench-') as tmp:
+        for kind in args.datasets:
+            files = generate_suite_tree(Path(tmp) / kind, kind, args.size_mb, args.files)
+            total_mb = sum(p.stat().st_size for p in files) / 1024 / 1024
+            print(f"{kind}: {len(files)} files, {total_mb:.1f} MB")
+            results[kind] = bench_dataset(Path(tmp), kind, args)
+            for stage, r in results[kind].items():
+                print(f"  {stage:>20} {r['seconds']:8.2f}s {r['mb_per_s']:9.1f} MB/s "
+                      f"{r['files_per_s']:10.0f} files/s {r['peak_rss_mb']:7.0f} MB RSS")
+            shutil.rmtree(Path(tmp) / kind)
+
+    report = {
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'parameters': {'size_mb': args.size_mb, 'files': args.files, 'workers': args.workers,
+                       'repeat': args.repeat},
+        'ciphers': {'mb_per_s': ciphers, 'selected': fastest_cipher()},
+        'results': results,
+    }
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved results to {args.save}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('parameters') != report['parameters']:
+            print("Warning: baseline was recorded with different parameters")
+        regressions = compare(results, baseline['results'], args.threshold, args.rss_threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No stage regressed more than {args.threshold:.0%} against {args.baseline}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for backup_tool.py')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    compression = subparsers.add_parser('compression', help='Parallel compression scaling with worker count')
+    compression.add_argument('--size-mb', type=int, default=256, help='Synthetic data size (default: 256)')
+    compression.add_argument('--level', type=int, default=9, help='Deflate level (default: 9)')
+    compression.add_argument('--workers', type=int, nargs='+',
+                             default=sorted({w for w in (1, 2, 4, 8, 16, 32) if w <= (os.cpu_count() or 1)}
+                                            | {os.cpu_count() or 1}),
+                             help='Worker counts to measure')
+    compression.set_defaults(func=bench_compression)
+
+    walk = subparsers.add_parser('walk', help='File collection with exclude patterns')
+    walk.add_argument('--entries', type=int, default=1_000_000, help='Synthetic tree size (default: 1000000)')
+    walk.add_argument('--exclude', nargs='+', default=['*.tmp', '*.cache', '**/node_modules/**',
+                                                       '**/__pycache__/**', '*.log'],
+                      help='Exclude patterns (default: those in config.yaml)')
+    walk.set_defaults(func=bench_walk)
+
+    solid = subparsers.add_parser('solid', help='Small-file archiving with and without solid blocks')
+    solid.add_argument('--files', type=int, default=100_000, help='Number of small files (default: 100000)')
+    solid.add_argument('--level', type=int, default=9, help='Deflate level (default: 9)')
+    solid.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Compression workers')
+    solid.set_defaults(func=bench_solid)
+
+    ciphers = subparsers.add_parser('ciphers', help='AES-256-GCM versus ChaCha20-Poly1305 throughput')
+    ciphers.add_argument('--size-mb', type=int, default=256, help='Data sealed per cipher (default: 256)')
+    ciphers.set_defaults(func=bench_ciphers)
+
+    chunking = subparsers.add_parser('chunking', help='Content-defined chunking with and without numpy')
+    chunking.add_argument('--size-mb', type=int, default=64, help='Random data chunked (default: 64)')
+    chunking.set_defaults(func=bench_chunking)
+
+    suite = subparsers.add_parser('suite', help='Backup and restore stages on synthetic trees, with a baseline')
+    suite.add_argument('--datasets', nargs='+', choices=SUITE_DATASETS, default=list(SUITE_DATASETS),
+                       help='Trees to run (default: all)')
+    suite.add_argument('--size-mb', type=int, default=256,
+                       help='Size of the huge, random and text trees (default: 256)')
+    suite.add_argument('--files', type=int, default=20_000, help='Files in the tiny tree (default: 20000)')
+    suite.add_argument('--workers', type=int, default=0, help='Compression workers (default: one per CPU core)')
+    suite.add_argument('--repeat', type=int, default=1, help='Runs per stage, best time is kept (default: 1)')
+    suite.add_argument('--save', help='Write results as JSON (e.g. a new baseline)')
+    suite.add_argument('--baseline', help='Compare against a saved JSON baseline and exit 1 on regressions')
+    suite.add_argument('--threshold', type=float, default=0.15,
+                       help='Allowed MB/s drop per stage as a fraction (default: 0.15)')
+    suite.add_argument('--rss-threshold', type=float, default=0.25,
+                       help='Allowed peak RSS growth per stage as a fraction (default: 0.25)')
+    suite.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
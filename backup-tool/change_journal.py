@@ -0,0 +1,501 @@
+"""
+Filesystem change journal for backup_tool.py
+
+A full collection stats every file under include_paths, which on trees of
+millions of files takes longer than the backup itself when little changed.
+A long-running watcher (backup_tool.py --watch) puts inotify watches on every
+directory and appends each changed path to a journal:
+
+    change-journal/
+        state.json              # watcher session, heartbeat, overflow count
+        journal-000001.log      # changed paths, one per line, append-only
+        snapshot.json           # journal position of the last collection
+        files.txt               # file list of the last collection
+
+A backup run then starts from the previous file list and re-examines only
+the journaled paths. It falls back to a full scan whenever the journal may
+have missed something: the watcher is not running or was restarted, the
+kernel event queue overflowed, a watch could not be added, or the include
+and exclude settings changed.
+
+inotify only reports changes made through the local kernel. On NFS the
+watcher has to run on the host that writes the files; changes made by other
+clients are not seen.
+"""
+
+import bisect
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import select
+import struct
+import sys
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_VERSION = 1
+STATE_FILE = 'state.json'
+SNAPSHOT_FILE = 'snapshot.json'
+FILE_LIST = 'files.txt'
+
+SEGMENT_SIZE = 64 * 1024 * 1024  # the watcher starts a new journal segment after this
+HEARTBEAT_INTERVAL = 5.0
+STALE_AFTER = 30.0  # a watcher silent for this long is treated as down
+FLUSH_INTERVAL = 1.0
+
+# inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_EXCL_UNLINK)
+EVENT = struct.Struct('iIII')
+
+
+def settings_fingerprint(root_path: str, include_paths: List[str], exclude_patterns: List[str]) -> str:
+    """Identifies the watched tree; a journal kept for other settings is not used"""
+    settings = json.dumps([str(root_path), list(include_paths), list(exclude_patterns)])
+    return hashlib.sha256(settings.encode()).hexdigest()
+
+
+def segment_name(number: int) -> str:
+    return f"journal-{number:06d}.log"
+
+
+def _write_json(path: Path, data: Dict):
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: Path) -> Optional[Dict]:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class _Inotify:
+    """Minimal inotify binding through libc"""
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError("The change journal watcher needs Linux inotify")
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1 failed: {os.strerror(err)}")
+
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read_events(self) -> Iterable[Tuple[int, int, str]]:
+        """(wd, mask, name) of every queued event"""
+        data = os.read(self.fd, 1024 * 1024)
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, pos)
+            pos += EVENT.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            yield wd, mask, name
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ChangeWatcher:
+    """Journal every change under roots until stopped"""
+
+    def __init__(self, journal_dir: Path, roots: List[Path], matcher, fingerprint: str):
+        self.journal_dir = journal_dir
+        self.roots = roots
+        self.matcher = matcher
+        self.fingerprint = fingerprint
+        self.session = uuid.uuid4().hex
+        self.state: Dict = {}
+        self._paths: Dict[int, str] = {}
+        self._segment = 1
+        self._journal_fd: Optional[int] = None
+        self._inotify: Optional[_Inotify] = None
+
+    def _save_state(self):
+        self.state['heartbeat'] = time.time()
+        self.state['segment'] = self._segment
+        _write_json(self.journal_dir / STATE_FILE, self.state)
+
+    def _open_segment(self):
+        if self._journal_fd is not None:
+            os.close(self._journal_fd)
+        self._journal_fd = os.open(self.journal_dir / segment_name(self._segment),
+                                   os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+
+    def _watch_tree(self, top: str, pending: Set[str]):
+        """Watch top and every directory below it that is not pruned"""
+        stack = [top]
+        while stack:
+            directory = stack.pop()
+            try:
+                wd = self._inotify.add_watch(directory, WATCH_MASK)
+            except OSError as e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                    # Gone or unreadable; a full scan would skip it as well
+                    continue
+                self.state['complete'] = False
+                self._save_state()
+                logger.error(f"Cannot watch {directory}: {e}"
+                             + (" (raise fs.inotify.max_user_watches)" if e.errno == errno.ENOSPC else ""))
+                continue
+            self._paths[wd] = directory
+            if directory != top:
+                pending.add(directory)
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False) and not self.matcher.prunes_dir(entry.path):
+                            stack.append(entry.path)
+            except OSError:
+                continue
+
+    def _start(self):
+        self.journal_dir.mkdir(parents=True, exist_ok=True)
+        for old in self.journal_dir.glob('journal-*.log'):
+            old.unlink()
+        self._open_segment()
+        self.state = {
+            'version': JOURNAL_VERSION,
+            'session': self.session,
+            'pid': os.getpid(),
+            'fingerprint': self.fingerprint,
+            'ready': False,
+            'complete': True,
+            'overflows': 0,
+        }
+        self._save_state()
+        self._inotify = _Inotify()
+        pending: Set[str] = set()
+        for root in self.roots:
+            if root.is_dir():
+                self._watch_tree(str(root), pending)
+            elif root.exists():
+                self._watch_path(str(root))
+            else:
+                logger.warning(f"Path not found, not watched: {root}")
+        self.state['ready'] = True
+        self._save_state()
+        logger.info(f"Watching {len(self._paths)} directories, journal in {self.journal_dir} "
+                    f"(session {self.session[:8]})")
+
+    def _watch_path(self, path: str):
+        try:
+            self._paths[self._inotify.add_watch(path, WATCH_MASK)] = path
+        except OSError as e:
+            self.state['complete'] = False
+            logger.error(f"Cannot watch {path}: {e}")
+
+    def _handle(self, wd: int, mask: int, name: str, pending: Set[str]):
+        if mask & IN_Q_OVERFLOW:
+            # Events were dropped; the next backup has to scan everything
+            self.state['overflows'] += 1
+            logger.warning("inotify event queue overflowed; next backup will do a full scan")
+            self._save_state()
+            return
+        base = self._paths.get(wd)
+        if base is None:
+            return
+        if mask & IN_IGNORED:
+            del self._paths[wd]
+            return
+        path = os.path.join(base, name) if name else base
+        if mask & IN_ISDIR:
+            if not mask & (IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM) or self.matcher.prunes_dir(path):
+                return
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                # Files may have landed before the watch was added; the
+                # collector walks the directory itself
+                self._watch_tree(path, pending)
+        elif self.matcher.excludes_file(path):
+            return
+        pending.add(path)
+
+    def _flush(self, pending: Set[str]):
+        if not pending:
+            return
+        data = ''.join(f"{path}\n" for path in sorted(pending)).encode('utf-8', 'surrogateescape')
+        # Readers take a shared lock, so they never see half a batch
+        fcntl.flock(self._journal_fd, fcntl.LOCK_EX)
+        try:
+            os.write(self._journal_fd, data)
+            os.fsync(self._journal_fd)
+        finally:
+            fcntl.flock(self._journal_fd, fcntl.LOCK_UN)
+        pending.clear()
+        if os.fstat(self._journal_fd).st_size > SEGMENT_SIZE:
+            self._segment += 1
+            self._open_segment()
+            self._save_state()
+
+    def run(self, stop=None):
+        """Watch until interrupted (or stop, a threading.Event, is set)"""
+        self._start()
+        pending: Set[str] = set()
+        last_flush = last_heartbeat = time.monotonic()
+        try:
+            while stop is None or not stop.is_set():
+                ready, _, _ = select.select([self._inotify.fd], [], [], FLUSH_INTERVAL)
+                if ready:
+                    for wd, mask, name in self._inotify.read_events():
+                        self._handle(wd, mask, name, pending)
+                now = time.monotonic()
+                if now - last_flush >= FLUSH_INTERVAL:
+                    self._flush(pending)
+                    last_flush = now
+                if now - last_heartbeat >= HEARTBEAT_INTERVAL:
+                    self._save_state()
+                    last_heartbeat = now
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._flush(pending)
+            self.state['ready'] = False
+            self.state['pid'] = None
+            self._save_state()
+            self._inotify.close()
+            os.close(self._journal_fd)
+            logger.info("Change watcher stopped")
+
+
+class ChangeJournal:
+    """Collection side of the journal: replay changes onto the previous file list"""
+
+    def __init__(self, journal_dir: Path, roots: List[Path], matcher, fingerprint: str,
+                 walk: Callable[[Path, object], Iterable[Path]]):
+        self.journal_dir = journal_dir
+        self.roots = roots
+        self.matcher = matcher
+        self.fingerprint = fingerprint
+        # Same directory walk as a full scan, for directories that appeared
+        self.walk = walk
+        self.position: Optional[Dict] = None
+        # Files changed since the last committed run; None when unknown
+        self.changed: Optional[Set[str]] = None
+        self._committed: Optional[str] = None
+
+    def _usable_state(self) -> Tuple[Optional[Dict], str]:
+        state = _read_json(self.journal_dir / STATE_FILE)
+        if not state or state.get('version') != JOURNAL_VERSION:
+            return None, "no change watcher has run"
+        if not state.get('ready') or not state.get('pid') or not _pid_alive(state['pid']):
+            return None, "change watcher is not running"
+        if time.time() - state.get('heartbeat', 0) > STALE_AFTER:
+            return None, "change watcher stopped responding"
+        if not state.get('complete'):
+            return None, "change watcher could not watch every directory"
+        if state.get('fingerprint') != self.fingerprint:
+            return None, "change watcher runs with other include/exclude settings"
+        return state, ''
+
+    def capture(self) -> str:
+        """
+        Record the current end of the journal before collecting. Returns why
+        the journal cannot be used after this run, or '' if it can.
+        """
+        self.position = None
+        state, reason = self._usable_state()
+        if state is None:
+            return reason
+        segments = sorted(self.journal_dir.glob('journal-*.log'))
+        if not segments:
+            return "change journal is missing"
+        segment = int(segments[-1].stem.split('-')[1])
+        with open(segments[-1], 'rb') as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            offset = os.fstat(f.fileno()).st_size
+            fcntl.flock(f, fcntl.LOCK_UN)
+        self.position = {'session': state['session'], 'overflows': state['overflows'],
+                         'segment': segment, 'offset': offset}
+        return ''
+
+    def _read_changes(self, start: Dict, end: Dict) -> Optional[Set[str]]:
+        changes: Set[str] = set()
+        for number in range(start['segment'], end['segment'] + 1):
+            path = self.journal_dir / segment_name(number)
+            begin = start['offset'] if number == start['segment'] else 0
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(begin)
+                    data = f.read(end['offset'] - begin) if number == end['segment'] else f.read()
+            except OSError:
+                return None
+            changes.update(os.fsdecode(line) for line in data.split(b'\n') if line)
+        return changes
+
+    def replay(self) -> Optional[List[Path]]:
+        """
+        The current file list, built from the previous one and the journal,
+        or None (with the reason logged) if a full scan is needed.
+        """
+        if self.position is None:
+            return None
+        snapshot = _read_json(self.journal_dir / SNAPSHOT_FILE)
+        if not snapshot or snapshot.get('fingerprint') != self.fingerprint:
+            logger.info("Change journal has no usable previous file list; scanning everything")
+            return None
+        start = snapshot.get('position')
+        if (not start or start['session'] != self.position['session']
+                or start['overflows'] != self.position['overflows']):
+            logger.info("Change journal has a gap since the last run (watcher restarted or overflowed); "
+                        "scanning everything")
+            return None
+        if [str(root) for root in self.roots if root.exists()] != snapshot.get('roots'):
+            logger.info("Include paths appeared or disappeared; scanning everything")
+            return None
+        changes = self._read_changes(start, self.position)
+        if changes is None:
+            logger.info("Change journal segments are missing; scanning everything")
+            return None
+
+        with open(self.journal_dir / FILE_LIST, 'r', encoding='utf-8', errors='surrogateescape') as f:
+            files = dict.fromkeys(line.rstrip('\n') for line in f)
+        changed = set(snapshot['changed']) if snapshot.get('changed') is not None else None
+        touched = self._apply(files, changes)
+        if changed is not None:
+            changed |= touched
+        self.changed = changed
+        self._committed = snapshot.get('committed')
+        logger.info(f"Change journal: {len(changes)} changed paths since the last run, {len(files)} files")
+        return [Path(path) for path in files]
+
+    def _excluded(self, path: str, is_dir: bool) -> bool:
+        """Whether a full scan would skip path: outside the roots, excluded, or below a pruned directory"""
+        for root in map(str, self.roots):
+            if path == root:
+                return False
+            if path.startswith(root + os.sep):
+                if not is_dir and self.matcher.excludes_file(path):
+                    return True
+                parent = path if is_dir else os.path.dirname(path)
+                while len(parent) > len(root):
+                    if self.matcher.prunes_dir(parent):
+                        return True
+                    parent = os.path.dirname(parent)
+                return False
+        return True
+
+    def _apply(self, files: Dict[str, None], changes: Set[str]) -> Set[str]:
+        """Update files in place from the changed paths; returns the files added, changed or removed"""
+        touched: Set[str] = set()
+        # Sorted copy of the keys, built on the first removal that is not a known file:
+        # everything below a directory is then one bisected range instead of a scan
+        ordered: Optional[List[str]] = None
+
+        def add(name: str):
+            if name not in files:
+                files[name] = None
+                if ordered is not None:
+                    bisect.insort(ordered, name)
+            touched.add(name)
+
+        for path in sorted(changes):
+            if os.path.isdir(path) and not os.path.islink(path):
+                if not self._excluded(path, is_dir=True):
+                    # A directory created or moved in: whatever is inside is new
+                    for file_path in self.walk(Path(path), self.matcher):
+                        add(str(file_path))
+            elif os.path.isfile(path) and not self._excluded(path, is_dir=False):
+                add(path)
+            else:
+                if ordered is None:
+                    ordered = sorted(files)
+                if path in files:
+                    start = bisect.bisect_left(ordered, path)
+                    end = start + 1
+                else:
+                    prefix = path + os.sep
+                    start = end = bisect.bisect_left(ordered, prefix)
+                    while end < len(ordered) and ordered[end].startswith(prefix):
+                        end += 1
+                removed = ordered[start:end]
+                del ordered[start:end]
+                for name in removed:
+                    del files[name]
+                touched.update(removed)
+        return touched
+
+    def changed_since(self, backup_time: Optional[str]) -> Optional[Set[str]]:
+        """Files changed since the run that saved backup_time's manifest, if the journal knows"""
+        if backup_time is None or self._committed != backup_time:
+            return None
+        return self.changed
+
+    def save(self, files: List[Path]):
+        """Store the collected list at the captured journal position"""
+        self.journal_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.journal_dir / (FILE_LIST + '.tmp')
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8', errors='surrogateescape') as f:
+            for file_path in files:
+                f.write(f"{file_path}\n")
+        os.replace(tmp_path, self.journal_dir / FILE_LIST)
+        self._save_snapshot()
+        if self.position:
+            # Earlier segments are fully consumed
+            for old in self.journal_dir.glob('journal-*.log'):
+                if int(old.stem.split('-')[1]) < self.position['segment']:
+                    old.unlink()
+
+    def _save_snapshot(self):
+        _write_json(self.journal_dir / SNAPSHOT_FILE, {
+            'version': JOURNAL_VERSION,
+            'fingerprint': self.fingerprint,
+            'position': self.position,
+            'roots': [str(root) for root in self.roots if root.exists()],
+            'changed': None if self.changed is None else sorted(self.changed),
+            'committed': self._committed,
+        })
+
+    def commit(self, backup_time: str):
+        """
+        The manifest for backup_time is saved: later incremental runs only
+        need to examine files changed from this run's journal position on.
+        """
+        self.changed = set()
+        self._committed = backup_time
+        self._save_snapshot()
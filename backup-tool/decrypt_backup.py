@@ -6,9 +6,14 @@ Supports both Post-Quantum (Kyber) and AES-256-GCM encrypted files
 
 import os
 import sys
+import time
 import argparse
 import logging
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
 
 try:
     import oqs
@@ -21,6 +26,15 @@ from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.backends import default_backend
 from cryptography.exceptions import InvalidTag
 
+from backup_format import (
+    ARGON2_DEFAULT_PARAMS, ARGON2_MEMORY_COST, CIPHER_NAMES, MAGIC, ContainerHeader, KeyCache, SegmentReader,
+    VERSIONED_MARKER, iter_decompressed, iter_decrypted_segments
+)
+from repository import Repository
+from duplicates import DUPLICATES_MEMBER, load_references, restore_duplicates
+from solid_blocks import extract_solid, is_solid_member, load_index, read_file
+from stream_extract import StreamExtractor
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s'
@@ -28,11 +42,52 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+DEFAULT_BUFFER_SIZE = 1024 * 1024  # 1 MiB blocks for single-pass (legacy) formats
+# Memory a batch worker needs besides the Argon2id KDF: segment and I/O buffers
+WORKER_BUFFERS = 32 * 1024 * 1024
+
+
+class DecryptionStats:
+    """Block and throughput counters for one decryption run"""
+
+    def __init__(self):
+        self.blocks = 0
+        self.bytes_out = 0
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def add_block(self, size: int):
+        self.blocks += 1
+        self.bytes_out += size
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.bytes_out / 1024 / 1024 / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (f"{self.blocks} blocks, {self.bytes_out / 1024 / 1024:.2f} MB "
+                f"in {self.elapsed:.2f}s ({self.mb_per_second:.2f} MB/s)")
+
+
 class BackupDecryptor:
-    """Decrypt backups created with backup_tool.py"""
+    """
+    Decrypt backups created with backup_tool.py
+
+    Every format is decrypted as a stream: ciphertext is read, authenticated and
+    written out in fixed-size blocks, so memory use stays flat whatever the
+    archive size. Plaintext goes to a ".partial" file that is only renamed to
+    the output path once the whole archive has authenticated.
+    """
     
-    def __init__(self, password: str):
+    def __init__(self, password: str, buffer_size: int = DEFAULT_BUFFER_SIZE):
         self.password = password
+        self.buffer_size = buffer_size
+        self.stats = None
+        # Memory-hard KDF results, reused across archives sharing a salt
+        self.keys = KeyCache(password)
     
     def detect_encryption_type(self, file_path: str) -> str:
         """Detect encryption type from file header"""
@@ -46,13 +101,48 @@ class BackupDecryptor:
         else:
             return 'unknown'
     
+    def _write_blocks(self, blocks: Iterator[bytes], output_path: str):
+        """Write decrypted blocks to output_path, atomically and only if all authenticate"""
+        self.stats = DecryptionStats()
+        partial_path = output_path + '.partial'
+        try:
+            with open(partial_path, 'wb') as out:
+                for block in blocks:
+                    out.write(block)
+                    self.stats.add_block(len(block))
+            os.replace(partial_path, output_path)
+        except BaseException:
+            # Never leave unauthenticated plaintext behind
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        self.stats.finish()
+        logger.info(f"Processed {self.stats}")
+    
+    def _iter_gcm_blocks(self, f: BinaryIO, key: bytes, iv: bytes, tag: bytes) -> Iterator[bytes]:
+        """Single-pass AES-256-GCM payload: decrypt buffer_size blocks, verify the tag at the end"""
+        cipher = Cipher(
+            algorithms.AES(key),
+            modes.GCM(iv, tag),
+            backend=default_backend()
+        )
+        decryptor = cipher.decryptor()
+        
+        while True:
+            chunk = f.read(self.buffer_size)
+            if not chunk:
+                break
+            yield decryptor.update(chunk)
+        
+        try:
+            final = decryptor.finalize()
+        except InvalidTag:
+            raise ValueError("Decryption failed: authentication tag mismatch (wrong password or corrupted file)")
+        if final:
+            yield final
+    
     def decrypt_aes_file(self, input_path: str, output_path: str):
         """Decrypt AES-256-GCM encrypted file"""
-        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-        from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-        from cryptography.hazmat.primitives import hashes
-        from cryptography.hazmat.backends import default_backend
-        
         with open(input_path, 'rb') as f:
             # Read header
             header = f.read(9)
@@ -63,46 +153,37 @@ class BackupDecryptor:
             salt = f.read(16)
             iv = f.read(16)
             tag = f.read(16)
-            ciphertext = f.read()
-        
-        # Derive key
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=100000,
-            backend=default_backend()
-        )
-        key = kdf.derive(self.password.encode())
-        
-        # Decrypt
-        cipher = Cipher(
-            algorithms.AES(key),
-            modes.GCM(iv, tag),
-            backend=default_backend()
-        )
-        decryptor = cipher.decryptor()
-        
-        plaintext = decryptor.update(ciphertext) + decryptor.finalize()
-        
-        # Write decrypted file
-        with open(output_path, 'wb') as f:
-            f.write(plaintext)
+            
+            # Derive key
+            kdf = PBKDF2HMAC(
+                algorithm=hashes.SHA256(),
+                length=32,
+                salt=salt,
+                iterations=100000,
+                backend=default_backend()
+            )
+            key = kdf.derive(self.password.encode())
+            
+            self._write_blocks(self._iter_gcm_blocks(f, key, iv, tag), output_path)
         
         logger.info(f"Decrypted with AES-256-GCM: {output_path}")
     
     def decrypt_pq_file(self, input_path: str, output_path: str):
         """Decrypt post-quantum encrypted file.
 
-        Supports two PQ formats kept in the repo:
-        - "PQBACKUP" (password-based KDF + AES-GCM)
+        Supports the PQ formats kept in the repo:
+        - "PQBACKUP" version 2 (password-based KDF + segmented AES-GCM or ChaCha20-Poly1305 stream)
+        - "PQBACKUP" version 1 (password-based KDF + single-pass AES-GCM)
         - KEM-based hybrid (algorithm name, KEM ciphertext, wrapped private key, AES-GCM payload)
         """
         # Open file and peek header to decide format
         with open(input_path, 'rb') as f:
-            header = f.read(8)
+            header = f.read(9)
 
-        if header == b'PQBACKUP':
+        if header[:8] == b'PQBACKUP' and header[8] == VERSIONED_MARKER:
+            self.decrypt_pq_stream(input_path, output_path)
+
+        elif header[:8] == b'PQBACKUP':
             # Existing password-based PQBACKUP format
 
             with open(input_path, 'rb') as f:
@@ -115,53 +196,12 @@ class BackupDecryptor:
                 salt = f.read(32)
                 iv = f.read(16)
                 tag = f.read(16)
-                ciphertext = f.read()
-
-            # Derive key based on KDF type
-            if kdf_type == b'ARGON2ID':
-                try:
-                    import argon2
-                    from argon2.low_level import hash_secret_raw, Type
-
-                    key = hash_secret_raw(
-                        secret=self.password.encode(),
-                        salt=salt,
-                        time_cost=3,
-                        memory_cost=65536,
-                        parallelism=4,
-                        hash_len=32,
-                        type=Type.ID
-                    )
-                    logger.info("Using Argon2id KDF")
-                except ImportError:
-                    raise ImportError("argon2-cffi required to decrypt this file. Install: pip install argon2-cffi")
-
-            elif kdf_type == b'PBKDF2SHA512':
-                kdf = PBKDF2HMAC(
-                    algorithm=hashes.SHA512(),
-                    length=32,
-                    salt=salt,
-                    iterations=500000,
-                    backend=default_backend()
-                )
-                key = kdf.derive(self.password.encode())
-                logger.info("Using PBKDF2-HMAC-SHA512 KDF")
-            else:
-                raise ValueError(f"Unknown KDF type: {kdf_type}")
 
-            # Decrypt
-            cipher = Cipher(
-                algorithms.AES(key),
-                modes.GCM(iv, tag),
-                backend=default_backend()
-            )
-            decryptor = cipher.decryptor()
+                # Derive key based on KDF type
+                key = self.keys.master_key(kdf_type, salt)
+                logger.info(f"Using {kdf_type.decode()} KDF")
 
-            plaintext = decryptor.update(ciphertext) + decryptor.finalize()
-
-            # Write decrypted file
-            with open(output_path, 'wb') as f:
-                f.write(plaintext)
+                self._write_blocks(self._iter_gcm_blocks(f, key, iv, tag), output_path)
 
             logger.info(f"Decrypted with AES-256-GCM + {kdf_type.decode()}: {output_path}")
 
@@ -188,60 +228,155 @@ class BackupDecryptor:
                 salt = f.read(16)
                 iv = f.read(16)
                 tag = f.read(16)
-                ciphertext = f.read()
 
-            # Unwrap private key using password
-            try:
-                wrap_kdf = PBKDF2HMAC(
+                # Unwrap private key using password
+                try:
+                    wrap_kdf = PBKDF2HMAC(
+                        algorithm=hashes.SHA256(),
+                        length=32,
+                        salt=wrap_salt,
+                        iterations=100000,
+                        backend=default_backend()
+                    )
+                    wrap_key = wrap_kdf.derive(self.password.encode())
+
+                    wrap_cipher = Cipher(
+                        algorithms.AES(wrap_key),
+                        modes.GCM(wrap_iv, wrap_tag),
+                        backend=default_backend()
+                    )
+                    wrap_decryptor = wrap_cipher.decryptor()
+                    private_key = wrap_decryptor.update(wrapped_private_key) + wrap_decryptor.finalize()
+                except InvalidTag:
+                    raise ValueError("Incorrect password or corrupted wrapped private key")
+
+                # Initialize KEM with private key and decapsulate
+                kem = oqs.KeyEncapsulation(algo_name, secret_key=private_key)
+                shared_secret = kem.decap_secret(kem_ciphertext)
+
+                # Derive file encryption key
+                kdf = PBKDF2HMAC(
                     algorithm=hashes.SHA256(),
                     length=32,
-                    salt=wrap_salt,
+                    salt=salt,
                     iterations=100000,
                     backend=default_backend()
                 )
-                wrap_key = wrap_kdf.derive(self.password.encode())
+                key = kdf.derive(shared_secret + self.password.encode())
 
-                wrap_cipher = Cipher(
-                    algorithms.AES(wrap_key),
-                    modes.GCM(wrap_iv, wrap_tag),
-                    backend=default_backend()
-                )
-                wrap_decryptor = wrap_cipher.decryptor()
-                private_key = wrap_decryptor.update(wrapped_private_key) + wrap_decryptor.finalize()
-            except InvalidTag:
-                raise ValueError("Incorrect password or corrupted wrapped private key")
+                # Decrypt file
+                self._write_blocks(self._iter_gcm_blocks(f, key, iv, tag), output_path)
 
-            # Initialize KEM with private key and decapsulate
-            kem = oqs.KeyEncapsulation(algo_name, secret_key=private_key)
-            shared_secret = kem.decap_secret(kem_ciphertext)
+            logger.info(f"Decrypted with post-quantum hybrid scheme: {output_path}")
+    
+    def _open_pq_stream(self, f: BinaryIO) -> Tuple[ContainerHeader, Iterator[bytes]]:
+        """Read a version 2 header and return it with the plaintext blocks that follow"""
+        header = ContainerHeader.read(f)
+        key = self.keys.archive_key(header)
+        cost = ''
+        if header.kdf_params:
+            time_cost, memory_cost, parallelism = header.kdf_params
+            cost = f", t={time_cost} m={memory_cost // 1024} MiB p={parallelism}"
+        logger.info(f"Using {header.kdf_type.decode()} KDF{cost}"
+                    f"{' (master key + archive subkey)' if header.subkey_salt else ''}")
+
+        blocks = iter_decrypted_segments(f, key, header)
+        if header.codec:
+            logger.info(f"Decompressing {header.codec} stream")
+            blocks = iter_decompressed(blocks, header.codec)
+        return header, blocks
+    
+    def decrypt_pq_stream(self, input_path: str, output_path: str):
+        """
+        Decrypt a segmented (version 2) PQBACKUP file one segment at a time.
 
-            # Derive file encryption key
-            kdf = PBKDF2HMAC(
-                algorithm=hashes.SHA256(),
-                length=32,
-                salt=salt,
-                iterations=100000,
-                backend=default_backend()
-            )
-            key = kdf.derive(shared_secret + self.password.encode())
+        Blocks are the segments written at encryption time, each authenticated
+        on its own, so the configured buffer size does not apply here. Archives
+        written with a zstd or lz4 codec are decompressed on the fly.
+        """
+        with open(input_path, 'rb') as f:
+            header, blocks = self._open_pq_stream(f)
+            self._write_blocks(blocks, output_path)
 
-            # Decrypt file
-            cipher = Cipher(
-                algorithms.AES(key),
-                modes.GCM(iv, tag),
-                backend=default_backend()
-            )
-            decryptor = cipher.decryptor()
-            try:
-                plaintext = decryptor.update(ciphertext) + decryptor.finalize()
-            except InvalidTag:
-                raise ValueError("Decryption failed: authentication tag mismatch (wrong password or corrupted file)")
+        logger.info(f"Decrypted with {CIPHER_NAMES[header.cipher]} + {header.kdf_type.decode()} "
+                    f"(format v{header.version}): {output_path}")
+    
+    def extract_paths(self, input_path: str, paths: List[str], dest_dir: str) -> int:
+        """
+        Restore selected files or directories from an archive into dest_dir.
+
+        Segmented archives without a stream codec are read in place: the zip
+        central directory at the end of the archive is the member index, and
+        only the segments holding it and the requested files are decrypted, so
+        the cost follows the size of what is restored rather than the archive.
+        Other formats are decrypted to a temporary zip first.
+        """
+        import zipfile
 
-            # Write decrypted file
-            with open(output_path, 'wb') as f:
-                f.write(plaintext)
+        started = time.perf_counter()
+        with open(input_path, 'rb') as f:
+            preamble = f.read(len(MAGIC) + 1)
+            header = None
+            if preamble[:len(MAGIC)] == MAGIC and preamble[len(MAGIC):] == bytes([VERSIONED_MARKER]):
+                f.seek(0)
+                header = ContainerHeader.read(f)
+            if header is not None and not header.codec:
+                reader = SegmentReader(f, self.keys.archive_key(header), header)
+                with zipfile.ZipFile(reader) as zf:
+                    restored = extract_selected(zf, paths, dest_dir)
+                logger.info(f"Restored {restored} file(s) to {dest_dir} in {time.perf_counter() - started:.2f}s, "
+                            f"decrypting {reader.segments_decrypted} of {reader.segment_count} segments")
+                return restored
+        
+        logger.warning("Archive has no seekable layout (legacy format or stream codec); decrypting it in full")
+        os.makedirs(dest_dir, exist_ok=True)
+        temp_path = os.path.join(dest_dir, f".{os.path.basename(input_path)}.restore")
+        try:
+            self.decrypt_file(input_path, temp_path)
+            with zipfile.ZipFile(temp_path) as zf:
+                restored = extract_selected(zf, paths, dest_dir)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        logger.info(f"Restored {restored} file(s) to {dest_dir} in {time.perf_counter() - started:.2f}s")
+        return restored
+    
+    def restore_direct(self, input_path: str, dest_dir: str, workers: int = 0) -> int:
+        """
+        Extract a segmented archive into dest_dir straight from the decrypted
+        stream, without writing the zip first. Each segment is authenticated
+        before its plaintext is used, so nothing unverified reaches the disk.
 
-            logger.info(f"Decrypted with post-quantum hybrid scheme: {output_path}")
+        Single-pass formats only authenticate at the very end, so they still
+        go through a decrypted zip.
+        """
+        with open(input_path, 'rb') as f:
+            preamble = f.read(len(MAGIC) + 1)
+        if preamble[:len(MAGIC)] != MAGIC or preamble[len(MAGIC):] != bytes([VERSIONED_MARKER]):
+            logger.warning("Single-pass archive format; decrypting to a zip before extracting")
+            os.makedirs(dest_dir, exist_ok=True)
+            output_file = self.decrypt_file(input_path, os.path.join(dest_dir, f".{os.path.basename(input_path)}.zip"))
+            try:
+                extract_zip(output_file)
+            finally:
+                os.remove(output_file)
+            return 0
+        
+        self.stats = DecryptionStats()
+        extractor = StreamExtractor(dest_dir, workers)
+        with open(input_path, 'rb') as f:
+            header, blocks = self._open_pq_stream(f)
+            restored = extractor.extract(self._counted(blocks))
+        self.stats.finish()
+        logger.info(f"Processed {self.stats}")
+        logger.info(f"Restored {restored} files ({extractor.bytes_written / 1024 / 1024:.2f} MB) to {dest_dir} "
+                    f"in {self.stats.elapsed:.2f}s, no intermediate zip")
+        return restored
+    
+    def _counted(self, blocks: Iterator[bytes]) -> Iterator[bytes]:
+        for block in blocks:
+            self.stats.add_block(len(block))
+            yield block
     
     def decrypt_file(self, input_path: str, output_path: str = None):
         """Decrypt a backup file (auto-detect encryption type)"""
@@ -268,16 +403,277 @@ class BackupDecryptor:
         return output_path
 
 
+def restore_snapshot(repository_path: str, snapshot: Optional[str], dest_dir: str, password: str):
+    """Restore one snapshot (default: the latest) from a deduplicating repository"""
+    repo = Repository.open(Path(repository_path), password)
+    snapshots = repo.list_snapshots()
+    if not snapshots:
+        raise ValueError(f"Repository has no snapshots: {repository_path}")
+    name = snapshot or snapshots[-1]
+    if name not in snapshots:
+        raise ValueError(f"Unknown snapshot {name}; available: {', '.join(snapshots)}")
+    
+    restored = repo.restore(name, Path(dest_dir))
+    logger.info(f"Restored {restored} files from snapshot {name} to: {dest_dir}")
+
+
+def check_member_paths(dest_dir: str, members: List[str]):
+    """Zip-slip protection: ensure every member extracts inside dest_dir"""
+    abs_dest = os.path.abspath(dest_dir)
+    for member in members:
+        member_path = os.path.abspath(os.path.join(abs_dest, member))
+        if not (member_path == abs_dest or member_path.startswith(abs_dest + os.sep)):
+            logger.error(f"Zip contains unsafe path, aborting extraction: {member}")
+            raise Exception("Unsafe zip entry detected")
+
+
+def extract_selected(zf, paths: List[str], dest_dir: str) -> int:
+    """
+    Extract the members matching paths (a file, or a directory and everything
+    below it), including files packed in solid blocks and duplicates stored as
+    references. Returns the file count.
+    """
+    prefixes = [path.strip('/') for path in paths]
+
+    def wanted(name: str) -> bool:
+        name = name.rstrip('/')
+        return any(name == prefix or name.startswith(prefix + '/') for prefix in prefixes)
+
+    index = load_index(zf)
+    members = [name for name in zf.namelist()
+               if not is_solid_member(name) and name != DUPLICATES_MEMBER and wanted(name)]
+    solid = [name for name in index if wanted(name)]
+    duplicates = {path: entry for path, entry in load_references(zf).items() if wanted(path)}
+    if not members and not solid and not duplicates:
+        raise ValueError(f"Not found in archive: {', '.join(paths)}")
+
+    check_member_paths(dest_dir, members)
+    zf.extractall(dest_dir, members)
+    restored = len([name for name in members if not name.endswith('/')]) + extract_solid(zf, dest_dir, solid)
+    # Sources outside the selection are read from the archive
+    return restored + restore_duplicates(duplicates, dest_dir, lambda name: read_file(zf, index, name),
+                                         set(members) | set(solid))
+
+
+def extract_zip(output_file: str):
+    """Extract a decrypted zip next to it, refusing entries that escape the directory"""
+    import zipfile
+
+    dest_dir = os.path.dirname(output_file) or '.'
+
+    with zipfile.ZipFile(output_file, 'r') as zf:
+        check_member_paths(dest_dir, zf.namelist())
+        zf.extractall(dest_dir, [m for m in zf.namelist() if not is_solid_member(m) and m != DUPLICATES_MEMBER])
+        # Small files packed into solid blocks are unpacked through the index
+        solid_files = extract_solid(zf, dest_dir)
+        if solid_files:
+            logger.info(f"Unpacked {solid_files} files from solid blocks")
+        duplicates = restore_duplicates(load_references(zf), dest_dir)
+        if duplicates:
+            logger.info(f"Recreated {duplicates} duplicate files from stored copies")
+
+    logger.info(f"Automatically extracted zip to: {dest_dir}")
+
+
+def find_archives(inputs: List[str]) -> List[str]:
+    """Expand directories to the encrypted archives in them; backup names sort oldest first"""
+    archives = []
+    for item in inputs:
+        if os.path.isdir(item):
+            archives += sorted(str(path) for path in Path(item).glob('*.encrypted'))
+        else:
+            archives.append(item)
+    return archives
+
+
+def available_memory() -> Optional[int]:
+    """Memory the kernel can give without swapping, if it can be found out"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def batch_jobs(archives: int, kdf_memory_cost: int = ARGON2_MEMORY_COST) -> int:
+    """
+    Parallel decryptions: one per core, and no more than memory allows at
+    the KDF's memory cost (KiB) plus WORKER_BUFFERS each
+    """
+    jobs = os.cpu_count() or 1
+    memory = available_memory()
+    if memory is not None:
+        jobs = min(jobs, memory // (kdf_memory_cost * 1024 + WORKER_BUFFERS))
+    return max(1, min(jobs, archives))
+
+
+_batch_decryptor: Optional[BackupDecryptor] = None
+
+
+def _init_batch_worker(password: str, buffer_size: int, keys: KeyCache):
+    global _batch_decryptor
+    _batch_decryptor = BackupDecryptor(password, buffer_size)
+    # Master keys the parent already derived for salts shared across the batch
+    _batch_decryptor.keys = keys
+
+
+def _batch_decrypt(input_path: str) -> Dict:
+    """Decrypt one archive in a pool process; errors are returned, not raised"""
+    decryptor = _batch_decryptor
+    kdf_runs = decryptor.keys.kdf_runs
+    started = time.perf_counter()
+    result = {'archive': input_path, 'output': None, 'error': None, 'bytes_out': 0}
+    try:
+        result['output'] = decryptor.decrypt_file(input_path)
+        result['bytes_out'] = decryptor.stats.bytes_out
+    except Exception as e:
+        result['error'] = str(e)
+    result['seconds'] = time.perf_counter() - started
+    result['bytes_in'] = os.path.getsize(input_path) if os.path.exists(input_path) else 0
+    result['kdf_runs'] = decryptor.keys.kdf_runs - kdf_runs
+    return result
+
+
+def _read_headers(archives: List[str]) -> List[ContainerHeader]:
+    headers = []
+    for input_path in archives:
+        try:
+            with open(input_path, 'rb') as f:
+                headers.append(ContainerHeader.read(f))
+        except (OSError, ValueError):
+            # Legacy formats and unreadable files are left to the workers
+            continue
+    return headers
+
+
+def _derive_shared_keys(headers: List[ContainerHeader], keys: KeyCache):
+    """Run the KDF once up front for every master salt used by more than one archive"""
+    salts = Counter((header.kdf_type, header.salt, header.kdf_params) for header in headers)
+    for (kdf_type, salt, params), count in salts.items():
+        if count > 1:
+            keys.master_key(kdf_type, salt, params)
+
+
+def decrypt_batch(archives: List[str], password: str, jobs: int = 0,
+                  buffer_size: int = DEFAULT_BUFFER_SIZE) -> bool:
+    """
+    Decrypt archives on a pool of jobs processes (0: sized by batch_jobs for
+    the costliest KDF among them) and extract each decrypted zip.
+
+    Decryption (KDF, authentication, writing the zip) runs in parallel;
+    extraction stays in this process and follows the input order, so an
+    incremental chain still lands oldest first while later archives decrypt.
+    A worker that dies (killed, out of memory) fails the archive it was
+    running and the rest go on in a fresh pool.
+    Returns True if every archive decrypted.
+    """
+    started = time.perf_counter()
+    headers = _read_headers(archives)
+    keys = KeyCache(password)
+    _derive_shared_keys(headers, keys)
+    if not jobs:
+        jobs = batch_jobs(len(archives), max([(header.kdf_params or ARGON2_DEFAULT_PARAMS)[1]
+                                              for header in headers], default=ARGON2_MEMORY_COST))
+    logger.info(f"Decrypting {len(archives)} archives on {jobs} processes")
+    
+    results = []
+    remaining = list(archives)
+    finished: Dict[str, Dict] = {}
+    # After a worker dies, the next archive runs alone so a crash is pinned on the archive causing it
+    alone = False
+    while remaining:
+        batch = remaining[:1] if alone else remaining[:]
+        with ProcessPoolExecutor(max_workers=1 if alone else jobs, initializer=_init_batch_worker,
+                                 initargs=(password, buffer_size, keys)) as pool:
+            futures = {input_path: pool.submit(_batch_decrypt, input_path)
+                       for input_path in batch if input_path not in finished}
+            for input_path in batch:
+                try:
+                    result = finished.pop(input_path) if input_path in finished else futures[input_path].result()
+                except BrokenProcessPool as e:
+                    if not alone:
+                        logger.warning(f"A decryption worker died; retrying {input_path} on its own")
+                        finished.update((path, future.result()) for path, future in futures.items()
+                                        if future.done() and not future.exception())
+                        alone = True
+                        break
+                    result = {'archive': input_path, 'output': None, 'error': f"worker process died: {e}",
+                              'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0, 'kdf_runs': 0}
+                alone = False
+                remaining.pop(0)
+                results.append(result)
+                if result['error']:
+                    logger.error(f"Decryption of {result['archive']} failed: {result['error']}")
+                    continue
+                try:
+                    if result['output'].endswith('.zip'):
+                        extract_zip(result['output'])
+                except Exception as e:
+                    logger.error(f"Automatic extraction of {result['output']} failed: {e}")
+    
+    elapsed = time.perf_counter() - started
+    logger.info(f"Batch summary:\n{batch_summary(results, elapsed, keys.kdf_runs)}")
+    return not any(result['error'] for result in results)
+
+
+def batch_summary(results: List[Dict], elapsed: float, kdf_runs: int = 0) -> str:
+    """Per-archive and aggregate throughput table"""
+    lines = [f"{'archive':<40} {'MB in':>10} {'MB out':>10} {'seconds':>9} {'MB/s':>9}  status"]
+    for result in results:
+        rate = result['bytes_in'] / 1024 / 1024 / result['seconds'] if result['seconds'] else 0.0
+        lines.append(f"{os.path.basename(result['archive'])[:40]:<40} {result['bytes_in'] / 1024 / 1024:10.2f} "
+                     f"{result['bytes_out'] / 1024 / 1024:10.2f} {result['seconds']:9.2f} {rate:9.1f}  "
+                     f"{'failed' if result['error'] else 'ok'}")
+    bytes_in = sum(result['bytes_in'] for result in results)
+    bytes_out = sum(result['bytes_out'] for result in results)
+    failed = sum(1 for result in results if result['error'])
+    kdf_runs += sum(result['kdf_runs'] for result in results)
+    lines.append(f"{'total':<40} {bytes_in / 1024 / 1024:10.2f} {bytes_out / 1024 / 1024:10.2f} {elapsed:9.2f} "
+                 f"{bytes_in / 1024 / 1024 / elapsed if elapsed else 0.0:9.1f}  "
+                 f"{len(results) - failed} ok, {failed} failed, {kdf_runs} KDF run(s)")
+    return '\n'.join(lines)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Decrypt backups created with backup_tool.py'
     )
-    parser.add_argument('input_file', help='Encrypted backup file to decrypt')
-    parser.add_argument('-o', '--output', help='Output file path (default: remove .encrypted extension)')
+    parser.add_argument('input_file', nargs='*',
+                        help='Encrypted backup file(s) or directories of them to decrypt, oldest first '
+                             '(with --repository: snapshot name, default latest)')
+    parser.add_argument('-o', '--output',
+                        help='Output file path (default: remove .encrypted extension); '
+                             'with --repository: directory to restore into (default: current directory)')
+    parser.add_argument('-x', '--extract', action='append', metavar='PATH',
+                        help='Restore only this file or directory (repeatable) into -o (default: current '
+                             'directory), decrypting just the parts of the archive it needs')
+    parser.add_argument('-d', '--direct', action='store_true',
+                        help='Extract straight from the decrypted stream into -o (default: next to the archive) '
+                             'without writing the decrypted zip')
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help='Threads writing restored files with --direct (default: one per CPU core)')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help='Archives decrypted in parallel when several are given (default: one per CPU '
+                             'core, as many as available memory allows; 1 = one at a time)')
+    parser.add_argument('-r', '--repository', help='Restore a snapshot from a deduplicating repository')
+    parser.add_argument('-b', '--buffer-size', type=int, default=DEFAULT_BUFFER_SIZE // 1024,
+                        help='Read/decrypt/write block size in KiB for single-pass formats (default: 1024)')
     parser.add_argument('-p', '--password', help='Decryption password (or use DECRYPTION_PASSWORD env var)')
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose logging')
     
     args = parser.parse_args()
+    if not args.repository:
+        args.input_file = find_archives(args.input_file)
+    if not args.input_file and not args.repository:
+        parser.error('input_file is required unless --repository is given')
+    if len(args.input_file) > 1 and (args.output or args.repository or args.extract):
+        parser.error('-o/--output, --extract and --repository take a single input')
     
     if args.verbose:
         logger.setLevel(logging.DEBUG)
@@ -289,37 +685,59 @@ def main():
         import getpass
         password = getpass.getpass('Enter decryption password: ')
     
-    try:
-        decryptor = BackupDecryptor(password)
-        output_file = decryptor.decrypt_file(args.input_file, args.output)
-        logger.info(f"Successfully decrypted to: {output_file}")
-        logger.info(f"Extract with: unzip {output_file}")
+    if args.repository:
+        try:
+            snapshot = args.input_file[0] if args.input_file else None
+            restore_snapshot(args.repository, snapshot, args.output or '.', password)
+        except Exception as e:
+            logger.error(f"Restore failed: {e}")
+            sys.exit(1)
+        return
+    
+    if args.extract:
+        try:
+            BackupDecryptor(password).extract_paths(args.input_file[0], args.extract, args.output or '.')
+        except Exception as e:
+            logger.error(f"Extraction failed: {e}")
+            sys.exit(1)
+        return
+    
+    # Direct restores stream into one destination, so they stay in order
+    if len(args.input_file) > 1 and args.jobs != 1 and not args.direct:
+        if not decrypt_batch(args.input_file, password, args.jobs, args.buffer_size * 1024):
+            sys.exit(1)
+        return
+    
+    # One decryptor for the whole batch: archives sharing a master salt
+    # need a single memory-hard KDF run
+    decryptor = BackupDecryptor(password, args.buffer_size * 1024)
+    for input_file in args.input_file:
+        if args.direct:
+            try:
+                decryptor.restore_direct(input_file, args.output or os.path.dirname(input_file) or '.',
+                                         args.workers)
+            except Exception as e:
+                logger.error(f"Restore failed: {e}")
+                sys.exit(1)
+            continue
+        try:
+            output_file = decryptor.decrypt_file(input_file, args.output)
+            logger.info(f"Successfully decrypted to: {output_file}")
+            logger.info(f"Extract with: unzip {output_file}")
+        except Exception as e:
+            logger.error(f"Decryption failed: {e}")
+            sys.exit(1)
 
         # Attempt to automatically extract the decrypted zip file in-place
         try:
             if output_file.endswith('.zip') and os.path.exists(output_file):
-                import zipfile
-
-                dest_dir = os.path.dirname(output_file) or '.'
-                abs_dest = os.path.abspath(dest_dir)
-
-                # Zip-slip protection: ensure every member extracts inside dest_dir
-                with zipfile.ZipFile(output_file, 'r') as zf:
-                    for member in zf.namelist():
-                        member_path = os.path.abspath(os.path.join(abs_dest, member))
-                        if not (member_path == abs_dest or member_path.startswith(abs_dest + os.sep)):
-                            logger.error(f"Zip contains unsafe path, aborting extraction: {member}")
-                            raise Exception("Unsafe zip entry detected")
-                    zf.extractall(dest_dir)
-
-                logger.info(f"Automatically extracted zip to: {dest_dir}")
+                extract_zip(output_file)
             else:
                 logger.debug("Output is not a zip archive; skipping automatic extraction")
         except Exception as e:
             logger.error(f"Automatic extraction failed: {e}")
-    except Exception as e:
-        logger.error(f"Decryption failed: {e}")
-        sys.exit(1)
+    if len(args.input_file) > 1:
+        logger.info(f"Decrypted {len(args.input_file)} archives with {decryptor.keys.kdf_runs} KDF run(s)")
 
 
 if __name__ == '__main__':
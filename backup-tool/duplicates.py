@@ -0,0 +1,205 @@
+"""
+Duplicate file detection for backup_tool.py
+
+Identical files (vendored libraries, repeated photo imports, hardlinked
+trees) are stored once; every other path with the same content becomes a
+reference in a small index member:
+
+    .backup-duplicates.json     # path -> source path, hardlink flag, mtime, mode
+
+Hardlinks are recognised by device and inode without reading the files.
+Other candidates are grouped by size, and only files that share a size are
+hashed: first their leading 64 KiB, then in full for those that still match.
+The hash is BLAKE2b, which runs at memory speed and, unlike a checksum,
+cannot be steered into a collision by crafted file content.
+
+Restore writes the stored file and then recreates every reference from it,
+as a hardlink where the source tree had one and as a copy otherwise.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import zipfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+DUPLICATES_MEMBER = '.backup-duplicates.json'
+DUPLICATES_VERSION = 1
+
+DEFAULT_MIN_SIZE = 4096  # below this a reference costs about as much as the member
+PREFIX_SIZE = 64 * 1024
+READ_SIZE = 1024 * 1024
+
+
+def _digest(path: Path, limit: Optional[int] = None) -> Optional[bytes]:
+    """BLAKE2b of the file (or its first limit bytes); None if it cannot be read"""
+    digest = hashlib.blake2b(digest_size=32)
+    remaining = limit
+    try:
+        with open(path, 'rb') as f:
+            while remaining is None or remaining > 0:
+                data = f.read(READ_SIZE if remaining is None else min(READ_SIZE, remaining))
+                if not data:
+                    break
+                digest.update(data)
+                if remaining is not None:
+                    remaining -= len(data)
+    except OSError as e:
+        logger.warning(f"Cannot hash {path}: {e}")
+        return None
+    return digest.digest()
+
+
+class DuplicateFinder:
+    """Split (path, arcname) members into distinct contents and references to them"""
+
+    def __init__(self, min_size: int = DEFAULT_MIN_SIZE, workers: int = 0):
+        self.min_size = min_size
+        self.workers = workers or os.cpu_count() or 1
+        self.hardlinks = 0
+        self.duplicates = 0
+        self.bytes_saved = 0
+        self.bytes_hashed = 0
+
+    def _refine(self, groups: List[List[Tuple[Path, str, os.stat_result]]],
+                limit: Optional[int]) -> List[List[Tuple[Path, str, os.stat_result]]]:
+        """Split each group by hash, keeping only subgroups that still hold several files"""
+        candidates = [member for group in groups for member in group]
+        # hashlib releases the GIL on large buffers, so threads hash in parallel
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            digests = list(pool.map(lambda member: _digest(member[0], limit), candidates))
+        self.bytes_hashed += sum(min(st.st_size, limit or st.st_size) for _, _, st in candidates)
+        refined = defaultdict(list)
+        for member, digest in zip(candidates, digests):
+            if digest is not None:
+                refined[(member[2].st_size, digest)].append(member)
+        return [group for group in refined.values() if len(group) > 1]
+
+    def find(self, members: List[Tuple[Path, str]]) -> Tuple[List[Tuple[Path, str]], Dict[str, Dict]]:
+        """
+        Returns the members to archive, in their original order, and
+        {path: reference} for every path left out.
+        """
+        references: Dict[str, Dict] = {}
+        inodes: Dict[Tuple[int, int], str] = {}
+        by_size = defaultdict(list)
+        for path, arcname in members:
+            try:
+                st = os.lstat(path)
+                if stat.S_ISLNK(st.st_mode):
+                    # Symlinks are archived as the file they point to
+                    st = os.stat(path)
+                elif st.st_nlink > 1:
+                    source = inodes.setdefault((st.st_dev, st.st_ino), arcname)
+                    if source != arcname:
+                        references[arcname] = self._reference(source, st, hardlink=True)
+                        self.hardlinks += 1
+                        continue
+            except OSError:
+                # Left to the archiver, which reports unreadable files
+                continue
+            if st.st_size >= self.min_size:
+                by_size[st.st_size].append((path, arcname, st))
+
+        groups = [group for group in by_size.values() if len(group) > 1]
+        if groups:
+            groups = self._refine(self._refine(groups, PREFIX_SIZE), None)
+        for group in groups:
+            source = group[0][1]
+            for _, arcname, st in group[1:]:
+                references[arcname] = self._reference(source, st, hardlink=False)
+                self.duplicates += 1
+                self.bytes_saved += st.st_size
+
+        unique = [(path, arcname) for path, arcname in members if arcname not in references]
+        return unique, references
+
+    @staticmethod
+    def _reference(source: str, st: os.stat_result, hardlink: bool) -> Dict:
+        return {'source': source, 'hardlink': hardlink, 'mtime': st.st_mtime, 'mode': stat.S_IMODE(st.st_mode)}
+
+    @staticmethod
+    def serialize(references: Dict[str, Dict]) -> bytes:
+        files = [dict(path=path, **reference) for path, reference in sorted(references.items())]
+        return json.dumps({'version': DUPLICATES_VERSION, 'files': files}, indent=1).encode()
+
+    def summary(self) -> str:
+        return (f"{self.duplicates} duplicate files ({self.bytes_saved / 1024 / 1024:.2f} MB not stored) "
+                f"and {self.hardlinks} hardlinks, {self.bytes_hashed / 1024 / 1024:.2f} MB hashed")
+
+
+def load_references(zf: zipfile.ZipFile) -> Dict[str, Dict]:
+    """Duplicate references of an open archive as {path: entry}; empty if it has none"""
+    try:
+        return parse_references(zf.read(DUPLICATES_MEMBER))
+    except KeyError:
+        return {}
+
+
+def parse_references(data: bytes) -> Dict[str, Dict]:
+    index = json.loads(data)
+    if index.get('version') != DUPLICATES_VERSION:
+        raise ValueError(f"Unsupported duplicates index version: {index.get('version')}")
+    return {entry['path']: entry for entry in index['files']}
+
+
+def resolve_source(references: Dict[str, Dict], path: str) -> str:
+    """Archive member holding the content of path"""
+    while path in references:
+        path = references[path]['source']
+    return path
+
+
+def restore_duplicates(references: Dict[str, Dict], dest_dir: str,
+                       read_source: Optional[Callable[[str], bytes]] = None,
+                       restored_paths: Optional[Set[str]] = None) -> int:
+    """
+    Recreate referenced paths under dest_dir from their restored source
+    files. With restored_paths (a partial restore), sources outside it are
+    read with read_source(member) instead. Returns the number of paths written.
+    """
+    abs_dest = os.path.abspath(dest_dir)
+    restored = 0
+    # Copies first: a hardlink's source can itself be a copied duplicate
+    for entry in sorted(references.values(), key=lambda e: e['hardlink']):
+        targets = []
+        for name in (entry['path'], entry['source']):
+            # Same zip-slip protection as regular members
+            target = os.path.abspath(os.path.join(abs_dest, name))
+            if not target.startswith(abs_dest + os.sep):
+                raise ValueError(f"Duplicates index contains unsafe path: {name}")
+            targets.append(target)
+        target, source = targets
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.lexists(target):
+            os.remove(target)
+        if (restored_paths is not None and entry['source'] not in restored_paths) or not os.path.exists(source):
+            if read_source is None:
+                logger.warning(f"Cannot restore {entry['path']}: {entry['source']} was not restored")
+                continue
+            with open(target, 'wb') as out:
+                out.write(read_source(resolve_source(references, entry['source'])))
+        elif entry['hardlink']:
+            try:
+                os.link(source, target)
+                restored += 1
+                continue
+            except OSError:
+                # Filesystem without hardlinks: fall back to a copy
+                shutil.copyfile(source, target)
+        else:
+            shutil.copyfile(source, target)
+        os.chmod(target, entry['mode'])
+        os.utime(target, (entry['mtime'], entry['mtime']))
+        if restored_paths is not None:
+            restored_paths.add(entry['path'])
+        restored += 1
+    return restored
@@ -0,0 +1,130 @@
+"""
+Argon2id cost calibration for backup_tool.py
+
+The fixed defaults (3 passes over 64 MiB on 4 lanes) take seconds on a small
+ARM board and leave most of a large server idle. Calibration measures the
+host instead: lanes follow the usable cores, memory starts at the budget
+(memory is what makes guessing expensive on GPUs and ASICs) and is only
+lowered when one pass alone would blow the latency target, and the number
+of passes is then raised until unlocking takes about the target time.
+
+The result is saved as JSON and new archives record the parameters in
+their header, so restoring never depends on this file or on the host:
+
+    {"version": 1, "kdf": "ARGON2ID", "time_cost": 4, "memory_cost": 262144,
+     "parallelism": 16, "seconds": 0.97, ...}
+
+Unlocking on a slower or smaller restore host takes proportionally longer.
+"""
+
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from backup_format import ARGON2_MAX_MEMORY_COST, ARGON2_MAX_TIME_COST, SALT_SIZE, check_kdf_params, derive_key
+
+logger = logging.getLogger(__name__)
+
+CALIBRATION_VERSION = 1
+DEFAULT_TARGET_SECONDS = 1.0
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+# Floor of the search (OWASP minimum for Argon2id: 19 MiB, 2 passes)
+MIN_MEMORY_COST = 19 * 1024
+MIN_TIME_COST = 2
+MAX_PARALLELISM = 64
+
+
+def usable_cores() -> int:
+    """Cores this process may run on (respects CPU affinity and cgroup-pinned sets)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _available_memory() -> Optional[int]:
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def measure(params: Tuple[int, int, int]) -> float:
+    """Seconds one key derivation takes with params"""
+    started = time.perf_counter()
+    derive_key(os.urandom(16).hex(), b'ARGON2ID', os.urandom(SALT_SIZE), params)
+    return time.perf_counter() - started
+
+
+def calibrate(target_seconds: float = DEFAULT_TARGET_SECONDS,
+              memory_budget: int = DEFAULT_MEMORY_BUDGET) -> Tuple[Tuple[int, int, int], float]:
+    """
+    Argon2id (time cost, memory cost in KiB, parallelism) that unlocks in
+    about target_seconds within memory_budget bytes, and the measured time.
+    """
+    try:
+        import argon2  # noqa: F401
+    except ImportError:
+        raise ImportError("argon2-cffi required to calibrate the KDF. Install: pip install argon2-cffi")
+
+    available = _available_memory()
+    if available is not None and available // 2 < memory_budget:
+        logger.warning(f"Only {available / 1024 / 1024:.0f} MB available; "
+                       f"capping the KDF memory at {available / 2 / 1024 / 1024:.0f} MB")
+        memory_budget = available // 2
+    parallelism = min(usable_cores(), MAX_PARALLELISM)
+    memory_cost = min(max(memory_budget // 1024, MIN_MEMORY_COST, 8 * parallelism), ARGON2_MAX_MEMORY_COST)
+
+    # One pass must leave room for MIN_TIME_COST passes within the target
+    elapsed = measure((1, memory_cost, parallelism))
+    while elapsed * MIN_TIME_COST > target_seconds and memory_cost > MIN_MEMORY_COST:
+        memory_cost = max(memory_cost // 2, MIN_MEMORY_COST)
+        elapsed = measure((1, memory_cost, parallelism))
+        logger.debug(f"1 pass over {memory_cost // 1024} MiB: {elapsed:.3f}s")
+
+    # Passes scale time linearly; confirm and step back if the estimate overshoots.
+    # A fast host with little memory stops at the most passes a header accepts
+    time_cost = min(max(MIN_TIME_COST, round(target_seconds / elapsed)), ARGON2_MAX_TIME_COST)
+    params = (time_cost, memory_cost, parallelism)
+    elapsed = measure(params)
+    while elapsed > target_seconds * 1.1 and time_cost > MIN_TIME_COST:
+        time_cost -= 1
+        params = (time_cost, memory_cost, parallelism)
+        elapsed = measure(params)
+    if elapsed > target_seconds * 1.1:
+        logger.warning(f"Cannot reach {target_seconds:.2f}s on this host; the minimum cost takes {elapsed:.2f}s")
+    check_kdf_params(params)
+    return params, elapsed
+
+
+def save_calibration(path: Path, params: Tuple[int, int, int], seconds: float, target_seconds: float):
+    time_cost, memory_cost, parallelism = params
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': CALIBRATION_VERSION, 'kdf': 'ARGON2ID', 'time_cost': time_cost,
+                   'memory_cost': memory_cost, 'parallelism': parallelism, 'seconds': round(seconds, 3),
+                   'target_seconds': target_seconds, 'cores': usable_cores(),
+                   'calibrated_at': int(time.time())}, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_calibration(path: Path) -> Optional[Tuple[int, int, int]]:
+    """Parameters saved by save_calibration; None if there is no usable file"""
+    if not path.exists():
+        return None
+    with open(path, 'r') as f:
+        stored: Dict = json.load(f)
+    if stored.get('version') != CALIBRATION_VERSION or stored.get('kdf') != 'ARGON2ID':
+        logger.warning(f"Ignoring KDF calibration with unsupported version: {path}")
+        return None
+    params = (int(stored['time_cost']), int(stored['memory_cost']), int(stored['parallelism']))
+    check_kdf_params(params)
+    return params
@@ -0,0 +1,258 @@
+"""
+Run metrics for backup_tool.py
+
+Each stage of a backup (collection, compression, key derivation, encryption,
+upload) records wall and CPU time, bytes in and out, files/s and peak RSS.
+A run's metrics are logged as a table and can be exported as JSON and as a
+Prometheus textfile for node_exporter's textfile collector:
+
+    node_exporter --collector.textfile.directory=/var/lib/node_exporter/textfile
+
+CPU time is process-wide, so for stages that run on worker threads it can
+exceed wall time. In pipeline mode compression and encryption run
+interleaved in one stage; their shares are broken out from time measured
+inside the encryptor and the KDF.
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_INTERVAL = 0.5
+
+
+class PeakRss:
+    """
+    Peak resident set size while the block runs, sampled from /proc every few
+    milliseconds. Elsewhere falls back to the process-wide maximum.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+    def _current(self) -> int:
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * self._page_size
+        except OSError:
+            import resource
+            usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # Kilobytes on Linux, bytes on macOS
+            return usage if sys.platform == 'darwin' else usage * 1024
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self._current())
+
+    def __enter__(self) -> 'PeakRss':
+        self.peak = self._current()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._current())
+
+
+class StageMetrics:
+    """Measurements for one stage; bytes and files are filled in by the stage itself"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.wall_seconds = 0.0
+        self.cpu_seconds: Optional[float] = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.files = 0
+        self.peak_rss_bytes: Optional[int] = None
+        # Cleared when the stage raises, or by the stage itself (a failed upload)
+        self.ok = True
+        # Live byte count for the progress display
+        self.progress: Optional[Callable[[], int]] = None
+
+    @property
+    def mb_per_second(self) -> float:
+        size = self.bytes_in or self.bytes_out
+        return size / 1024 / 1024 / self.wall_seconds if self.wall_seconds else 0.0
+
+    @property
+    def files_per_second(self) -> float:
+        return self.files / self.wall_seconds if self.wall_seconds else 0.0
+
+    def to_dict(self) -> Dict:
+        return {
+            'wall_seconds': round(self.wall_seconds, 4),
+            'cpu_seconds': None if self.cpu_seconds is None else round(self.cpu_seconds, 4),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'files': self.files,
+            'mb_per_second': round(self.mb_per_second, 2),
+            'files_per_second': round(self.files_per_second, 1),
+            'peak_rss_bytes': self.peak_rss_bytes,
+            'ok': self.ok,
+        }
+
+
+class RunMetrics:
+    """Stages of one backup run, in the order they ran"""
+
+    def __init__(self, backup_time: str, progress: bool = False):
+        self.backup_time = backup_time
+        self.show_progress = progress
+        self.stages: Dict[str, StageMetrics] = {}
+        self.success = False
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self._cpu_started = time.process_time()
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageMetrics]:
+        """Time the block as stage name; the yielded object takes bytes and file counts"""
+        stage = StageMetrics(name)
+        self.stages[name] = stage
+        done = threading.Event()
+        display = None
+        if self.show_progress:
+            display = threading.Thread(target=self._display, args=(stage, done), daemon=True)
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        # Unset if PeakRss itself fails to start
+        rss = None
+        try:
+            with PeakRss() as rss:
+                if display:
+                    display.start()
+                yield stage
+        except BaseException:
+            stage.ok = False
+            raise
+        finally:
+            stage.wall_seconds = time.perf_counter() - started
+            stage.cpu_seconds = time.process_time() - cpu_started
+            stage.peak_rss_bytes = rss.peak if rss else None
+            done.set()
+            if display and display.ident is not None:
+                display.join()
+
+    def record(self, name: str, wall_seconds: float, bytes_in: int = 0, bytes_out: int = 0,
+               files: int = 0) -> StageMetrics:
+        """Add a stage measured elsewhere (time spent inside the KDF or the encryptor)"""
+        stage = StageMetrics(name)
+        stage.wall_seconds = wall_seconds
+        stage.bytes_in = bytes_in
+        stage.bytes_out = bytes_out
+        stage.files = files
+        self.stages[name] = stage
+        return stage
+
+    def _display(self, stage: StageMetrics, done: threading.Event):
+        started = time.perf_counter()
+        while not done.wait(PROGRESS_INTERVAL):
+            elapsed = time.perf_counter() - started
+            line = f"\r[{stage.name}] {elapsed:7.1f}s"
+            if stage.progress:
+                try:
+                    size = stage.progress()
+                except (OSError, ValueError):
+                    # The stage's file may be gone or already closed
+                    size = 0
+                line += f" {size / 1024 / 1024:10.1f} MB {size / 1024 / 1024 / elapsed:8.1f} MB/s"
+            sys.stderr.write(line)
+            sys.stderr.flush()
+        sys.stderr.write(f"\r[{stage.name}] done in {time.perf_counter() - started:.1f}s\033[K\n")
+        sys.stderr.flush()
+
+    def finish(self, success: bool):
+        self.success = success and all(stage.ok for stage in self.stages.values())
+        self.wall_seconds = time.perf_counter() - self._started
+        self.cpu_seconds = time.process_time() - self._cpu_started
+
+    def summary(self) -> str:
+        lines = [f"{'stage':>10} {'wall':>9} {'cpu':>9} {'MB in':>10} {'MB out':>10} {'MB/s':>9} "
+                 f"{'files/s':>10} {'peak RSS':>9}"]
+        for stage in self.stages.values():
+            cpu = '' if stage.cpu_seconds is None else f"{stage.cpu_seconds:8.2f}s"
+            rss = '' if stage.peak_rss_bytes is None else f"{stage.peak_rss_bytes / 1024 / 1024:6.0f} MB"
+            lines.append(f"{stage.name:>10} {stage.wall_seconds:8.2f}s {cpu:>9} "
+                         f"{stage.bytes_in / 1024 / 1024:10.2f} {stage.bytes_out / 1024 / 1024:10.2f} "
+                         f"{stage.mb_per_second:9.1f} {stage.files_per_second:10.0f} {rss:>9}")
+        lines.append(f"{'total':>10} {self.wall_seconds:8.2f}s {self.cpu_seconds:8.2f}s")
+        return '\n'.join(lines)
+
+    def to_dict(self) -> Dict:
+        return {
+            'backup_time': self.backup_time,
+            'started_at': self.started_at,
+            'success': self.success,
+            'wall_seconds': round(self.wall_seconds, 4),
+            'cpu_seconds': round(self.cpu_seconds, 4),
+            'stages': {name: stage.to_dict() for name, stage in self.stages.items()},
+        }
+
+    def write_json(self, path: str):
+        _write_atomic(path, json.dumps(self.to_dict(), indent=2) + '\n')
+
+    def write_prometheus(self, path: str):
+        """Textfile-collector format; replaced atomically so a scrape never sees half a file"""
+        gauges = [
+            ('wall_seconds', 'Wall-clock time of the stage', lambda s: s.wall_seconds),
+            ('cpu_seconds', 'Process CPU time during the stage', lambda s: s.cpu_seconds),
+            ('bytes_in', 'Bytes read by the stage', lambda s: s.bytes_in),
+            ('bytes_out', 'Bytes written by the stage', lambda s: s.bytes_out),
+            ('files', 'Files handled by the stage', lambda s: s.files),
+            ('throughput_bytes_per_second', 'Stage throughput',
+             lambda s: s.mb_per_second * 1024 * 1024),
+            ('peak_rss_bytes', 'Peak resident memory during the stage', lambda s: s.peak_rss_bytes),
+            ('success', 'Whether the stage completed', lambda s: int(s.ok)),
+        ]
+        lines = []
+        for suffix, help_text, value in gauges:
+            metric = f"backup_stage_{suffix}"
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+            for stage in self.stages.values():
+                if value(stage) is not None:
+                    lines.append(f'{metric}{{stage="{stage.name}"}} {_sample(value(stage))}')
+        lines += [
+            "# HELP backup_last_run_timestamp_seconds Start time of the last backup run",
+            "# TYPE backup_last_run_timestamp_seconds gauge",
+            f"backup_last_run_timestamp_seconds {self.started_at:.0f}",
+            "# HELP backup_last_run_success Whether the last backup run completed",
+            "# TYPE backup_last_run_success gauge",
+            f"backup_last_run_success {int(self.success)}",
+            "# HELP backup_last_run_wall_seconds Wall-clock time of the last backup run",
+            "# TYPE backup_last_run_wall_seconds gauge",
+            f"backup_last_run_wall_seconds {_sample(self.wall_seconds)}",
+            "# HELP backup_last_run_cpu_seconds CPU time of the last backup run",
+            "# TYPE backup_last_run_cpu_seconds gauge",
+            f"backup_last_run_cpu_seconds {_sample(self.cpu_seconds)}",
+        ]
+        _write_atomic(path, '\n'.join(lines) + '\n')
+
+
+def _sample(value) -> str:
+    # Byte counts stay exact; times keep microseconds
+    return str(value) if isinstance(value, int) else str(round(value, 6))
+
+
+def _write_atomic(path: str, text: str):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, path)
@@ -0,0 +1,451 @@
+"""
+Multi-core zip compression for backup_tool.py
+
+Files are cut into fixed-size chunks that a thread pool deflates independently
+(zlib releases the GIL while compressing). Each chunk is primed with the last
+32 KiB of the chunk before it and ends on a sync flush, so the chunks join into
+one ordinary deflate stream per member (the pigz technique) and compress almost
+as well as a single-threaded pass. Results are written back strictly in
+submission order, so the archive is identical whatever the worker count.
+
+The writer streams to any writable file object (including the encryption
+writer) and never seeks: members use data descriptors and ZIP64 records are
+emitted as needed, so the output opens with the standard zipfile module.
+"""
+
+import io
+import os
+import stat
+import logging
+import struct
+import time
+import zlib
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+DICTIONARY_SIZE = 32 * 1024  # deflate window
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP64_LIMIT = (1 << 31) - 1  # same threshold the zipfile module uses
+ZIP_MAX_COUNT = 0xFFFF
+ZIP_MAX_32 = 0xFFFFFFFF
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+UNIX_SYSTEM = 3
+DEFAULT_VERSION = 20
+ZIP64_VERSION = 45
+
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5HLL')
+END_RECORD = struct.Struct('<4s4H2LH')
+END_RECORD64 = struct.Struct('<4sQ2H2L4Q')
+END_LOCATOR64 = struct.Struct('<4sLQL')
+
+
+def _dos_datetime(mtime: float) -> Tuple[int, int]:
+    """Zip timestamps cannot represent dates before 1980, clamp like zipfile does"""
+    t = time.localtime(mtime)[:6]
+    if t[0] < 1980:
+        t = (1980, 1, 1, 0, 0, 0)
+    elif t[0] > 2107:
+        t = (2107, 12, 31, 23, 59, 59)
+    dos_date = (t[0] - 1980) << 9 | t[1] << 5 | t[2]
+    dos_time = t[3] << 11 | t[4] << 5 | t[5] // 2
+    return dos_time, dos_date
+
+
+class ZipEntry:
+    """Bookkeeping for one member, filled in as it is written"""
+
+    def __init__(self, arcname: str, mtime: float, mode: int, size: int, method: int):
+        self.name = arcname.encode('utf-8')
+        self.flags = FLAG_DATA_DESCRIPTOR | (0 if arcname.isascii() else FLAG_UTF8)
+        self.method = method
+        self.dos_time, self.dos_date = _dos_datetime(mtime)
+        self.external_attr = (mode & 0xFFFF) << 16
+        # Decided up front from the file size, like zipfile does for streamed members
+        self.zip64 = size * 1.05 > ZIP64_LIMIT
+        self.header_offset = 0
+        self.crc = 0
+        self.compress_size = 0
+        self.file_size = 0
+
+    # Central directory record of a finished member, kept to resume an interrupted archive
+    FIELDS = ('flags', 'method', 'dos_time', 'dos_date', 'external_attr', 'zip64',
+              'header_offset', 'crc', 'compress_size', 'file_size')
+
+    def to_dict(self) -> Dict:
+        record = {field: getattr(self, field) for field in self.FIELDS}
+        record['name'] = self.name.decode('utf-8')
+        return record
+
+    @classmethod
+    def from_dict(cls, record: Dict) -> 'ZipEntry':
+        entry = cls.__new__(cls)
+        entry.name = record['name'].encode('utf-8')
+        for field in cls.FIELDS:
+            setattr(entry, field, record[field])
+        return entry
+
+
+class ZipStreamWriter:
+    """
+    Write a zip archive to a stream using only sequential writes.
+
+    offset and entries continue an interrupted archive: the stream must be
+    positioned right after the last of those members.
+    """
+
+    def __init__(self, fileobj: BinaryIO, offset: int = 0, entries: Optional[List[ZipEntry]] = None):
+        self._fp = fileobj
+        self._offset = offset
+        self._entries: List[ZipEntry] = entries or []
+
+    @property
+    def offset(self) -> int:
+        return self._offset
+
+    @property
+    def entries(self) -> List[ZipEntry]:
+        """Members completed so far, in archive order"""
+        return self._entries
+
+    def _write(self, data: bytes):
+        self._fp.write(data)
+        self._offset += len(data)
+
+    def start_member(self, entry: ZipEntry):
+        """Write a local file header; sizes and CRC follow in the data descriptor"""
+        entry.header_offset = self._offset
+        extra = b''
+        if entry.zip64:
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+        version = ZIP64_VERSION if entry.zip64 else DEFAULT_VERSION
+        size_field = ZIP_MAX_32 if entry.zip64 else 0
+        self._write(LOCAL_HEADER.pack(
+            b'PK\x03\x04', version, 0, entry.flags, entry.method,
+            entry.dos_time, entry.dos_date, 0, size_field, size_field,
+            len(entry.name), len(extra)
+        ) + entry.name + extra)
+
+    def write_data(self, entry: ZipEntry, data: bytes):
+        self._write(data)
+        entry.compress_size += len(data)
+
+    def end_member(self, entry: ZipEntry, crc: int, file_size: int):
+        entry.crc = crc
+        entry.file_size = file_size
+        if not entry.zip64 and max(entry.compress_size, file_size) > ZIP_MAX_32:
+            raise ValueError(f"{entry.name.decode()} grew past 4 GiB while being archived")
+        fmt = '<4sLQQ' if entry.zip64 else '<4sLLL'
+        self._write(struct.pack(fmt, b'PK\x07\x08', crc, entry.compress_size, file_size))
+        self._entries.append(entry)
+
+    def abandon_member(self, entry: ZipEntry, crc: int, file_size: int):
+        """
+        Close a member whose source failed part way without listing it in the
+        central directory. Its bytes stay in the stream (they cannot be taken
+        back) as dead space that readers going by the central directory never
+        see; the descriptor keeps sequential readers in step.
+        """
+        fmt = '<4sLQQ' if entry.zip64 else '<4sLLL'
+        self._write(struct.pack(fmt, b'PK\x07\x08', crc, entry.compress_size, file_size))
+
+    def close(self):
+        """Write the central directory and end records"""
+        cd_offset = self._offset
+        for entry in self._entries:
+            zip64_fields = []
+            file_size, compress_size, header_offset = entry.file_size, entry.compress_size, entry.header_offset
+            if file_size > ZIP64_LIMIT:
+                zip64_fields.append(file_size)
+                file_size = ZIP_MAX_32
+            if compress_size > ZIP64_LIMIT:
+                zip64_fields.append(compress_size)
+                compress_size = ZIP_MAX_32
+            if header_offset > ZIP64_LIMIT:
+                zip64_fields.append(header_offset)
+                header_offset = ZIP_MAX_32
+            extra = b''
+            if zip64_fields:
+                extra = struct.pack(f'<HH{len(zip64_fields)}Q', 1, 8 * len(zip64_fields), *zip64_fields)
+            version = ZIP64_VERSION if (zip64_fields or entry.zip64) else DEFAULT_VERSION
+            self._write(CENTRAL_HEADER.pack(
+                b'PK\x01\x02', version, UNIX_SYSTEM, version, 0, entry.flags, entry.method,
+                entry.dos_time, entry.dos_date, entry.crc, compress_size, file_size,
+                len(entry.name), len(extra), 0, 0, 0, entry.external_attr, header_offset
+            ) + entry.name + extra)
+
+        count = len(self._entries)
+        cd_size = self._offset - cd_offset
+        if count > ZIP_MAX_COUNT or cd_offset > ZIP64_LIMIT or cd_size > ZIP64_LIMIT:
+            end64_offset = self._offset
+            self._write(END_RECORD64.pack(
+                b'PK\x06\x06', END_RECORD64.size - 12, ZIP64_VERSION, ZIP64_VERSION,
+                0, 0, count, count, cd_size, cd_offset
+            ))
+            self._write(END_LOCATOR64.pack(b'PK\x06\x07', 0, end64_offset, 1))
+            count = min(count, ZIP_MAX_COUNT)
+            cd_size = min(cd_size, ZIP_MAX_32)
+            cd_offset = min(cd_offset, ZIP_MAX_32)
+        self._write(END_RECORD.pack(b'PK\x05\x06', 0, 0, count, count, cd_size, cd_offset, 0))
+
+
+def _deflate_chunk(data: bytes, zdict: bytes, level: int, final: bool) -> bytes:
+    """Raw-deflate one chunk so that consecutive chunks concatenate into one stream"""
+    options = {'zdict': zdict} if zdict else {}
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, **options)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class CompressionPolicy:
+    """
+    Per-file choice between storing and deflating, and of the deflate level.
+
+    Files with extensions of already-compressed formats are stored without
+    being read. Larger files are judged from a quick level-1 trial compression
+    of their first block: incompressible data is stored, marginal data gets
+    level 1, and only clearly compressible data pays for the configured level.
+
+    Savings are estimates: a calibration at startup measures what the
+    configured level costs, in CPU time and output size, on incompressible and
+    on marginal data, and that is applied to the bytes each rule diverted.
+    """
+
+    STORED_EXTENSIONS = {
+        # images, audio, video
+        '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+        '.mp3', '.aac', '.ogg', '.opus', '.flac', '.m4a',
+        '.mp4', '.m4v', '.mkv', '.mov', '.avi', '.webm',
+        # archives and compressed streams
+        '.zip', '.gz', '.tgz', '.bz2', '.xz', '.txz', '.zst', '.lz4', '.7z', '.rar',
+        '.jar', '.whl', '.apk', '.deb', '.rpm', '.docx', '.xlsx', '.pptx', '.odt',
+        # already encrypted
+        '.gpg', '.age', '.encrypted',
+    }
+    SAMPLE_SIZE = 64 * 1024
+    STORE_RATIO = 0.95
+    FAST_RATIO = 0.80
+    FAST_LEVEL = 1
+
+    def __init__(self, compression_level: int = 9):
+        self.compression_level = compression_level
+        self.stored_files = 0
+        self.stored_bytes = 0
+        self.fast_files = 0
+        self.fast_bytes = 0
+        self.sample_cpu_seconds = 0.0
+        self._calibrate()
+
+    @staticmethod
+    def _deflate_cost(data: bytes, level: int) -> Tuple[float, int]:
+        """CPU seconds per byte and output size of deflating data at level"""
+        started = time.thread_time()
+        rounds = 0
+        while True:
+            size = len(zlib.compress(data, level))
+            rounds += 1
+            elapsed = time.thread_time() - started
+            # Repeat until the measurement is above clock resolution
+            if elapsed > 0.02 or rounds >= 50:
+                return elapsed / rounds / len(data), size
+
+    def _calibrate(self):
+        import base64
+
+        incompressible = os.urandom(256 * 1024)
+        marginal = base64.b64encode(os.urandom(192 * 1024))  # deflates to ~75%
+        level = self.compression_level
+        cost, size = self._deflate_cost(incompressible, level)
+        self._stored_cpu_per_byte = cost
+        self._stored_size_per_byte = size / len(incompressible) - 1
+        cost_n, size_n = self._deflate_cost(marginal, level)
+        cost_1, size_1 = self._deflate_cost(marginal, self.FAST_LEVEL)
+        self._fast_cpu_per_byte = max(cost_n - cost_1, 0.0)
+        self._fast_size_per_byte = (size_n - size_1) / len(marginal)
+
+    def choose(self, path: Path, f: BinaryIO, size: int) -> Tuple[int, int]:
+        """Return (method, level) for one file; f is left at offset 0"""
+        if Path(path).suffix.lower() in self.STORED_EXTENSIONS:
+            return self._store(size)
+        if size <= self.SAMPLE_SIZE or self.compression_level <= self.FAST_LEVEL:
+            # Sampling would cost as much as just compressing it
+            return ZIP_DEFLATED, self.compression_level
+
+        started = time.thread_time()
+        sample = f.read(self.SAMPLE_SIZE)
+        f.seek(0)
+        ratio = len(zlib.compress(sample, self.FAST_LEVEL)) / len(sample)
+        self.sample_cpu_seconds += time.thread_time() - started
+
+        if ratio > self.STORE_RATIO:
+            return self._store(size)
+        if ratio > self.FAST_RATIO:
+            self.fast_files += 1
+            self.fast_bytes += size
+            return ZIP_DEFLATED, self.FAST_LEVEL
+        return ZIP_DEFLATED, self.compression_level
+
+    def _store(self, size: int) -> Tuple[int, int]:
+        self.stored_files += 1
+        self.stored_bytes += size
+        return ZIP_STORED, 0
+
+    @property
+    def cpu_seconds_saved(self) -> float:
+        return (self.stored_bytes * self._stored_cpu_per_byte
+                + self.fast_bytes * self._fast_cpu_per_byte
+                - self.sample_cpu_seconds)
+
+    @property
+    def bytes_saved(self) -> int:
+        """Positive when the archive got smaller (deflate expansion avoided)"""
+        return int(self.stored_bytes * self._stored_size_per_byte
+                   + self.fast_bytes * self._fast_size_per_byte)
+
+    def summary(self) -> str:
+        return (f"{self.stored_files} files ({self.stored_bytes / 1024 / 1024:.2f} MB) stored, "
+                f"{self.fast_files} files ({self.fast_bytes / 1024 / 1024:.2f} MB) at level {self.FAST_LEVEL}; "
+                f"~{self.cpu_seconds_saved:.2f} CPU-s and ~{self.bytes_saved} bytes saved "
+                f"vs. level {self.compression_level} throughout")
+
+
+class ParallelZipCompressor:
+    """Deflate archive members on a thread pool and assemble them in order"""
+
+    def __init__(self, workers: int, compression_level: int = 9, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 policy: Optional[CompressionPolicy] = None):
+        self.workers = max(1, workers)
+        self.compression_level = compression_level
+        self.policy = policy
+        self.chunk_size = chunk_size
+        self.files_written = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Archive names of members that could not be read
+        self.failed: List[str] = []
+
+    def write_archive(self, fileobj: BinaryIO, members: Iterable[Tuple[Union[Path, bytes], str]],
+                      extra_members: Optional[Dict[str, bytes]] = None,
+                      writer: Optional[ZipStreamWriter] = None,
+                      on_member: Optional[Callable[[ZipStreamWriter], None]] = None) -> List[str]:
+        """
+        Compress (path, arcname) pairs into a zip written to fileobj. A member
+        source may also be in-memory bytes (solid blocks and their index).
+
+        extra_members maps archive names to small in-memory payloads (backup
+        metadata) that are appended after the files.
+
+        writer continues an interrupted archive instead of starting a new one,
+        and on_member(writer) is called each time a member has been written
+        in full (the points a crash-safe run can checkpoint at).
+
+        At most two chunks per worker are in flight, so memory stays bounded
+        by workers * chunk_size however large the individual files are.
+
+        Returns the archive names of the members that could not be read and
+        were left out (also kept in failed).
+        """
+        writer = writer or ZipStreamWriter(fileobj)
+        pending = deque()
+        max_in_flight = self.workers * 2
+
+        def drain(limit: int):
+            while len(pending) > limit:
+                action, entry, payload = pending.popleft()
+                if action == 'start':
+                    writer.start_member(entry)
+                elif action == 'data':
+                    # Stored chunks are queued as-is, deflated ones as futures
+                    data = payload if isinstance(payload, bytes) else payload.result()
+                    writer.write_data(entry, data)
+                    self.bytes_out += len(data)
+                elif action == 'abandon':
+                    writer.abandon_member(entry, *payload)
+                else:
+                    writer.end_member(entry, *payload)
+                    self.files_written += 1
+                    if on_member:
+                        on_member(writer)
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='deflate') as pool:
+            extra = ((data, arcname) for arcname, data in (extra_members or {}).items())
+            for source, arcname in itertools.chain(members, extra):
+                if isinstance(source, bytes):
+                    path, f = Path(arcname), io.BytesIO(source)
+                    mtime, mode, file_size = time.time(), 0o100600, len(source)
+                else:
+                    path = source
+                    try:
+                        f = open(path, 'rb')
+                        st = os.fstat(f.fileno())
+                    except OSError as e:
+                        logger.error(f"Failed to add {path}: {e}")
+                        self.failed.append(arcname)
+                        continue
+                    if not stat.S_ISREG(st.st_mode):
+                        f.close()
+                        continue
+                    mtime, mode, file_size = st.st_mtime, st.st_mode, st.st_size
+
+                method, level = ZIP_DEFLATED, self.compression_level
+                if self.policy:
+                    try:
+                        method, level = self.policy.choose(path, f, file_size)
+                    except OSError as e:
+                        f.close()
+                        logger.error(f"Failed to add {path}: {e}")
+                        self.failed.append(arcname)
+                        continue
+                entry = ZipEntry(arcname, mtime, mode, file_size, method)
+                pending.append(('start', entry, None))
+                crc = 0
+                size = 0
+                zdict = b''
+                # Only errors reading the source are the member's; output errors end the archive
+                read_error = None
+                with f:
+                    try:
+                        chunk = f.read(self.chunk_size)
+                    except OSError as e:
+                        read_error = e
+                    while read_error is None:
+                        try:
+                            next_chunk = f.read(self.chunk_size) if len(chunk) == self.chunk_size else b''
+                        except OSError as e:
+                            read_error = e
+                            break
+                        final = not next_chunk
+                        if method == ZIP_STORED:
+                            pending.append(('data', entry, chunk))
+                        else:
+                            pending.append(('data', entry, pool.submit(_deflate_chunk, chunk, zdict, level, final)))
+                        crc = zlib.crc32(chunk, crc)
+                        size += len(chunk)
+                        drain(max_in_flight)
+                        if final:
+                            break
+                        zdict = chunk[-DICTIONARY_SIZE:]
+                        chunk = next_chunk
+                if read_error is not None:
+                    logger.error(f"Failed to add {path}: {read_error}")
+                    self.failed.append(arcname)
+                    if method != ZIP_STORED:
+                        # End the deflate stream so the member still parses
+                        pending.append(('data', entry, pool.submit(_deflate_chunk, b'', zdict, level, True)))
+                    pending.append(('abandon', entry, (crc, size)))
+                    continue
+                pending.append(('end', entry, (crc, size)))
+                self.bytes_in += size
+
+            drain(0)
+        writer.close()
+        return self.failed
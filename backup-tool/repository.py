@@ -0,0 +1,346 @@
+"""
+Deduplicating repository storage for backup_tool.py
+
+Instead of one standalone archive per run, files are split into
+content-defined chunks and every distinct chunk is stored once, compressed,
+encrypted and addressed by a keyed hash of its content. A backup is a small
+encrypted snapshot listing each file's chunks, so data that barely changes
+between runs costs almost nothing to store or upload again.
+
+Layout:
+
+    repository/
+        config                 # KDF, salt, chunker parameters, key check (JSON, no secrets)
+        chunks/ab/abcd...      # [ NONCE ][ AES-256-GCM(zlib(chunk)) ], id bound as associated data
+        snapshots/<name>       # [ NONCE ][ AES-256-GCM(zlib(json index)) ]
+        pending-uploads.json   # objects not yet confirmed in cloud storage (JSON list)
+
+Chunk boundaries come from a gear rolling hash (FastCDC with normalized
+chunking), so inserting or removing bytes only changes the chunks around the
+edit. The gear table and chunk ids are derived from the repository key, so
+neither chunk boundaries nor ids can be used to fingerprint known content.
+"""
+
+import hashlib
+import hmac
+import json
+import logging
+import os
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from backup_format import SALT_SIZE, check_kdf_params, derive_key, hkdf
+
+# Vectorizes the chunker's rolling hash; the pure Python fallback is far slower
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+REPOSITORY_VERSION = 1
+NONCE_SIZE = 12
+PENDING_UPLOADS = 'pending-uploads.json'
+
+# Chunk sizes: restore and dedup granularity vs. number of objects
+MIN_CHUNK_SIZE = 256 * 1024
+AVG_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+
+HASH_MASK = (1 << 64) - 1
+GEAR_WINDOW = 64  # bytes that reach the top bit of the gear hash
+SCAN_BLOCK_SIZE = 32 * 1024  # positions hashed per numpy step; small enough to stay in cache
+
+
+class ContentDefinedChunker:
+    """
+    Split a stream at content-defined boundaries (FastCDC, normalized chunking).
+
+    The 64-bit gear hash at a position only depends on the 64 bytes ending
+    there, so with numpy it is computed for a whole block of positions at
+    once and the first one passing the mask is searched for; without numpy a
+    per-byte loop finds the same boundaries, only much more slowly.
+    """
+
+    def __init__(self, gear_seed: bytes, min_size: int = MIN_CHUNK_SIZE,
+                 avg_size: int = AVG_CHUNK_SIZE, max_size: int = MAX_CHUNK_SIZE):
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.gear = [int.from_bytes(gear_seed[i:i + 8], 'big') for i in range(0, 256 * 8, 8)]
+        # Harder mask below the average size, easier above it, using the top
+        # bits of the hash (they depend on the last 64 bytes seen)
+        bits = avg_size.bit_length() - 1
+        self.mask_small = ((1 << (bits + 2)) - 1) << (64 - bits - 2)
+        self.mask_large = ((1 << (bits - 2)) - 1) << (64 - bits + 2)
+        self._gear_table = numpy.array(self.gear, dtype=numpy.uint64) if numpy is not None else None
+
+    def _cut_point(self, data: bytes, start: int = 0) -> int:
+        """Length of the chunk that starts at data[start]"""
+        size = len(data) - start
+        if size <= self.min_size:
+            return size
+        limit = min(size, self.max_size)
+        normal = min(limit, self.avg_size)
+        # Hashing starts at min_size (earlier bytes can never end a chunk), so
+        # the first 63 hashes cover fewer than 64 bytes: those go byte by byte
+        head = limit if self._gear_table is None else min(limit, self.min_size + GEAR_WINDOW - 1)
+        gear = self.gear
+        h = 0
+        i = self.min_size
+        while i < head:
+            h = ((h << 1) + gear[data[start + i]]) & HASH_MASK
+            i += 1
+            if not h & (self.mask_small if i <= normal else self.mask_large):
+                return i
+        for low, high, mask in ((i, normal, self.mask_small), (max(i, normal), limit, self.mask_large)):
+            for block in range(low, high, SCAN_BLOCK_SIZE):
+                hashes = self._window_hashes(data, start + block, min(high - block, SCAN_BLOCK_SIZE))
+                hits = numpy.flatnonzero((hashes & numpy.uint64(mask)) == 0)
+                if hits.size:
+                    return block + int(hits[0]) + 1
+        return limit
+
+    def _window_hashes(self, data: bytes, offset: int, count: int):
+        """Gear hash of the 64 bytes ending at each of data[offset:offset + count]"""
+        context = GEAR_WINDOW - 1
+        size = count + context
+        hashes = numpy.take(self._gear_table, numpy.frombuffer(data, numpy.uint8, size, offset - context))
+        shifted = numpy.empty(size, numpy.uint64)
+        # Each step doubles the bytes every hash covers: 1, 2, 4, ... 64
+        span = 1
+        while span < GEAR_WINDOW:
+            numpy.left_shift(hashes[:-span], numpy.uint64(span), out=shifted[:size - span])
+            numpy.add(hashes[span:], shifted[:size - span], out=hashes[span:])
+            span *= 2
+        return hashes[context:]
+
+    def chunks(self, f: BinaryIO) -> Iterator[bytes]:
+        buffer = b''
+        start = 0
+        eof = False
+        while True:
+            if not eof and len(buffer) - start < self.max_size:
+                # The unchunked tail is copied once per read, not once per chunk
+                pieces = [buffer[start:]]
+                available = len(buffer) - start
+                while not eof and available < self.max_size:
+                    data = f.read(self.max_size)
+                    eof = not data
+                    pieces.append(data)
+                    available += len(data)
+                buffer = b''.join(pieces)
+                start = 0
+            if start == len(buffer):
+                return
+            cut = self._cut_point(buffer, start)
+            yield buffer[start:start + cut]
+            start += cut
+
+
+class Repository:
+    """Content-addressed, encrypted chunk store with snapshot indexes"""
+
+    def __init__(self, path: Path, master_key: bytes, settings: Dict):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        self.path = path
+        self.settings = settings
+        self._aead = AESGCM(hkdf(master_key, b'pqbackup repository encryption'))
+        self._id_key = hkdf(master_key, b'pqbackup repository chunk id')
+        chunker = settings['chunker']
+        self.chunker = ContentDefinedChunker(
+            hkdf(master_key, b'pqbackup repository chunker', 256 * 8),
+            chunker['min_size'], chunker['avg_size'], chunker['max_size']
+        )
+        self.compression_level = settings.get('compression_level', 6)
+        self._known_chunks = None
+
+    @staticmethod
+    def _key_check(master_key: bytes) -> str:
+        return hmac.new(master_key, b'pqbackup repository key check', hashlib.sha256).hexdigest()
+
+    @classmethod
+    def init(cls, path: Path, password: str, kdf_type: bytes, compression_level: int = 6,
+             kdf_params: Optional[Tuple[int, int, int]] = None) -> 'Repository':
+        """Create an empty repository protected by password; kdf_params are kept in its config"""
+        salt = os.urandom(SALT_SIZE)
+        if kdf_params is not None:
+            check_kdf_params(kdf_params)
+        master_key = derive_key(password, kdf_type, salt, kdf_params)
+        settings = {
+            'version': REPOSITORY_VERSION,
+            'kdf': kdf_type.decode(),
+            'salt': salt.hex(),
+            'kdf_params': list(kdf_params) if kdf_params else None,
+            'chunker': {'min_size': MIN_CHUNK_SIZE, 'avg_size': AVG_CHUNK_SIZE, 'max_size': MAX_CHUNK_SIZE},
+            'compression_level': compression_level,
+            'key_check': cls._key_check(master_key),
+        }
+        (path / 'chunks').mkdir(parents=True, exist_ok=True)
+        (path / 'snapshots').mkdir(exist_ok=True)
+        with open(path / 'config', 'w') as f:
+            json.dump(settings, f, indent=2)
+        logger.info(f"Initialized repository: {path}")
+        return cls(path, master_key, settings)
+
+    @classmethod
+    def open(cls, path: Path, password: str) -> 'Repository':
+        config_path = path / 'config'
+        if not config_path.exists():
+            raise FileNotFoundError(f"Not a backup repository: {path}")
+        with open(config_path, 'r') as f:
+            settings = json.load(f)
+        if settings.get('version') != REPOSITORY_VERSION:
+            raise ValueError(f"Unsupported repository version: {settings.get('version')}")
+
+        kdf_params = tuple(settings['kdf_params']) if settings.get('kdf_params') else None
+        if kdf_params is not None:
+            check_kdf_params(kdf_params)
+        master_key = derive_key(password, settings['kdf'].encode(), bytes.fromhex(settings['salt']), kdf_params)
+        if not hmac.compare_digest(cls._key_check(master_key), settings['key_check']):
+            raise ValueError("Incorrect password for repository")
+        return cls(path, master_key, settings)
+
+    def _seal(self, plaintext: bytes, aad: bytes) -> bytes:
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self._aead.encrypt(nonce, zlib.compress(plaintext, self.compression_level), aad)
+
+    def _open(self, sealed: bytes, aad: bytes) -> bytes:
+        from cryptography.exceptions import InvalidTag
+
+        try:
+            return zlib.decompress(self._aead.decrypt(sealed[:NONCE_SIZE], sealed[NONCE_SIZE:], aad))
+        except InvalidTag:
+            raise ValueError(f"Authentication failed for repository object {aad.decode()}")
+
+    @staticmethod
+    def _write_atomic(path: Path, data: bytes):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def chunk_id(self, data: bytes) -> str:
+        return hmac.new(self._id_key, data, hashlib.sha256).hexdigest()
+
+    def chunk_path(self, chunk_id: str) -> Path:
+        return self.path / 'chunks' / chunk_id[:2] / chunk_id
+
+    def known_chunks(self) -> set:
+        if self._known_chunks is None:
+            self._known_chunks = {p.name for p in (self.path / 'chunks').glob('*/*') if not p.name.endswith('.tmp')}
+        return self._known_chunks
+
+    def store_chunk(self, data: bytes) -> Tuple[str, bool]:
+        """Store data unless already present; returns its id and whether it was new"""
+        chunk_id = self.chunk_id(data)
+        if chunk_id in self.known_chunks():
+            return chunk_id, False
+        self._write_atomic(self.chunk_path(chunk_id), self._seal(data, chunk_id.encode()))
+        self._known_chunks.add(chunk_id)
+        return chunk_id, True
+
+    def load_chunk(self, chunk_id: str) -> bytes:
+        with open(self.chunk_path(chunk_id), 'rb') as f:
+            return self._open(f.read(), chunk_id.encode())
+
+    def pending_uploads(self) -> List[str]:
+        """
+        Object paths (relative to the repository) written locally but not yet
+        confirmed uploaded. Chunks count as known as soon as they are on local
+        disk, so without this list a failed upload would never be retried.
+        """
+        path = self.path / PENDING_UPLOADS
+        if not path.exists():
+            return []
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def set_pending_uploads(self, objects: List[str]):
+        self._write_atomic(self.path / PENDING_UPLOADS, json.dumps(sorted(set(objects))).encode())
+
+    def list_snapshots(self) -> List[str]:
+        return sorted(p.name for p in (self.path / 'snapshots').iterdir() if not p.name.endswith('.tmp'))
+
+    def load_snapshot(self, name: str) -> Dict:
+        with open(self.path / 'snapshots' / name, 'rb') as f:
+            return json.loads(self._open(f.read(), f"snapshot:{name}".encode()))
+
+    def write_snapshot(self, name: str, snapshot: Dict) -> Path:
+        path = self.path / 'snapshots' / name
+        self._write_atomic(path, self._seal(json.dumps(snapshot).encode(), f"snapshot:{name}".encode()))
+        return path
+
+    def backup(self, files: List[Path], root_path: Path, name: str) -> Dict:
+        """
+        Chunk and store files, then write snapshot name.
+
+        Files whose size, mtime and inode match the latest snapshot reuse its
+        chunk list without being read. Returns counters plus the repository
+        objects written, for uploading.
+        """
+        parent = {}
+        snapshots = self.list_snapshots()
+        if snapshots:
+            parent = {entry['path']: entry for entry in self.load_snapshot(snapshots[-1])['files']}
+
+        stats = {'files': 0, 'reused_files': 0, 'chunks': 0, 'new_chunks': 0,
+                 'bytes_in': 0, 'bytes_new': 0, 'new_objects': []}
+        entries = []
+        for file_path in files:
+            try:
+                rel_path = file_path.relative_to(root_path).as_posix()
+                st = file_path.stat()
+                entry = {'path': rel_path, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                         'inode': st.st_ino, 'mode': st.st_mode & 0o7777}
+                previous = parent.get(rel_path)
+                if previous and all(previous.get(k) == entry[k] for k in ('size', 'mtime_ns', 'inode')) \
+                        and all(c in self.known_chunks() for c in previous['chunks']):
+                    entry['chunks'] = previous['chunks']
+                    stats['reused_files'] += 1
+                else:
+                    entry['chunks'] = []
+                    with open(file_path, 'rb') as f:
+                        for chunk in self.chunker.chunks(f):
+                            chunk_id, is_new = self.store_chunk(chunk)
+                            entry['chunks'].append(chunk_id)
+                            stats['chunks'] += 1
+                            if is_new:
+                                stats['new_chunks'] += 1
+                                stats['bytes_new'] += len(chunk)
+                                stats['new_objects'].append(self.chunk_path(chunk_id))
+            except (OSError, ValueError) as e:
+                logger.error(f"Failed to add {file_path}: {e}")
+                continue
+            entries.append(entry)
+            stats['files'] += 1
+            stats['bytes_in'] += entry['size']
+
+        snapshot = {'version': REPOSITORY_VERSION, 'name': name, 'root_path': str(root_path),
+                    'created': datetime.now().isoformat(), 'files': entries}
+        stats['new_objects'].append(self.write_snapshot(name, snapshot))
+        return stats
+
+    def restore(self, name: str, dest_dir: Path) -> int:
+        """Recreate every file of snapshot name under dest_dir"""
+        snapshot = self.load_snapshot(name)
+        abs_dest = os.path.abspath(dest_dir)
+        restored = 0
+        for entry in snapshot['files']:
+            # Same zip-slip protection as archive extraction
+            target = os.path.abspath(os.path.join(abs_dest, entry['path']))
+            if not target.startswith(abs_dest + os.sep):
+                raise ValueError(f"Snapshot contains unsafe path: {entry['path']}")
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as out:
+                for chunk_id in entry['chunks']:
+                    out.write(self.load_chunk(chunk_id))
+            os.chmod(target, entry['mode'])
+            os.utime(target, ns=(entry['mtime_ns'], entry['mtime_ns']))
+            restored += 1
+        return restored
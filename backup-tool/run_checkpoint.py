@@ -0,0 +1,251 @@
+"""
+Crash-safe backup runs for backup_tool.py
+
+An archive run keeps its progress in a hidden directory next to the output:
+
+    <output_dir>/.run-<backup_time>/
+        state.json      # stage, committed zip offset and encryption position
+        files.txt       # files selected for the archive
+        metadata.json   # metadata members (deleted paths, duplicates index)
+        manifest.json   # incremental manifest to save once the archive is done
+        entries.jsonl   # central directory records of the committed members
+
+The selection is frozen when the run starts, so a restarted run archives
+exactly what the first attempt meant to. While the archive is written, a
+checkpoint is committed every so often at a member boundary: the output is
+flushed and fsynced first, then the new central directory records are
+appended and synced, and state.json is replaced atomically last, so it never
+points past data that is on disk. A restarted run cuts the output back to the
+committed point, skips the members written before it and carries on.
+
+Encryption resumes only on a finished zip: the segments after a checkpoint
+are sealed again under the nonces they had before the crash, which is only
+safe for plaintext that cannot have changed in between. A pipeline run,
+whose zip is rebuilt from the live tree, keeps its selection but writes the
+encrypted archive again under a fresh header and nonce prefix.
+
+Output goes to <name>.partial and is renamed when the stage completes, so an
+interrupted run never leaves a file that looks like a finished archive.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from parallel_zip import ZipEntry, ZipStreamWriter
+
+logger = logging.getLogger(__name__)
+
+RUN_VERSION = 1
+RUN_PREFIX = '.run-'
+PARTIAL_SUFFIX = '.partial'
+DEFAULT_INTERVAL = 64 * 1024 * 1024
+
+STATE_FILE = 'state.json'
+FILE_LIST = 'files.txt'
+METADATA_FILE = 'metadata.json'
+MANIFEST_FILE = 'manifest.json'
+ENTRIES_FILE = 'entries.jsonl'
+
+
+def run_fingerprint(config: Dict) -> str:
+    """Hash of the settings an interrupted run must be resumed with"""
+    encryption = {key: value for key, value in config.get('encryption', {}).items()
+                  if key not in ('password', 'password_file')}
+    settings = json.dumps({'backup': config.get('backup', {}), 'encryption': encryption},
+                          sort_keys=True, default=str)
+    return hashlib.sha256(settings.encode()).hexdigest()
+
+
+def fsync_file(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _fsync_dir(path: Path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # Not supported everywhere (some network filesystems)
+        pass
+    finally:
+        os.close(fd)
+
+
+def commit_rename(partial_path: Path, final_path: Path):
+    """Move finished output into place; the rename survives a crash right after"""
+    os.replace(partial_path, final_path)
+    _fsync_dir(final_path.parent)
+
+
+class RunCheckpoint:
+    """Durable progress of one archive run"""
+
+    def __init__(self, directory: Path, state: Dict):
+        self.directory = directory
+        self.state = state
+        self._committed_entries = state['zip']['entries'] if state.get('zip') else 0
+
+    @classmethod
+    def start(cls, output_dir: Path, backup_time: str, fingerprint: str) -> 'RunCheckpoint':
+        directory = output_dir / f"{RUN_PREFIX}{backup_time}"
+        if directory.exists():
+            shutil.rmtree(directory)
+        directory.mkdir(mode=0o700, parents=True)
+        return cls(directory, {'version': RUN_VERSION, 'backup_time': backup_time,
+                               'fingerprint': fingerprint, 'stage': 'select', 'zip': None,
+                               'encryption': None})
+
+    @classmethod
+    def find(cls, output_dir: Path) -> Optional['RunCheckpoint']:
+        """The most recent interrupted run in output_dir, if any"""
+        runs = []
+        for directory in sorted(output_dir.glob(f"{RUN_PREFIX}*")) if output_dir.is_dir() else []:
+            try:
+                with open(directory / STATE_FILE, 'r') as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                logger.warning(f"Removing unusable run checkpoint: {directory}")
+                shutil.rmtree(directory, ignore_errors=True)
+                continue
+            if state.get('version') != RUN_VERSION:
+                logger.warning(f"Ignoring run checkpoint with unsupported version: {directory}")
+                continue
+            runs.append(cls(directory, state))
+        return runs[-1] if runs else None
+
+    @property
+    def backup_time(self) -> str:
+        return self.state['backup_time']
+
+    @property
+    def fingerprint(self) -> str:
+        return self.state['fingerprint']
+
+    @property
+    def stage(self) -> str:
+        return self.state['stage']
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.directory / MANIFEST_FILE
+
+    def partial_names(self) -> List[str]:
+        """Unfinished output the run may have left in the output directory (including the plaintext zip)"""
+        zip_name = f"backup_{self.backup_time}.zip"
+        return [zip_name, zip_name + PARTIAL_SUFFIX, zip_name + '.encrypted' + PARTIAL_SUFFIX]
+
+    def save_selection(self, files: List[Path], metadata_members: Dict[str, bytes]):
+        with open(self.directory / FILE_LIST, 'w', encoding='utf-8', errors='surrogateescape') as f:
+            for file_path in files:
+                f.write(f"{file_path}\n")
+            fsync_file(f)
+        with open(self.directory / METADATA_FILE, 'w') as f:
+            json.dump({name: data.hex() for name, data in metadata_members.items()}, f)
+            fsync_file(f)
+        self.set_stage('archive')
+
+    def load_selection(self) -> Tuple[List[Path], Dict[str, bytes]]:
+        with open(self.directory / FILE_LIST, 'r', encoding='utf-8', errors='surrogateescape') as f:
+            files = [Path(line.rstrip('\n')) for line in f if line.strip()]
+        with open(self.directory / METADATA_FILE, 'r') as f:
+            metadata_members = {name: bytes.fromhex(data) for name, data in json.load(f).items()}
+        return files, metadata_members
+
+    def reset_output(self):
+        """Forget committed progress (the partial output is gone); the stage starts over"""
+        self.state['zip'] = None
+        self.state['encryption'] = None
+        self._committed_entries = 0
+        if (self.directory / ENTRIES_FILE).exists():
+            os.remove(self.directory / ENTRIES_FILE)
+        self._save()
+
+    def set_stage(self, stage: str):
+        self.state['stage'] = stage
+        self._save()
+
+    def zip_writer(self, fileobj) -> ZipStreamWriter:
+        """Writer continuing the committed members; fileobj must already sit at the committed offset"""
+        committed = self.state.get('zip')
+        if not committed:
+            return ZipStreamWriter(fileobj)
+        entries = []
+        with open(self.directory / ENTRIES_FILE, 'r+', encoding='utf-8') as f:
+            # Records appended after the last commit are dropped
+            f.truncate(committed['entries_bytes'])
+            for line in f:
+                entries.append(ZipEntry.from_dict(json.loads(line)))
+        if len(entries) != committed['entries']:
+            raise ValueError(f"Run checkpoint {self.directory} lists {len(entries)} members, "
+                             f"expected {committed['entries']}")
+        return ZipStreamWriter(fileobj, committed['offset'], entries)
+
+    @property
+    def zip_offset(self) -> int:
+        return self.state['zip']['offset'] if self.state.get('zip') else 0
+
+    def done_members(self) -> Set[str]:
+        """Archive names of the members that are already committed"""
+        if not self.state.get('zip'):
+            return set()
+        with open(self.directory / ENTRIES_FILE, 'r', encoding='utf-8') as f:
+            return {json.loads(line)['name'] for line in f.read(self.state['zip']['entries_bytes']).splitlines()}
+
+    def commit_zip(self, writer: ZipStreamWriter):
+        """Record the members written so far; the output must be synced already"""
+        new_entries = writer.entries[self._committed_entries:]
+        with open(self.directory / ENTRIES_FILE, 'a', encoding='utf-8') as f:
+            for entry in new_entries:
+                f.write(json.dumps(entry.to_dict()) + '\n')
+            fsync_file(f)
+            entries_bytes = f.tell()
+        self._committed_entries = len(writer.entries)
+        self.state['zip'] = {'offset': writer.offset, 'entries': self._committed_entries,
+                             'entries_bytes': entries_bytes}
+        self._save()
+
+    @property
+    def encryption(self) -> Optional[Tuple[int, bytes]]:
+        """(segments written, sealed buffer) of the encrypted output, as EncryptingWriter.checkpoint() gave it"""
+        committed = self.state.get('encryption')
+        if not committed:
+            return None
+        return committed['segments'], bytes.fromhex(committed['buffer'])
+
+    def commit_encryption(self, position: Tuple[int, bytes]):
+        """
+        Record an encryption position; the output must be synced already.
+        Only for encrypting a finished zip, whose plaintext cannot change
+        before the resume seals it again under the same nonces.
+        """
+        segments, sealed_buffer = position
+        self.state['encryption'] = {'segments': segments, 'buffer': sealed_buffer.hex()}
+        self._save()
+
+    def _save(self):
+        tmp_path = self.directory / (STATE_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+            fsync_file(f)
+        os.replace(tmp_path, self.directory / STATE_FILE)
+        _fsync_dir(self.directory)
+
+    def discard(self):
+        """Remove the checkpoint and the run's unfinished output"""
+        output_dir = self.directory.parent
+        for name in self.partial_names():
+            if (output_dir / name).exists():
+                os.remove(output_dir / name)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def finish(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
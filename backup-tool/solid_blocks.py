@@ -0,0 +1,163 @@
+"""
+Solid packing of small files for backup_tool.py
+
+Home directories hold huge numbers of tiny files, and as separate zip members
+each one pays for its own local header, central directory record and deflate
+stream (which starts with an empty dictionary and compresses a few hundred
+bytes badly). The packer concatenates small files into large block members
+so they share one compression stream:
+
+    .backup-solid/000000.blk      # file contents back to back
+    .backup-solid/000001.blk
+    .backup-solid-index.json      # path -> block, offset, size, mtime, mode
+
+Files above the size limit stay regular zip members. Small files are grouped
+by extension before packing, which puts similar content next to each other.
+The index makes single files readable without unpacking whole blocks into
+the destination.
+"""
+
+import json
+import logging
+import os
+import stat
+import zipfile
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+SOLID_INDEX_MEMBER = '.backup-solid-index.json'
+SOLID_BLOCK_PREFIX = '.backup-solid/'
+SOLID_INDEX_VERSION = 1
+
+DEFAULT_BLOCK_SIZE = 16 * 1024 * 1024
+DEFAULT_MAX_FILE_SIZE = 128 * 1024
+
+
+class SolidPacker:
+    """Turn (path, arcname) members into large files plus solid blocks and an index"""
+
+    def __init__(self, block_size: int = DEFAULT_BLOCK_SIZE, max_file_size: int = DEFAULT_MAX_FILE_SIZE):
+        if max_file_size > block_size:
+            raise ValueError("Solid file size limit must not exceed the block size")
+        self.block_size = block_size
+        self.max_file_size = max_file_size
+        self.files_packed = 0
+        self.blocks_written = 0
+        self.bytes_packed = 0
+        # Archive names of files that could not be read
+        self.failed: List[str] = []
+
+    def pack(self, members: Iterable[Tuple[Path, str]]) -> Iterator[Tuple[Union[Path, bytes], str]]:
+        """
+        Yield archive members: large files as (path, arcname), then solid
+        blocks and finally the index as (bytes, arcname).
+        """
+        small: List[Tuple[Path, str, os.stat_result]] = []
+        for path, arcname in members:
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                logger.error(f"Failed to add {path}: {e}")
+                self.failed.append(arcname)
+                continue
+            if stat.S_ISREG(st.st_mode) and st.st_size <= self.max_file_size:
+                small.append((path, arcname, st))
+            else:
+                yield path, arcname
+
+        small.sort(key=lambda m: (os.path.splitext(m[1])[1].lower(), m[1]))
+        files = []
+        block = bytearray()
+        for path, arcname, st in small:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError as e:
+                logger.error(f"Failed to add {path}: {e}")
+                self.failed.append(arcname)
+                continue
+            if block and len(block) + len(data) > self.block_size:
+                yield self._flush(block)
+                block = bytearray()
+            files.append({'path': arcname, 'block': self.blocks_written, 'offset': len(block),
+                          'size': len(data), 'mtime': st.st_mtime, 'mode': st.st_mode & 0o7777})
+            block += data
+            self.files_packed += 1
+            self.bytes_packed += len(data)
+        if block:
+            yield self._flush(block)
+
+        index = {'version': SOLID_INDEX_VERSION, 'blocks': self.blocks_written, 'files': files}
+        yield json.dumps(index).encode(), SOLID_INDEX_MEMBER
+
+    def _flush(self, block: bytearray) -> Tuple[bytes, str]:
+        name = block_name(self.blocks_written)
+        self.blocks_written += 1
+        return bytes(block), name
+
+
+def block_name(number: int) -> str:
+    return f"{SOLID_BLOCK_PREFIX}{number:06d}.blk"
+
+
+def load_index(zf: zipfile.ZipFile) -> Dict[str, Dict]:
+    """Solid index of an open archive as {path: entry}; empty if it has none"""
+    try:
+        return parse_index(zf.read(SOLID_INDEX_MEMBER))
+    except KeyError:
+        return {}
+
+
+def parse_index(data: bytes) -> Dict[str, Dict]:
+    index = json.loads(data)
+    if index.get('version') != SOLID_INDEX_VERSION:
+        raise ValueError(f"Unsupported solid index version: {index.get('version')}")
+    return {entry['path']: entry for entry in index['files']}
+
+
+def read_file(zf: zipfile.ZipFile, index: Dict[str, Dict], path: str) -> bytes:
+    """Contents of one file, whether it is a regular member or packed in a block"""
+    entry = index.get(path)
+    if entry is None:
+        return zf.read(path)
+    with zf.open(block_name(entry['block'])) as block:
+        # Decompression is sequential, so seeking reads up to the offset
+        block.seek(entry['offset'])
+        return block.read(entry['size'])
+
+
+def is_solid_member(name: str) -> bool:
+    return name == SOLID_INDEX_MEMBER or name.startswith(SOLID_BLOCK_PREFIX)
+
+
+def extract_solid(zf: zipfile.ZipFile, dest_dir: str, paths: Optional[Iterable[str]] = None) -> int:
+    """
+    Unpack every file listed in the solid index (or just the given paths)
+    into dest_dir, reading each block once. Returns the number of files written.
+    """
+    index = load_index(zf)
+    if paths is not None:
+        index = {path: index[path] for path in paths if path in index}
+    return unpack_files(index, lambda number: zf.read(block_name(number)), dest_dir)
+
+
+def unpack_files(index: Dict[str, Dict], read_block: Callable[[int], bytes], dest_dir: str) -> int:
+    """Write the files of a solid index using read_block(number) for block contents"""
+    abs_dest = os.path.abspath(dest_dir)
+    entries = sorted(index.values(), key=lambda e: (e['block'], e['offset']))
+    current, data = None, b''
+    for entry in entries:
+        # Same zip-slip protection as regular members
+        target = os.path.abspath(os.path.join(abs_dest, entry['path']))
+        if not target.startswith(abs_dest + os.sep):
+            raise ValueError(f"Solid index contains unsafe path: {entry['path']}")
+        if entry['block'] != current:
+            current, data = entry['block'], read_block(entry['block'])
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as out:
+            out.write(data[entry['offset']:entry['offset'] + entry['size']])
+        os.chmod(target, entry['mode'])
+        os.utime(target, (entry['mtime'], entry['mtime']))
+    return len(entries)
@@ -0,0 +1,342 @@
+"""
+Streaming zip extraction for decrypt_backup.py
+
+Restores an archive straight from the decrypted stream instead of writing the
+zip to disk and reopening it. Members are parsed from their local headers as
+they arrive, so the central directory at the end is never needed:
+
+- a deflated member ends where its deflate stream ends
+- a stored member with a data descriptor ends at the first descriptor whose
+  CRC and sizes match the bytes seen so far
+- every path is checked against the destination before anything is written,
+  and every member's CRC is verified
+
+The central directory is only read to list the members it holds: a member
+whose source failed while the archive was written is left out of it, and
+what was extracted for it is removed again once the stream ends.
+
+Small files are buffered and written by a thread pool while parsing moves
+on; large files are written as they are decompressed. Solid blocks are
+spooled under the destination and unpacked through the index, which is the
+last member, once the stream ends; duplicate references are recreated after
+that.
+"""
+
+import logging
+import os
+import shutil
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Iterable, List, Optional, Set, Tuple
+
+from duplicates import DUPLICATES_MEMBER, parse_references, restore_duplicates
+from parallel_zip import CENTRAL_HEADER, FLAG_DATA_DESCRIPTOR, LOCAL_HEADER, ZIP_DEFLATED, ZIP_STORED
+from solid_blocks import SOLID_BLOCK_PREFIX, SOLID_INDEX_MEMBER, block_name, parse_index, unpack_files
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 1024 * 1024
+SMALL_FILE_LIMIT = 4 * 1024 * 1024  # larger members are written by the parsing thread
+MAX_PENDING_BYTES = 64 * 1024 * 1024  # file data waiting in the write queue
+
+LOCAL_SIGNATURE = b'PK\x03\x04'
+DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+CENTRAL_SIGNATURES = (b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06')
+FLAG_UTF8 = 0x800
+ZIP64_EXTRA = 0x0001
+DESCRIPTOR = struct.Struct('<4sLLL')
+DESCRIPTOR64 = struct.Struct('<4sLQQ')
+
+
+class _StreamReader:
+    """Byte-level reads over an iterator of decrypted blocks"""
+
+    def __init__(self, blocks: Iterable[bytes]):
+        self._blocks = iter(blocks)
+        self._buffer = bytearray()
+
+    def _more(self) -> bool:
+        for block in self._blocks:
+            if block:
+                self._buffer += block
+                return True
+        return False
+
+    def peek(self, size: int) -> bytes:
+        while len(self._buffer) < size and self._more():
+            pass
+        return bytes(self._buffer[:size])
+
+    def read(self, size: int) -> bytes:
+        data = self.peek(size)
+        if len(data) < size:
+            raise ValueError("Archive stream ends in the middle of a zip member")
+        del self._buffer[:size]
+        return data
+
+    def read_some(self, limit: int) -> bytes:
+        if not self._buffer and not self._more():
+            raise ValueError("Archive stream ends in the middle of a zip member")
+        data = bytes(self._buffer[:limit])
+        del self._buffer[:len(data)]
+        return data
+
+    def central_names(self) -> Set[str]:
+        """Read the central directory headers, returning the member names listed"""
+        names = set()
+        while self.peek(4) == CENTRAL_SIGNATURES[0]:
+            fields = CENTRAL_HEADER.unpack(self.read(CENTRAL_HEADER.size))
+            flags, name_len, extra_len, comment_len = fields[5], fields[12], fields[13], fields[14]
+            names.add(self.read(name_len).decode('utf-8' if flags & FLAG_UTF8 else 'cp437'))
+            self.read(extra_len + comment_len)
+        return names
+
+    def unread(self, data: bytes):
+        self._buffer[:0] = data
+
+    def drain(self):
+        """Consume the rest of the stream, which authenticates every remaining segment"""
+        self._buffer = bytearray()
+        for _ in self._blocks:
+            pass
+
+    def read_sized(self, size: int, emit: Callable[[bytes], None]):
+        while size:
+            data = self.read_some(min(size, READ_SIZE))
+            emit(data)
+            size -= len(data)
+
+    def read_deflated(self, emit: Callable[[bytes], None]) -> int:
+        """Inflate one raw deflate stream, returning its compressed size"""
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        compressed = 0
+        while not decompressor.eof:
+            data = self.read_some(READ_SIZE)
+            compressed += len(data)
+            # Bounded output per call, so a highly compressed member cannot balloon memory
+            emit(decompressor.decompress(data, READ_SIZE))
+            while decompressor.unconsumed_tail and not decompressor.eof:
+                emit(decompressor.decompress(decompressor.unconsumed_tail, READ_SIZE))
+        self.unread(decompressor.unused_data)
+        return compressed - len(decompressor.unused_data)
+
+    def read_stored_until_descriptor(self, descriptor: struct.Struct,
+                                     emit: Callable[[bytes], None]) -> Tuple[int, int]:
+        """
+        Stream a stored member whose size is only in the data descriptor that
+        follows it. Returns (crc, size) from the descriptor.
+        """
+        crc = size = start = 0
+        while True:
+            pos = self._buffer.find(DESCRIPTOR_SIGNATURE, start)
+            if pos != -1 and pos + descriptor.size <= len(self._buffer):
+                _, stored_crc, compress_size, file_size = descriptor.unpack_from(self._buffer, pos)
+                if (compress_size == file_size == size + pos
+                        and stored_crc == zlib.crc32(self._buffer[:pos], crc)):
+                    emit(bytes(self._buffer[:pos]))
+                    del self._buffer[:pos + descriptor.size]
+                    return stored_crc, file_size
+                # Signature bytes inside the file data
+                start = pos + 1
+                continue
+            # Pass on everything that cannot be part of a descriptor yet
+            cut = pos if pos != -1 else max(len(self._buffer) - len(DESCRIPTOR_SIGNATURE) + 1, 0)
+            if cut:
+                data = bytes(self._buffer[:cut])
+                del self._buffer[:cut]
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                emit(data)
+            start = 0
+            if not self._more():
+                raise ValueError("Archive stream ends in the middle of a zip member")
+
+
+class _MemberWriter:
+    """Collect a member's data; small members go to the pool, large ones straight to disk"""
+
+    def __init__(self, target: str):
+        self.target = target
+        self.crc = 0
+        self.size = 0
+        self._chunks = []
+        self._file = None
+
+    def write(self, data: bytes):
+        if not data:
+            return
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        if self._file is not None:
+            self._file.write(data)
+            return
+        self._chunks.append(data)
+        if self.size > SMALL_FILE_LIMIT:
+            self._file = open(self.target, 'wb')
+            self._file.write(b''.join(self._chunks))
+            self._chunks = []
+
+    def finish(self) -> Optional[bytes]:
+        """Close a file written in place, or return the buffered data for the pool"""
+        if self._file is not None:
+            self._file.close()
+            return None
+        return b''.join(self._chunks)
+
+
+def _write_file(target: str, data: bytes):
+    with open(target, 'wb') as f:
+        f.write(data)
+
+
+class StreamExtractor:
+    """Extract a zip arriving as a stream of blocks into dest_dir"""
+
+    def __init__(self, dest_dir: str, workers: int = 0):
+        self.dest_dir = dest_dir
+        self._abs_dest = os.path.abspath(dest_dir)
+        self.workers = workers or os.cpu_count() or 1
+        self.files_written = 0
+        self.bytes_written = 0
+        self._pending: Deque[Tuple[Future, int]] = deque()
+        self._pending_bytes = 0
+        self._extracted: List[Tuple[str, str, int]] = []
+
+    def _target(self, name: str) -> str:
+        # Zip-slip protection: checked as each member arrives, before anything is written
+        target = os.path.abspath(os.path.join(self._abs_dest, name))
+        if not (target == self._abs_dest or target.startswith(self._abs_dest + os.sep)):
+            logger.error(f"Zip contains unsafe path, aborting extraction: {name}")
+            raise ValueError("Unsafe zip entry detected")
+        return target
+
+    def _drain(self, limit: int):
+        """Wait for queued writes until at most limit bytes are pending; 0 waits for all, empty files too"""
+        while self._pending and (self._pending_bytes > limit or not limit):
+            future, size = self._pending.popleft()
+            future.result()
+            self._pending_bytes -= size
+
+    def extract(self, blocks: Iterable[bytes]) -> int:
+        """Returns the number of files written, solid-packed files included"""
+        reader = _StreamReader(blocks)
+        os.makedirs(self.dest_dir, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            try:
+                while reader.peek(4) == LOCAL_SIGNATURE:
+                    self._extract_member(reader, pool)
+                if reader.peek(4) not in CENTRAL_SIGNATURES:
+                    raise ValueError("Archive stream is not a zip or has a corrupt member")
+                listed = reader.central_names()
+                reader.drain()
+                self._drain(0)
+            finally:
+                for future, _ in self._pending:
+                    future.cancel()
+        self._remove_unlisted(listed)
+        return self.files_written + self._unpack_solid() + self._restore_duplicates()
+
+    def _extract_member(self, reader: _StreamReader, pool: ThreadPoolExecutor):
+        (_, _, _, flags, method, _, _, crc, compress_size, file_size,
+         name_len, extra_len) = LOCAL_HEADER.unpack(reader.read(LOCAL_HEADER.size))
+        name = reader.read(name_len).decode('utf-8' if flags & FLAG_UTF8 else 'cp437')
+        extra = reader.read(extra_len)
+        zip64 = False
+        pos = 0
+        while pos + 4 <= len(extra):
+            tag, length = struct.unpack_from('<HH', extra, pos)
+            if tag == ZIP64_EXTRA:
+                zip64 = True
+                # Only the sizes stored as 0xFFFFFFFF appear, in this order
+                values = iter(struct.unpack_from(f'<{length // 8}Q', extra, pos + 4))
+                if file_size == 0xFFFFFFFF:
+                    file_size = next(values, file_size)
+                if compress_size == 0xFFFFFFFF:
+                    compress_size = next(values, compress_size)
+            pos += 4 + length
+        if method not in (ZIP_STORED, ZIP_DEFLATED):
+            raise ValueError(f"Unsupported compression method {method} for {name}")
+
+        target = self._target(name)
+        if name.endswith('/'):
+            os.makedirs(target, exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+        writer = _MemberWriter(target)
+
+        if flags & FLAG_DATA_DESCRIPTOR:
+            descriptor = DESCRIPTOR64 if zip64 else DESCRIPTOR
+            if method == ZIP_STORED:
+                crc, file_size = reader.read_stored_until_descriptor(descriptor, writer.write)
+            else:
+                compress_size = reader.read_deflated(writer.write)
+                # The descriptor signature is optional in the zip spec
+                if reader.peek(4) != DESCRIPTOR_SIGNATURE:
+                    reader.unread(DESCRIPTOR_SIGNATURE)
+                _, crc, stored_size, file_size = descriptor.unpack(reader.read(descriptor.size))
+                if stored_size != compress_size:
+                    raise ValueError(f"Bad data descriptor for {name}")
+        elif method == ZIP_STORED:
+            reader.read_sized(compress_size, writer.write)
+        else:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            reader.read_sized(compress_size, lambda data: writer.write(decompressor.decompress(data)))
+            writer.write(decompressor.flush())
+
+        if writer.crc != crc or writer.size != file_size:
+            raise ValueError(f"CRC or size mismatch for {name}")
+        data = writer.finish()
+        if name.endswith('/'):
+            return
+        if data is not None:
+            self._pending.append((pool.submit(_write_file, target, data), len(data)))
+            self._pending_bytes += len(data)
+            self._drain(MAX_PENDING_BYTES)
+        if not (name in (SOLID_INDEX_MEMBER, DUPLICATES_MEMBER) or name.startswith(SOLID_BLOCK_PREFIX)):
+            self.files_written += 1
+            self.bytes_written += writer.size
+            self._extracted.append((name, target, writer.size))
+
+    def _remove_unlisted(self, listed: Set[str]):
+        """Remove members missing from the central directory: their source failed mid-write"""
+        for name, target, size in self._extracted:
+            if name in listed:
+                continue
+            logger.warning(f"Skipping {name}: abandoned while the archive was written")
+            os.remove(target)
+            self.files_written -= 1
+            self.bytes_written -= size
+
+    def _unpack_solid(self) -> int:
+        """Split spooled solid blocks into files, then remove the blocks and index"""
+        index_path = os.path.join(self.dest_dir, SOLID_INDEX_MEMBER)
+        if not os.path.exists(index_path):
+            return 0
+        with open(index_path, 'rb') as f:
+            index = parse_index(f.read())
+
+        def read_block(number: int) -> bytes:
+            with open(os.path.join(self.dest_dir, block_name(number)), 'rb') as block:
+                return block.read()
+
+        unpacked = unpack_files(index, read_block, self.dest_dir)
+        self.bytes_written += sum(entry['size'] for entry in index.values())
+        os.remove(index_path)
+        shutil.rmtree(os.path.join(self.dest_dir, SOLID_BLOCK_PREFIX), ignore_errors=True)
+        return unpacked
+
+    def _restore_duplicates(self) -> int:
+        """Recreate paths stored as references to identical files, then remove the index"""
+        index_path = os.path.join(self.dest_dir, DUPLICATES_MEMBER)
+        if not os.path.exists(index_path):
+            return 0
+        with open(index_path, 'rb') as f:
+            references = parse_references(f.read())
+        os.remove(index_path)
+        restored = restore_duplicates(references, self.dest_dir)
+        self.bytes_written += sum(os.path.getsize(target) for target in
+                                  (os.path.join(self.dest_dir, path) for path in references)
+                                  if os.path.exists(target))
+        return restored
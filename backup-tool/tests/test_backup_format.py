@@ -0,0 +1,254 @@
+import io
+import json
+import os
+import struct
+
+import backup_format
+import pytest
+from backup_format import (
+    CIPHER_AES_GCM, CIPHER_CHACHA20, CIPHERS, FIELD_CIPHER, FIELD_KDF_PARAMS, HASH_SIZE, KDF_PARAMS_FORMAT, SALT_SIZE,
+    TAG_SIZE, TRAILER_FOOTER_SIZE, ContainerHeader, EncryptingWriter, KeyCache, SegmentReader, iter_decrypted_segments
+)
+from backup_tool import BackupConfig, BackupManager
+
+KEY = bytes(range(32))
+SEGMENT_SIZE = 1024
+
+
+def encrypt(data, **options):
+    header = ContainerHeader.create(b'ARGON2ID', SEGMENT_SIZE, **options)
+    out = io.BytesIO()
+    with EncryptingWriter(out, KEY, header) as writer:
+        writer.write(data)
+    return out.getvalue()
+
+
+def decrypt(archive, key=KEY):
+    f = io.BytesIO(archive)
+    header = ContainerHeader.read(f)
+    return b''.join(iter_decrypted_segments(f, key, header))
+
+
+def header_size(archive):
+    return len(ContainerHeader.read(io.BytesIO(archive)).raw)
+
+
+def header_fields(header):
+    """Tags of the TLV records in a serialized header"""
+    fields = header.raw[12:]
+    tags = []
+    while fields:
+        tags.append(fields[0])
+        fields = fields[3 + int.from_bytes(fields[1:3], 'big'):]
+    return tags
+
+
+@pytest.mark.parametrize('cipher', CIPHERS)
+@pytest.mark.parametrize('hash_tree', [True, False])
+@pytest.mark.parametrize('size', [0, 1, SEGMENT_SIZE, 5 * SEGMENT_SIZE + 17])
+def test_round_trip(size, hash_tree, cipher):
+    data = os.urandom(size)
+    assert decrypt(encrypt(data, hash_tree=hash_tree, cipher=cipher)) == data
+
+
+def test_header_round_trip():
+    header = ContainerHeader.create(b'ARGON2ID', SEGMENT_SIZE)
+    parsed = ContainerHeader.read(io.BytesIO(header.raw + b'segments'))
+    assert (parsed.kdf_type, parsed.salt, parsed.nonce_prefix, parsed.segment_size) == \
+        (header.kdf_type, header.salt, header.nonce_prefix, SEGMENT_SIZE)
+    assert parsed.raw == header.raw
+
+
+@pytest.mark.parametrize('offset, length', [
+    (0, 10), (SEGMENT_SIZE - 10, 30), (2 * SEGMENT_SIZE, SEGMENT_SIZE), (5 * SEGMENT_SIZE, 100), (0, -1),
+])
+def test_segment_reader_reads_any_range(offset, length):
+    data = os.urandom(5 * SEGMENT_SIZE + 17)
+    f = io.BytesIO(encrypt(data))
+    reader = SegmentReader(f, KEY, ContainerHeader.read(f))
+    reader.seek(offset)
+    expected = data[offset:] if length < 0 else data[offset:offset + length]
+    assert reader.read(length) == expected
+
+
+def test_wrong_key_fails():
+    with pytest.raises(ValueError, match='Authentication failed'):
+        decrypt(encrypt(b'secret'), key=bytes(32))
+
+
+@pytest.mark.parametrize('hash_tree', [True, False])
+def test_truncation_at_segment_boundary_is_detected(hash_tree):
+    archive = encrypt(os.urandom(3 * SEGMENT_SIZE + 5), hash_tree=hash_tree)
+    # Whole non-final segments only: the cut-off stream has no final segment
+    truncated = archive[:header_size(archive) + 2 * (SEGMENT_SIZE + TAG_SIZE)]
+    with pytest.raises(ValueError):
+        decrypt(truncated)
+
+
+@pytest.mark.parametrize('cut', [40, HASH_SIZE + TRAILER_FOOTER_SIZE])
+def test_dropped_trailer_is_detected(cut):
+    archive = encrypt(os.urandom(3 * SEGMENT_SIZE), hash_tree=True)
+    with pytest.raises(ValueError):
+        decrypt(archive[:-cut])
+
+
+def test_damaged_trailer_still_decrypts():
+    data = os.urandom(3 * SEGMENT_SIZE)
+    archive = bytearray(encrypt(data, hash_tree=True))
+    # The trailer is not authenticated, only checked by verify_backup.py
+    archive[-TRAILER_FOOTER_SIZE - 1] ^= 1
+    assert decrypt(bytes(archive)) == data
+
+
+def test_tampered_segment_is_detected():
+    archive = bytearray(encrypt(os.urandom(3 * SEGMENT_SIZE)))
+    archive[header_size(archive) + SEGMENT_SIZE + TAG_SIZE + 3] ^= 1
+    with pytest.raises(ValueError, match='segment 1'):
+        decrypt(bytes(archive))
+
+
+def test_header_is_bound_to_the_segments():
+    archive = encrypt(b'payload')
+    header = ContainerHeader.read(io.BytesIO(archive))
+    # The key is the same, only the header bytes (the associated data) differ
+    forged = ContainerHeader(header.kdf_type, os.urandom(len(header.salt)), header.nonce_prefix, header.segment_size)
+    with pytest.raises(ValueError, match='Authentication failed'):
+        decrypt(forged.raw + archive[len(header.raw):])
+
+
+def test_not_a_container_is_rejected():
+    with pytest.raises(ValueError, match='Not a PQBACKUP file'):
+        ContainerHeader.read(io.BytesIO(b'PK\x03\x04 plain zip'))
+
+
+def test_key_hierarchy_runs_the_kdf_once_per_master_salt():
+    keys = KeyCache('password')
+    params = (1, 8, 1)
+    master_salt = os.urandom(SALT_SIZE)
+    first = ContainerHeader.create(b'ARGON2ID', master_salt=master_salt, kdf_params=params)
+    second = ContainerHeader.create(b'ARGON2ID', master_salt=master_salt, kdf_params=params)
+    standalone = ContainerHeader.create(b'ARGON2ID', kdf_params=params)
+
+    first_key = keys.archive_key(first)
+    second_key = keys.archive_key(second)
+    assert keys.kdf_runs == 1
+    # Each archive still gets its own key from its subkey salt
+    assert first_key != second_key
+    assert KeyCache('password').archive_key(first) == first_key
+
+    keys.archive_key(standalone)
+    assert keys.kdf_runs == 2
+    assert KeyCache('other password').archive_key(first) != first_key
+
+
+def test_cipher_field_only_for_chacha():
+    aes = ContainerHeader.create(b'ARGON2ID', cipher=CIPHER_AES_GCM)
+    chacha = ContainerHeader.create(b'ARGON2ID', cipher=CIPHER_CHACHA20)
+    assert FIELD_CIPHER not in header_fields(aes)
+    assert FIELD_CIPHER in header_fields(chacha)
+    assert ContainerHeader.read(io.BytesIO(aes.raw)).cipher == CIPHER_AES_GCM
+    assert ContainerHeader.read(io.BytesIO(chacha.raw)).cipher == CIPHER_CHACHA20
+
+
+def test_unknown_cipher_is_rejected():
+    with pytest.raises(ValueError, match='Unsupported cipher'):
+        ContainerHeader.create(b'ARGON2ID', cipher='rot13')
+
+
+def test_cipher_is_bound_to_the_segments():
+    archive = encrypt(b'payload', cipher=CIPHER_CHACHA20)
+    header = ContainerHeader.read(io.BytesIO(archive))
+    # Dropping the cipher field makes the header claim AES-GCM for ChaCha20 segments
+    forged = ContainerHeader(header.kdf_type, header.salt, header.nonce_prefix, header.segment_size)
+    with pytest.raises(ValueError, match='Authentication failed'):
+        decrypt(forged.raw + archive[len(header.raw):])
+
+
+@pytest.mark.parametrize('aes, chacha, expected', [
+    (1000.0, 1050.0, CIPHER_AES_GCM),
+    (1000.0, 900.0, CIPHER_AES_GCM),
+    (300.0, 900.0, CIPHER_CHACHA20),
+])
+def test_chacha_is_chosen_only_when_clearly_faster(monkeypatch, aes, chacha, expected):
+    monkeypatch.setattr(backup_format, '_fastest_cipher', None)
+    measured = []
+
+    def throughput():
+        measured.append(1)
+        return {CIPHER_AES_GCM: aes, CIPHER_CHACHA20: chacha}
+
+    monkeypatch.setattr(backup_format, 'cipher_throughput', throughput)
+    assert backup_format.fastest_cipher() == expected
+    # Measured once per process
+    assert backup_format.fastest_cipher() == expected and len(measured) == 1
+
+
+@pytest.mark.parametrize('configured, expected', [
+    (CIPHER_CHACHA20, CIPHER_CHACHA20), (CIPHER_AES_GCM, CIPHER_AES_GCM), ('rot13', None),
+])
+def test_configured_cipher_is_validated(tmp_path, configured, expected):
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({'encryption': {'cipher': configured}}))
+    manager = BackupManager(BackupConfig(str(config_path)))
+    if expected is None:
+        with pytest.raises(ValueError, match="Unknown cipher 'rot13'"):
+            manager.cipher()
+    else:
+        assert manager.cipher() == expected
+
+
+def test_kdf_params_round_trip():
+    header = ContainerHeader.create(b'ARGON2ID', kdf_params=(2, 131072, 8))
+    assert FIELD_KDF_PARAMS in header_fields(header)
+    assert ContainerHeader.read(io.BytesIO(header.raw)).kdf_params == (2, 131072, 8)
+    assert FIELD_KDF_PARAMS not in header_fields(ContainerHeader.create(b'ARGON2ID'))
+
+
+@pytest.mark.parametrize('kdf_type, kdf_params', [
+    (b'ARGON2ID', (0, 65536, 4)),
+    (b'ARGON2ID', (3, 64 * 1024 * 1024, 4)),
+    (b'PBKDF2', (3, 65536, 4)),
+])
+def test_bad_kdf_params_are_rejected(kdf_type, kdf_params):
+    with pytest.raises(ValueError):
+        ContainerHeader.create(kdf_type, kdf_params=kdf_params)
+
+
+def test_crafted_kdf_params_are_rejected_on_read():
+    raw = ContainerHeader.create(b'ARGON2ID', kdf_params=(2, 131072, 8)).raw
+    # A header asking for 64 GiB would make the KDF allocate it before authentication fails
+    crafted = raw.replace(struct.pack(KDF_PARAMS_FORMAT, 2, 131072, 8), struct.pack(KDF_PARAMS_FORMAT, 2, 1 << 26, 8))
+    with pytest.raises(ValueError, match='out of range'):
+        ContainerHeader.read(io.BytesIO(crafted))
+
+
+def test_resume_from_checkpoint():
+    data = os.urandom(6 * SEGMENT_SIZE + 100)
+    header = ContainerHeader.create(b'ARGON2ID', SEGMENT_SIZE, hash_tree=True)
+    out = io.BytesIO()
+    writer = EncryptingWriter(out, KEY, header)
+    split = 2 * SEGMENT_SIZE + 300
+    writer.write(data[:split])
+    checkpoint = writer.checkpoint()
+    # Segments sealed after the checkpoint are lost in the crash, or written again
+    writer.write(data[split:split + 2 * SEGMENT_SIZE])
+    writer.abort()
+
+    with EncryptingWriter(out, KEY, header, resume=checkpoint) as writer:
+        writer.write(data[split:])
+    assert decrypt(out.getvalue()) == data
+
+
+def test_failed_write_seals_no_final_segment():
+    class FailingFile(io.BytesIO):
+        def write(self, data):
+            if self.tell() > SEGMENT_SIZE:
+                raise OSError('disk full')
+            return super().write(data)
+
+    out = FailingFile()
+    with pytest.raises(OSError):
+        with EncryptingWriter(out, KEY, ContainerHeader.create(b'ARGON2ID', SEGMENT_SIZE)) as writer:
+            writer.write(os.urandom(4 * SEGMENT_SIZE))
+    with pytest.raises(ValueError):
+        decrypt(out.getvalue())
@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import change_journal
+import pytest
+from backup_tool import ExcludeMatcher, walk_files
+from change_journal import ChangeJournal, ChangeWatcher
+
+PATTERNS = ['*.log', '**/node_modules/**']
+
+
+@pytest.fixture
+def root(tmp_path):
+    root = tmp_path / 'root'
+    for name in ['a/x.txt', 'a/sub/y.txt', 'a/sub/deep/z.txt', 'ab/w.txt', 'b/v.txt', 'b/keep.txt']:
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_text(name)
+    return root
+
+
+def make_journal(root, tmp_path):
+    return ChangeJournal(tmp_path / 'journal', [root], ExcludeMatcher(PATTERNS), 'fingerprint', walk_files)
+
+
+def full_scan(root):
+    return sorted(str(path) for path in walk_files(root, ExcludeMatcher(PATTERNS)))
+
+
+def test_renamed_directory_moves_everything_below_it(root, tmp_path):
+    journal = make_journal(root, tmp_path)
+    files = dict.fromkeys(full_scan(root))
+    os.rename(root / 'a', root / 'renamed')
+    touched = journal._apply(files, {str(root / 'a'), str(root / 'renamed')})
+    assert sorted(files) == full_scan(root)
+    # 'ab' shares the prefix of the old name but is not below it
+    assert str(root / 'ab' / 'w.txt') in files and str(root / 'ab' / 'w.txt') not in touched
+    assert len(touched) == 6
+
+
+def test_deleted_files_and_directories_are_removed(root, tmp_path):
+    journal = make_journal(root, tmp_path)
+    files = dict.fromkeys(full_scan(root))
+    os.remove(root / 'b' / 'v.txt')
+    os.remove(root / 'a' / 'sub' / 'deep' / 'z.txt')
+    os.rmdir(root / 'a' / 'sub' / 'deep')
+    touched = journal._apply(files, {str(root / 'b' / 'v.txt'), str(root / 'a' / 'sub' / 'deep'),
+                                     str(root / 'missing.txt')})
+    assert sorted(files) == full_scan(root)
+    assert touched == {str(root / 'b' / 'v.txt'), str(root / 'a' / 'sub' / 'deep' / 'z.txt')}
+
+
+def test_new_paths_follow_the_exclude_rules(root, tmp_path):
+    journal = make_journal(root, tmp_path)
+    files = dict.fromkeys(full_scan(root))
+    for name in ['new/one.txt', 'new/skip.log', 'new/node_modules/pkg/index.js', 'top.log', 'b/added.txt']:
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_text(name)
+    changes = {str(root / 'new'), str(root / 'top.log'), str(root / 'b' / 'added.txt'),
+               str(root / 'new' / 'node_modules' / 'pkg' / 'index.js'), str(tmp_path / 'outside.txt')}
+    (tmp_path / 'outside.txt').write_text('not watched')
+    journal._apply(files, changes)
+    assert sorted(files) == full_scan(root)
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def watcher(root, tmp_path):
+    watcher = ChangeWatcher(tmp_path / 'journal', [root], ExcludeMatcher(PATTERNS), 'fingerprint')
+    stop = threading.Event()
+    thread = threading.Thread(target=watcher.run, args=(stop,))
+    try:
+        change_journal._Inotify().close()
+    except OSError as e:
+        pytest.skip(f"inotify unavailable: {e}")
+    thread.start()
+    state_path = tmp_path / 'journal' / change_journal.STATE_FILE
+    wait_for(lambda: state_path.exists() and json.loads(state_path.read_text()).get('ready'))
+    yield watcher
+    stop.set()
+    thread.join()
+
+
+def test_journal_replays_renames_and_deletes(root, tmp_path, watcher):
+    journal = make_journal(root, tmp_path)
+    assert journal.capture() == ''
+    # First run: no previous file list, so a full scan is saved
+    assert journal.replay() is None
+    journal.save([Path(path) for path in full_scan(root)])
+
+    os.rename(root / 'a' / 'sub', root / 'b' / 'moved')
+    os.remove(root / 'b' / 'keep.txt')
+    (root / 'c').mkdir()
+    (root / 'c' / 'new.txt').write_text('new')
+    (root / 'c' / 'ignored.log').write_text('excluded')
+
+    def replayed():
+        journal = make_journal(root, tmp_path)
+        assert journal.capture() == ''
+        files = journal.replay()
+        return files is not None and sorted(map(str, files)) == full_scan(root)
+
+    wait_for(replayed)
+
+
+def write_state(tmp_path, **changes):
+    state = {'version': change_journal.JOURNAL_VERSION, 'session': 'session-1', 'pid': os.getpid(),
+             'fingerprint': 'fingerprint', 'ready': True, 'complete': True, 'overflows': 0,
+             'heartbeat': time.time(), 'segment': 1}
+    state.update(changes)
+    (tmp_path / 'journal').mkdir(exist_ok=True)
+    (tmp_path / 'journal' / change_journal.STATE_FILE).write_text(json.dumps(state))
+    (tmp_path / 'journal' / change_journal.segment_name(1)).touch()
+
+
+@pytest.mark.parametrize('changes, reason', [
+    ({'ready': False}, "change watcher is not running"),
+    ({'heartbeat': 0}, "change watcher stopped responding"),
+    ({'complete': False}, "change watcher could not watch every directory"),
+    ({'fingerprint': 'other'}, "change watcher runs with other include/exclude settings"),
+])
+def test_journal_is_not_used_without_a_healthy_watcher(root, tmp_path, changes, reason):
+    write_state(tmp_path, **changes)
+    assert make_journal(root, tmp_path).capture() == reason
+
+
+@pytest.mark.parametrize('changes', [{'session': 'session-2'}, {'overflows': 1}])
+def test_gap_in_the_journal_forces_a_full_scan(root, tmp_path, changes):
+    write_state(tmp_path)
+    journal = make_journal(root, tmp_path)
+    assert journal.capture() == ''
+    journal.save([Path(path) for path in full_scan(root)])
+    # The watcher restarted or dropped events since the saved position
+    write_state(tmp_path, **changes)
+    journal = make_journal(root, tmp_path)
+    assert journal.capture() == ''
+    assert journal.replay() is None
+
+    write_state(tmp_path)
+    journal = make_journal(root, tmp_path)
+    assert journal.capture() == ''
+    assert sorted(map(str, journal.replay())) == full_scan(root)
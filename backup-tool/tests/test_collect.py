@@ -0,0 +1,67 @@
+import os
+from pathlib import PurePosixPath
+
+import pytest
+from backup_tool import ExcludeMatcher, walk_files
+
+
+@pytest.mark.parametrize('pattern, path, excluded', [
+    ('*.log', '/home/u/app.log', True),
+    ('*.log', '/home/u/app.log.1', False),
+    ('*.tmp', '/home/u/dir.tmp/file', False),
+    ('cache/*.bin', '/home/u/cache/a.bin', True),
+    ('cache/*.bin', '/home/u/cache/sub/a.bin', False),
+    ('**/node_modules/**', '/p/node_modules/pkg/index.js', True),
+    ('**/node_modules/**', '/p/src/index.js', False),
+    ('/var/log/*', '/var/log/syslog', True),
+    ('/var/log/*', '/home/var/log/syslog', False),
+    ('file?.txt', '/a/file1.txt', True),
+    ('file?.txt', '/a/file10.txt', False),
+    ('[!a]*.py', '/a/b.py', True),
+    ('[!a]*.py', '/a/a.py', False),
+    ('[]x].txt', '/a/].txt', True),
+])
+def test_pattern_semantics(pattern, path, excluded):
+    assert ExcludeMatcher([pattern]).excludes_file(path) is excluded
+
+
+@pytest.mark.parametrize('pattern, path', [
+    ('*.log', '/x/y.log'),
+    ('a/**/b', '/r/a/b'),
+    ('a/**/b', '/r/a/x/y/b'),
+    ('data/*/*.csv', '/r/data/2024/x.csv'),
+])
+def test_relative_patterns_match_like_path_match(pattern, path):
+    # Path.match anchors relative patterns at the end of the path, except for "**"
+    assert ExcludeMatcher([pattern]).excludes_file(path)
+    if '**' not in pattern:
+        assert PurePosixPath(path).match(pattern)
+
+
+def test_only_directory_patterns_prune():
+    matcher = ExcludeMatcher(['**/node_modules/**', '*.tmp', '/srv/cache/**'])
+    assert matcher.prunes_dir('/p/node_modules')
+    assert matcher.prunes_dir('/srv/cache')
+    assert not matcher.prunes_dir('/p/dir.tmp')
+    assert not matcher.prunes_dir('/p/src')
+    assert not ExcludeMatcher([]).prunes_dir('/p') and not ExcludeMatcher([]).excludes_file('/p/x')
+
+
+def test_walk_prunes_and_skips(tmp_path, monkeypatch):
+    for name in ['src/a.py', 'src/b.log', 'src/deep/c.py', 'node_modules/pkg/index.js', 'dir.tmp/keep.txt']:
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text('x')
+    os.symlink(tmp_path / 'src', tmp_path / 'link')
+    listed = []
+    real_scandir = os.scandir
+
+    def scandir(path):
+        listed.append(os.path.relpath(path, tmp_path))
+        return real_scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', scandir)
+    matcher = ExcludeMatcher(['**/node_modules/**', '*.log', '*.tmp'])
+    found = [path.relative_to(tmp_path).as_posix() for path in walk_files(tmp_path, matcher)]
+    assert found == ['dir.tmp/keep.txt', 'src/a.py', 'src/deep/c.py']
+    # Pruned directories are never listed and symlinked directories never followed
+    assert not any('node_modules' in path or path.startswith('link') for path in listed)
@@ -0,0 +1,125 @@
+import io
+import multiprocessing
+import os
+import zipfile
+
+import decrypt_backup
+import pytest
+from backup_format import CIPHER_AES_GCM, CIPHERS, ContainerHeader, EncryptingWriter, KeyCache, SegmentReader
+from decrypt_backup import BackupDecryptor, decrypt_batch
+
+PASSWORD = 'decrypt-password'
+SEGMENT_SIZE = 1024
+# Cheapest Argon2id cost, the tests are about decryption not key derivation
+KDF_PARAMS = (1, 8, 1)
+
+
+def write_archive(path, members, cipher=CIPHER_AES_GCM):
+    """Encrypted container holding a stored zip of members {name: data}"""
+    zipped = io.BytesIO()
+    with zipfile.ZipFile(zipped, 'w', zipfile.ZIP_STORED) as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+    header = ContainerHeader.create(b'ARGON2ID', SEGMENT_SIZE, kdf_params=KDF_PARAMS, cipher=cipher)
+    with open(path, 'wb') as f, EncryptingWriter(f, KeyCache(PASSWORD).archive_key(header), header) as writer:
+        writer.write(zipped.getvalue())
+    return str(path)
+
+
+@pytest.fixture
+def members():
+    return {f"dir{i % 3}/file{i}.bin": os.urandom(4 * SEGMENT_SIZE) for i in range(20)}
+
+
+@pytest.mark.parametrize('cipher', CIPHERS)
+def test_decrypt_file_detects_the_cipher(members, tmp_path, cipher):
+    archive = write_archive(tmp_path / 'backup.zip.encrypted', members, cipher)
+    output = BackupDecryptor(PASSWORD).decrypt_file(archive)
+    with zipfile.ZipFile(output) as zf:
+        assert {name: zf.read(name) for name in zf.namelist()} == members
+
+
+def test_extract_paths_decrypts_only_the_segments_it_needs(members, tmp_path, monkeypatch):
+    archive = write_archive(tmp_path / 'backup.zip.encrypted', members)
+    readers = []
+
+    class RecordingReader(SegmentReader):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            readers.append(self)
+
+    monkeypatch.setattr(decrypt_backup, 'SegmentReader', RecordingReader)
+    assert BackupDecryptor(PASSWORD).extract_paths(archive, ['dir1/file4.bin'], str(tmp_path / 'out')) == 1
+    assert (tmp_path / 'out' / 'dir1' / 'file4.bin').read_bytes() == members['dir1/file4.bin']
+    assert sorted(os.listdir(tmp_path / 'out')) == ['dir1']
+    assert readers[0].segments_decrypted < readers[0].segment_count // 4
+
+
+def test_extract_paths_restores_a_directory(members, tmp_path):
+    archive = write_archive(tmp_path / 'backup.zip.encrypted', members)
+    assert BackupDecryptor(PASSWORD).extract_paths(archive, ['dir2/'], str(tmp_path / 'out')) == 6
+    for name, data in members.items():
+        restored = tmp_path / 'out' / name
+        assert restored.exists() == name.startswith('dir2/')
+        if restored.exists():
+            assert restored.read_bytes() == data
+
+
+def test_extract_paths_reports_missing_paths(members, tmp_path):
+    archive = write_archive(tmp_path / 'backup.zip.encrypted', members)
+    with pytest.raises(ValueError, match='Not found in archive'):
+        BackupDecryptor(PASSWORD).extract_paths(archive, ['nowhere'], str(tmp_path / 'out'))
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_restore_direct_writes_no_intermediate_zip(members, tmp_path, workers):
+    archive = write_archive(tmp_path / 'backup.zip.encrypted', members)
+    dest = tmp_path / 'out'
+    assert BackupDecryptor(PASSWORD).restore_direct(archive, str(dest), workers) == len(members)
+    for name, data in members.items():
+        assert (dest / name).read_bytes() == data
+    assert sorted(os.listdir(dest)) == ['dir0', 'dir1', 'dir2']
+
+
+def test_restore_direct_stops_at_a_tampered_segment(members, tmp_path):
+    archive = write_archive(tmp_path / 'backup.zip.encrypted', members)
+    data = bytearray(open(archive, 'rb').read())
+    data[len(data) // 2] ^= 1
+    open(archive, 'wb').write(bytes(data))
+    with pytest.raises(ValueError, match='Authentication failed'):
+        BackupDecryptor(PASSWORD).restore_direct(archive, str(tmp_path / 'out'))
+    # Members after the tampered segment were never written
+    restored = [path for path in (tmp_path / 'out').rglob('*') if path.is_file()]
+    assert len(restored) < len(members)
+
+
+def test_batch_reports_each_failed_archive(tmp_path, caplog):
+    archives = [write_archive(tmp_path / f"{name}.zip.encrypted", {f"{name}.txt": name.encode()}) for name in 'ab']
+    (tmp_path / 'garbage.zip.encrypted').write_bytes(os.urandom(200))
+    archives.insert(1, str(tmp_path / 'garbage.zip.encrypted'))
+    assert not decrypt_batch(archives, PASSWORD, jobs=2)
+    assert (tmp_path / 'a.txt').read_bytes() == b'a' and (tmp_path / 'b.txt').read_bytes() == b'b'
+    assert [record.message.split(':')[0] for record in caplog.records if record.levelname == 'ERROR'] == \
+        [f"Decryption of {archives[1]} failed"]
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork', reason='workers must inherit the patched function')
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_batch_survives_a_worker_that_dies(tmp_path, monkeypatch, caplog, jobs):
+    archives = [write_archive(tmp_path / f"{name}.zip.encrypted", {f"{name}.txt": name.encode()})
+                for name in 'abcde']
+    original = decrypt_backup._batch_decrypt
+
+    def crashing(input_path):
+        if input_path == archives[2]:
+            os._exit(9)
+        return original(input_path)
+
+    # Pool tasks are pickled by name, so the stand-in has to pass for the module's function
+    crashing.__module__, crashing.__qualname__ = 'decrypt_backup', '_batch_decrypt'
+    monkeypatch.setattr(decrypt_backup, '_batch_decrypt', crashing)
+    assert not decrypt_batch(archives, PASSWORD, jobs=jobs)
+    for name in 'abde':
+        assert (tmp_path / f"{name}.txt").read_bytes() == name.encode()
+    errors = [record.message for record in caplog.records if record.levelname == 'ERROR']
+    assert len(errors) == 1 and errors[0].startswith(f"Decryption of {archives[2]} failed: worker process died")
@@ -0,0 +1,104 @@
+import os
+import random
+
+import duplicates
+import pytest
+from duplicates import DuplicateFinder, parse_references, resolve_source, restore_duplicates
+
+SIZE = 8192
+
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    # A small prefix so same-size files can differ after it
+    monkeypatch.setattr(duplicates, 'PREFIX_SIZE', 1024)
+    rng = random.Random(0)
+    content = rng.randbytes(SIZE)
+    root = tmp_path / 'src'
+    (root / 'sub').mkdir(parents=True)
+    files = {
+        'original.bin': content,
+        'sub/copy.bin': content,
+        'late_difference.bin': content[:-1] + bytes([content[-1] ^ 1]),
+        'early_difference.bin': bytes([content[0] ^ 1]) + content[1:],
+        'other_size.bin': content + b'x',
+        'small_a.txt': b'tiny',
+        'small_b.txt': b'tiny',
+    }
+    for name, data in files.items():
+        (root / name).write_bytes(data)
+    os.link(root / 'original.bin', root / 'sub' / 'hardlink.bin')
+    return root
+
+
+def members(root):
+    return [(path, path.relative_to(root).as_posix()) for path in sorted(root.rglob('*')) if path.is_file()]
+
+
+def test_only_identical_content_becomes_a_reference(tree):
+    finder = DuplicateFinder()
+    unique, references = finder.find(members(tree))
+    assert sorted(references) == ['sub/copy.bin', 'sub/hardlink.bin']
+    assert references['sub/copy.bin']['source'] == 'original.bin' and not references['sub/copy.bin']['hardlink']
+    assert references['sub/hardlink.bin']['source'] == 'original.bin' and references['sub/hardlink.bin']['hardlink']
+    # Unique members keep their order; the identical small files are below min_size
+    assert [arcname for _, arcname in unique] == [arcname for _, arcname in members(tree)
+                                                   if arcname not in references]
+    assert finder.duplicates == 1 and finder.hardlinks == 1 and finder.bytes_saved == SIZE
+
+
+def test_files_are_hashed_by_size_then_prefix_then_in_full(tree):
+    finder = DuplicateFinder()
+    finder.find(members(tree))
+    # Four files share SIZE (the hardlink is matched by inode): all four prefixes
+    # are hashed, then only the three whose prefixes match are read in full
+    assert finder.bytes_hashed == 4 * 1024 + 3 * SIZE
+
+
+def test_hardlinks_are_found_without_reading(tree):
+    finder = DuplicateFinder()
+    _, references = finder.find([(tree / 'original.bin', 'a'), (tree / 'sub' / 'hardlink.bin', 'b')])
+    assert references['b']['hardlink'] and finder.bytes_hashed == 0
+
+
+def test_references_round_trip(tree):
+    _, references = DuplicateFinder().find(members(tree))
+    parsed = parse_references(DuplicateFinder.serialize(references))
+    assert {path: {k: v for k, v in entry.items() if k != 'path'} for path, entry in parsed.items()} == references
+    with pytest.raises(ValueError, match='Unsupported duplicates index version'):
+        parse_references(b'{"version": 99, "files": []}')
+
+
+def test_restore_recreates_copies_and_hardlinks(tree, tmp_path):
+    _, references = DuplicateFinder().find(members(tree))
+    references = parse_references(DuplicateFinder.serialize(references))
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+    (dest / 'original.bin').write_bytes((tree / 'original.bin').read_bytes())
+    assert restore_duplicates(references, str(dest)) == 2
+    assert (dest / 'sub' / 'copy.bin').read_bytes() == (tree / 'original.bin').read_bytes()
+    assert os.path.samefile(dest / 'sub' / 'hardlink.bin', dest / 'original.bin')
+    assert not os.path.samefile(dest / 'sub' / 'copy.bin', dest / 'original.bin')
+    assert (dest / 'sub' / 'copy.bin').stat().st_mtime == pytest.approx(references['sub/copy.bin']['mtime'])
+
+
+def test_partial_restore_reads_sources_it_did_not_restore(tmp_path):
+    references = {'b': {'path': 'b', 'source': 'a', 'hardlink': False, 'mtime': 0, 'mode': 0o644},
+                  'c': {'path': 'c', 'source': 'b', 'hardlink': True, 'mtime': 0, 'mode': 0o644}}
+    assert resolve_source(references, 'c') == 'a'
+    read = []
+
+    def read_source(name):
+        read.append(name)
+        return b'content of ' + name.encode()
+
+    # Only 'a' is outside the restore; 'c' links to 'b' once that is written
+    assert restore_duplicates(references, str(tmp_path), read_source, set()) == 2
+    assert (tmp_path / 'b').read_bytes() == b'content of a' and read == ['a']
+    assert os.path.samefile(tmp_path / 'c', tmp_path / 'b')
+
+
+def test_unsafe_reference_is_rejected(tmp_path):
+    references = {'../escaped': {'path': '../escaped', 'source': 'a', 'hardlink': False, 'mtime': 0, 'mode': 0o644}}
+    with pytest.raises(ValueError, match='unsafe path'):
+        restore_duplicates(references, str(tmp_path / 'dest'))
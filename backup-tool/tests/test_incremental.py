@@ -0,0 +1,100 @@
+import json
+import os
+
+import pytest
+from backup_tool import DELETED_PATHS_MEMBER, BackupConfig, BackupManager, FileManifest
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / 'root'
+    for name, data in {'a.txt': b'a', 'b.txt': b'b', 'sub/c.txt': b'c'}.items():
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_bytes(data)
+    return root
+
+
+def files_in(root):
+    return sorted(path for path in root.rglob('*') if path.is_file())
+
+
+def diff(manifest, root):
+    changed, deleted, current = manifest.diff(files_in(root), root)
+    return sorted(path.relative_to(root).as_posix() for path in changed), deleted, current
+
+
+def test_first_run_archives_everything(tree, tmp_path):
+    changed, deleted, current = diff(FileManifest(tmp_path / 'manifest.json'), tree)
+    assert changed == ['a.txt', 'b.txt', 'sub/c.txt']
+    assert deleted == []
+    assert set(current.entries) == set(changed)
+
+
+def test_changes_and_deletions(tree, tmp_path):
+    path = tmp_path / 'manifest.json'
+    diff(FileManifest(path), tree)[2].save('20240101_000000')
+
+    (tree / 'a.txt').write_bytes(b'changed')
+    # Touched but identical content is not archived again
+    os.utime(tree / 'b.txt', ns=(0, 0))
+    (tree / 'sub' / 'c.txt').unlink()
+    (tree / 'new.txt').write_bytes(b'new')
+
+    changed, deleted, current = diff(FileManifest.load(path), tree)
+    assert changed == ['a.txt', 'new.txt']
+    assert deleted == ['sub/c.txt']
+    assert current.entries['b.txt']['mtime_ns'] == 0
+
+
+def test_unreadable_file_is_not_deleted(tree, tmp_path, monkeypatch):
+    path = tmp_path / 'manifest.json'
+    diff(FileManifest(path), tree)[2].save('20240101_000000')
+    previous = FileManifest.load(path)
+    (tree / 'a.txt').write_bytes(b'changed')
+
+    real_hash = FileManifest.hash_file
+
+    def failing_hash(file_path):
+        if file_path.name == 'a.txt':
+            raise OSError(5, 'Input/output error')
+        return real_hash(file_path)
+
+    monkeypatch.setattr(FileManifest, 'hash_file', staticmethod(failing_hash))
+    changed, deleted, current = diff(previous, tree)
+    assert changed == [] and deleted == []
+    # The old entry stays, so the next run compares against it again
+    assert current.entries['a.txt'] == previous.entries['a.txt']
+
+
+def test_revert_restores_previous_entries(tree, tmp_path):
+    path = tmp_path / 'manifest.json'
+    diff(FileManifest(path), tree)[2].save('20240101_000000')
+    previous = FileManifest.load(path)
+    (tree / 'a.txt').write_bytes(b'changed')
+    (tree / 'new.txt').write_bytes(b'new')
+
+    current = diff(previous, tree)[2]
+    current.revert(['a.txt', 'new.txt'], previous)
+    assert current.entries['a.txt'] == previous.entries['a.txt']
+    assert 'new.txt' not in current.entries
+
+
+def test_select_incremental_records_deletions(tree, tmp_path):
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({'backup': {'root_path': str(tree), 'include_paths': ['.'],
+                                                  'output_dir': str(tmp_path / 'out'), 'incremental': True}}))
+    manager = BackupManager(BackupConfig(str(config_path)))
+    files, manifest = manager.select_incremental(files_in(tree))
+    assert len(files) == 3
+    manifest.save(manager.backup_time)
+
+    (tree / 'b.txt').unlink()
+    manager = BackupManager(BackupConfig(str(config_path)))
+    files, manifest = manager.select_incremental(files_in(tree))
+    assert files == []
+    assert manifest is not None
+    assert json.loads(manager.metadata_members[DELETED_PATHS_MEMBER]) == ['b.txt']
+
+    manifest.save(manager.backup_time)
+    manager = BackupManager(BackupConfig(str(config_path)))
+    assert manager.select_incremental(files_in(tree)) == ([], None)
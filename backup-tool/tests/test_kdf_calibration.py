@@ -0,0 +1,114 @@
+import json
+
+import kdf_calibration
+import pytest
+from backup_format import ARGON2_MAX_TIME_COST
+from backup_tool import BackupConfig, BackupManager
+from kdf_calibration import MAX_PARALLELISM, MIN_MEMORY_COST, MIN_TIME_COST, load_calibration, save_calibration
+
+BUDGET = 256 * 1024 * 1024  # bytes
+BUDGET_KIB = BUDGET // 1024
+
+
+@pytest.fixture
+def host(monkeypatch):
+    """Simulated host: one pass costs memory / speed seconds; set speed, cores and memory per test"""
+
+    class Host:
+        speed = 10 * BUDGET_KIB  # KiB per second
+        cores = 8
+        memory = None
+        # Extra factor on runs with more passes than this, to make the estimate overshoot
+        slow_above = None
+        measured = []
+
+        def measure(self, params):
+            time_cost, memory_cost, _ = params
+            self.measured.append(params)
+            seconds = time_cost * memory_cost / self.speed
+            return seconds * 1.5 if self.slow_above and time_cost > self.slow_above else seconds
+
+    host = Host()
+    monkeypatch.setattr(kdf_calibration, 'measure', host.measure)
+    monkeypatch.setattr(kdf_calibration, 'usable_cores', lambda: host.cores)
+    monkeypatch.setattr(kdf_calibration, '_available_memory', lambda: host.memory)
+    return host
+
+
+def test_fast_host_uses_the_whole_budget_and_adds_passes(host):
+    params, seconds = kdf_calibration.calibrate(1.0, BUDGET)
+    assert params == (10, BUDGET_KIB, 8) and seconds == pytest.approx(1.0)
+
+
+def test_slow_host_lowers_memory_until_two_passes_fit(host):
+    host.speed = BUDGET_KIB
+    params, seconds = kdf_calibration.calibrate(1.0, BUDGET)
+    assert params == (MIN_TIME_COST, BUDGET_KIB // 2, 8) and seconds == pytest.approx(1.0)
+
+
+def test_memory_and_passes_never_drop_below_the_floor(host, caplog):
+    host.speed = MIN_MEMORY_COST
+    params, seconds = kdf_calibration.calibrate(1.0, BUDGET)
+    assert params == (MIN_TIME_COST, MIN_MEMORY_COST, 8) and seconds == pytest.approx(2.0)
+    assert 'Cannot reach 1.00s' in caplog.text
+
+
+def test_memory_is_capped_at_half_of_what_is_available(host):
+    host.memory = 512 * 1024 * 1024
+    params, _ = kdf_calibration.calibrate(1.0, 2 * BUDGET)
+    assert params == (10, BUDGET_KIB, 8)
+
+
+def test_passes_are_capped_at_what_a_header_accepts(host):
+    # 32 MiB passes on a host this fast would need 80 of them
+    host.memory = 64 * 1024 * 1024
+    params, seconds = kdf_calibration.calibrate(1.0, BUDGET)
+    assert params == (ARGON2_MAX_TIME_COST, 32 * 1024, 8) and seconds < 1.0
+
+
+def test_lanes_follow_the_cores_up_to_the_limit(host):
+    host.cores = 500
+    assert kdf_calibration.calibrate(1.0, BUDGET)[0][2] == MAX_PARALLELISM
+    host.cores = 1
+    assert kdf_calibration.calibrate(1.0, BUDGET)[0][2] == 1
+
+
+def test_passes_step_back_when_the_estimate_overshoots(host):
+    host.speed = 5 * BUDGET_KIB
+    host.slow_above = 3
+    params, seconds = kdf_calibration.calibrate(1.0, BUDGET)
+    # 0.2s per pass suggests 5 passes, but 5 and 4 measure over the target
+    assert params == (3, BUDGET_KIB, 8) and seconds == pytest.approx(0.6)
+    assert [time_cost for time_cost, _, _ in host.measured] == [1, 5, 4, 3]
+
+
+def test_calibration_round_trip(tmp_path):
+    path = tmp_path / 'calibration' / 'kdf.json'
+    save_calibration(path, (4, 262144, 16), 0.97, 1.0)
+    assert load_calibration(path) == (4, 262144, 16)
+    assert load_calibration(tmp_path / 'missing.json') is None
+
+
+def test_unsupported_or_out_of_range_calibration(tmp_path):
+    path = tmp_path / 'kdf.json'
+    save_calibration(path, (4, 262144, 16), 0.97, 1.0)
+    stored = json.loads(path.read_text())
+    path.write_text(json.dumps(dict(stored, version=99)))
+    assert load_calibration(path) is None
+    path.write_text(json.dumps(dict(stored, memory_cost=64)))
+    with pytest.raises(ValueError, match='out of range'):
+        load_calibration(path)
+
+
+def test_config_params_take_precedence_over_the_calibration(tmp_path):
+    config = {'backup': {'output_dir': str(tmp_path)}}
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps(config))
+    assert BackupManager(BackupConfig(str(config_path))).kdf_params() is None
+
+    save_calibration(tmp_path / 'kdf-calibration.json', (4, 262144, 16), 0.97, 1.0)
+    assert BackupManager(BackupConfig(str(config_path))).kdf_params() == (4, 262144, 16)
+
+    config['encryption'] = {'kdf_params': {'time_cost': 2, 'memory_cost': 65536, 'parallelism': 2}}
+    config_path.write_text(json.dumps(config))
+    assert BackupManager(BackupConfig(str(config_path))).kdf_params() == (2, 65536, 2)
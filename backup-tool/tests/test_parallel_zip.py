@@ -0,0 +1,166 @@
+import io
+import os
+import zipfile
+import zlib
+
+import pytest
+import parallel_zip
+from parallel_zip import ZIP_DEFLATED, ZIP_STORED, ParallelZipCompressor, ZipEntry, ZipStreamWriter
+from run_checkpoint import RunCheckpoint
+from stream_extract import StreamExtractor
+
+
+@pytest.fixture
+def sources(tmp_path):
+    files = {
+        'text.txt': b'hello zip\n' * 5000,
+        'random.bin': os.urandom(200000),
+        'empty': b'',
+        'dir/nested/ünïcode.txt': 'ünïcode'.encode() * 100,
+    }
+    for name, data in files.items():
+        path = tmp_path / 'src' / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    return tmp_path / 'src', files
+
+
+def members(root, names):
+    return [(root / name, name) for name in names]
+
+
+def test_stream_writer_output_reads_with_zipfile():
+    out = io.BytesIO()
+    writer = ZipStreamWriter(out)
+    for name, data, method in [('stored', b'stored data', ZIP_STORED), ('deflated', b'abc' * 1000, ZIP_DEFLATED)]:
+        entry = ZipEntry(name, 1700000000, 0o100644, len(data), method)
+        writer.start_member(entry)
+        if method == ZIP_DEFLATED:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+            writer.write_data(entry, compressor.compress(data) + compressor.flush())
+        else:
+            writer.write_data(entry, data)
+        writer.end_member(entry, zlib.crc32(data), len(data))
+    writer.close()
+
+    with zipfile.ZipFile(io.BytesIO(out.getvalue())) as zf:
+        assert zf.testzip() is None
+        assert zf.read('stored') == b'stored data'
+        assert zf.read('deflated') == b'abc' * 1000
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_compressor_round_trip(sources, workers):
+    root, files = sources
+    out = io.BytesIO()
+    compressor = ParallelZipCompressor(workers, compression_level=6, chunk_size=16384)
+    failed = compressor.write_archive(out, members(root, files), extra_members={'meta.json': b'{}'})
+    assert failed == []
+    with zipfile.ZipFile(io.BytesIO(out.getvalue())) as zf:
+        assert zf.testzip() is None
+        assert {name: zf.read(name) for name in files} == files
+        assert zf.read('meta.json') == b'{}'
+
+
+def test_unreadable_member_is_left_out(sources, monkeypatch):
+    root, files = sources
+    real_open = open
+
+    class FailingFile(io.FileIO):
+        reads = 0
+
+        def read(self, size=-1):
+            FailingFile.reads += 1
+            if FailingFile.reads > 2:
+                raise OSError(5, 'Input/output error')
+            return super().read(size)
+
+    def failing_open(path, mode='r', *args, **kwargs):
+        if str(path).endswith('random.bin'):
+            return FailingFile(path, mode)
+        return real_open(path, mode, *args, **kwargs)
+
+    monkeypatch.setattr(parallel_zip, 'open', failing_open, raising=False)
+    out = io.BytesIO()
+    compressor = ParallelZipCompressor(2, compression_level=6, chunk_size=16384)
+    assert compressor.write_archive(out, members(root, files)) == ['random.bin']
+    with zipfile.ZipFile(io.BytesIO(out.getvalue())) as zf:
+        assert zf.testzip() is None
+        assert sorted(zf.namelist()) == sorted(set(files) - {'random.bin'})
+
+
+def test_unreadable_member_is_skipped_on_extraction(sources, tmp_path, monkeypatch):
+    root, files = sources
+    real_open = open
+
+    class FailingFile(io.FileIO):
+        def read(self, size=-1):
+            if self.tell():
+                raise OSError(5, 'Input/output error')
+            return super().read(size)
+
+    def failing_open(path, mode='r', *args, **kwargs):
+        if str(path).endswith('text.txt'):
+            return FailingFile(path, mode)
+        return real_open(path, mode, *args, **kwargs)
+
+    monkeypatch.setattr(parallel_zip, 'open', failing_open, raising=False)
+    out = io.BytesIO()
+    ParallelZipCompressor(1, compression_level=6, chunk_size=4096).write_archive(out, members(root, files))
+    # The partial member stays in the stream, but the extractor must not restore it
+    data = out.getvalue()
+    dest = tmp_path / 'dest'
+    assert StreamExtractor(str(dest)).extract(data[i:i + 1000] for i in range(0, len(data), 1000)) == len(files) - 1
+    assert not (dest / 'text.txt').exists()
+    assert (dest / 'random.bin').read_bytes() == files['random.bin']
+
+
+def test_failed_sample_skips_member(sources):
+    root, files = sources
+
+    class FailingPolicy:
+        def choose(self, path, f, size):
+            if path.name == 'random.bin':
+                raise OSError(5, 'Input/output error')
+            return ZIP_DEFLATED, 6
+
+    out = io.BytesIO()
+    compressor = ParallelZipCompressor(1, policy=FailingPolicy())
+    assert compressor.write_archive(out, members(root, files)) == ['random.bin']
+    with zipfile.ZipFile(io.BytesIO(out.getvalue())) as zf:
+        assert 'random.bin' not in zf.namelist()
+
+
+class Crash(Exception):
+    pass
+
+
+def test_checkpointed_archive_resumes(sources, tmp_path):
+    root, files = sources
+    names = sorted(files)
+    run = RunCheckpoint.start(tmp_path / 'out', '20240101_000000', 'fingerprint')
+    path = tmp_path / 'out' / 'backup.zip'
+
+    def on_member(writer):
+        # Commit after two members, then crash one member later
+        if len(writer.entries) == 2:
+            f.flush()
+            run.commit_zip(writer)
+        elif len(writer.entries) == 3:
+            raise Crash()
+
+    with open(path, 'wb') as f, pytest.raises(Crash):
+        ParallelZipCompressor(1, compression_level=6).write_archive(f, members(root, names), on_member=on_member)
+
+    run = RunCheckpoint.find(tmp_path / 'out')
+    assert run.done_members() == set(names[:2])
+    with open(path, 'r+b') as f:
+        f.seek(run.zip_offset)
+        f.truncate()
+        writer = run.zip_writer(f)
+        remaining = [member for member in members(root, names) if member[1] not in run.done_members()]
+        ParallelZipCompressor(1, compression_level=6).write_archive(f, remaining, writer=writer)
+
+    with zipfile.ZipFile(path) as zf:
+        assert zf.testzip() is None
+        assert {name: zf.read(name) for name in zf.namelist()} == files
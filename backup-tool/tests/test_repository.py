@@ -0,0 +1,158 @@
+import io
+import json
+import os
+import random
+
+import pytest
+import repository
+from backup_tool import BackupConfig, BackupManager
+from repository import ContentDefinedChunker, Repository
+
+PASSWORD = 'repository-password'
+# Cheapest Argon2id cost, the tests are about storage not key derivation
+KDF_PARAMS = (1, 8, 1)
+
+
+def small_chunker(seed=random.Random(0).randbytes(2048)):
+    return ContentDefinedChunker(seed, min_size=1024, avg_size=4096, max_size=16384)
+
+
+def chunk_sizes(chunker, data):
+    return [len(chunk) for chunk in chunker.chunks(io.BytesIO(data))]
+
+
+def test_chunks_cover_the_input_within_size_limits():
+    data = random.Random(1).randbytes(300000)
+    chunks = list(small_chunker().chunks(io.BytesIO(data)))
+    assert b''.join(chunks) == data
+    assert all(1024 <= len(chunk) <= 16384 for chunk in chunks[:-1])
+
+
+def test_an_insert_only_changes_nearby_chunks():
+    rng = random.Random(2)
+    data = rng.randbytes(300000)
+    edited = data[:150000] + b'inserted bytes' + data[150000:]
+    before = set(small_chunker().chunks(io.BytesIO(data)))
+    after = list(small_chunker().chunks(io.BytesIO(edited)))
+    assert sum(1 for chunk in after if chunk not in before) <= 2
+
+
+def test_boundaries_depend_on_the_key():
+    data = random.Random(3).randbytes(300000)
+    assert chunk_sizes(small_chunker(), data) != chunk_sizes(small_chunker(os.urandom(2048)), data)
+
+
+@pytest.mark.skipif(repository.numpy is None, reason='numpy not installed')
+@pytest.mark.parametrize('data', [random.Random(4).randbytes(500000), b'\x00' * 100000, b'ab' * 50000])
+def test_vectorized_scan_matches_per_byte_loop(data):
+    chunker = small_chunker()
+    vectorized = chunk_sizes(chunker, data)
+    chunker._gear_table = None
+    assert chunk_sizes(chunker, data) == vectorized
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / 'root'
+    rng = random.Random(5)
+    for name, size in {'big.bin': 3 * 1024 * 1024, 'small.txt': 100, 'sub/empty': 0}.items():
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_bytes(rng.randbytes(size))
+    return root
+
+
+def files_in(root):
+    return sorted(path for path in root.rglob('*') if path.is_file())
+
+
+def test_backup_restore_and_dedup(tree, tmp_path):
+    repo = Repository.init(tmp_path / 'repo', PASSWORD, b'ARGON2ID', kdf_params=KDF_PARAMS)
+    first = repo.backup(files_in(tree), tree, 'first')
+    assert first['files'] == 3 and first['new_chunks'] == first['chunks']
+
+    second = repo.backup(files_in(tree), tree, 'second')
+    assert second['reused_files'] == 3 and second['new_chunks'] == 0
+
+    # A copy under another name is read again but stores nothing new
+    (tree / 'copy.bin').write_bytes((tree / 'big.bin').read_bytes())
+    third = repo.backup(files_in(tree), tree, 'third')
+    assert third['new_chunks'] == 0 and third['chunks'] > 0
+
+    repo = Repository.open(tmp_path / 'repo', PASSWORD)
+    assert repo.list_snapshots() == ['first', 'second', 'third']
+    assert repo.restore('third', tmp_path / 'restored') == 4
+    for path in files_in(tree):
+        assert (tmp_path / 'restored' / path.relative_to(tree)).read_bytes() == path.read_bytes()
+
+
+def test_wrong_password_is_rejected(tmp_path):
+    Repository.init(tmp_path / 'repo', PASSWORD, b'ARGON2ID', kdf_params=KDF_PARAMS)
+    with pytest.raises(ValueError, match='Incorrect password'):
+        Repository.open(tmp_path / 'repo', 'wrong')
+
+
+def test_tampered_chunk_is_detected(tree, tmp_path):
+    repo = Repository.init(tmp_path / 'repo', PASSWORD, b'ARGON2ID', kdf_params=KDF_PARAMS)
+    repo.backup(files_in(tree), tree, 'first')
+    chunk_path = next(path for path in (tmp_path / 'repo' / 'chunks').glob('*/*'))
+    data = bytearray(chunk_path.read_bytes())
+    data[-1] ^= 1
+    chunk_path.write_bytes(bytes(data))
+    with pytest.raises(ValueError, match='Authentication failed'):
+        repo.restore('first', tmp_path / 'restored')
+
+
+def make_manager(tree, tmp_path, backup_time):
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({
+        'backup': {'root_path': str(tree), 'include_paths': ['.'], 'output_dir': str(tmp_path / 'out'),
+                   'mode': 'repository'},
+        'encryption': {'kdf_params': {'time_cost': 1, 'memory_cost': 8, 'parallelism': 1}},
+        'storage': {'local_only': False},
+    }))
+    manager = BackupManager(BackupConfig(str(config_path)))
+    manager.backup_time = backup_time
+    manager.prompt_password = lambda: PASSWORD
+    return manager
+
+
+def test_failed_upload_is_retried_on_the_next_run(tree, tmp_path):
+    uploaded = []
+
+    def failing_upload(items, checkpoint=False):
+        return False
+
+    def upload(items, checkpoint=False):
+        uploaded.extend(name for _, name in items)
+        return True
+
+    manager = make_manager(tree, tmp_path, '20240101_000000')
+    manager.upload = failing_upload
+    with pytest.raises(RuntimeError, match='retried on the next run'):
+        manager.repository_backup(files_in(tree))
+    repo_path = manager.repository_path()
+    pending = json.loads((repo_path / repository.PENDING_UPLOADS).read_text())
+    assert any(name.startswith('chunks/') for name in pending)
+
+    # Nothing changed, so only the previous run's objects and the new snapshot go up
+    manager = make_manager(tree, tmp_path, '20240102_000000')
+    manager.upload = upload
+    manager.repository_backup(files_in(tree))
+    assert sorted(uploaded) == sorted({'repository/' + name for name in pending}
+                                      | {'repository/snapshots/backup_20240102_000000'})
+    assert json.loads((repo_path / repository.PENDING_UPLOADS).read_text()) == []
+
+
+def test_snapshots_wait_for_their_chunks(tree, tmp_path):
+    calls = []
+
+    def upload(items, checkpoint=False):
+        calls.append([name for _, name in items])
+        return not any('/chunks/' in name for name in calls[-1])
+
+    manager = make_manager(tree, tmp_path, '20240101_000000')
+    manager.upload = upload
+    with pytest.raises(RuntimeError):
+        manager.repository_backup(files_in(tree))
+    # The chunk upload failed, so the snapshot referencing them was never sent
+    assert len(calls) == 1
@@ -0,0 +1,55 @@
+import json
+from pathlib import Path
+
+import pytest
+from backup_tool import BackupConfig, BackupManager
+from run_checkpoint import RunCheckpoint, run_fingerprint
+
+BACKUP_TIME = '20240101_000000'
+
+
+def make_manager(tmp_path, **backup):
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({'backup': dict(output_dir=str(tmp_path / 'out'), **backup)}))
+    manager = BackupManager(BackupConfig(str(config_path)))
+    manager.backup_time = '20240102_000000'
+    return manager
+
+
+def interrupt(manager, stage, fingerprint=None):
+    output_dir = Path(manager.config.get('backup', 'output_dir'))
+    run = RunCheckpoint.start(output_dir, BACKUP_TIME, fingerprint or run_fingerprint(manager.config.config))
+    run.set_stage(stage)
+    return run
+
+
+@pytest.fixture
+def manager(tmp_path):
+    return make_manager(tmp_path)
+
+
+def test_interrupted_run_is_resumed_under_its_backup_time(manager):
+    interrupt(manager, 'archive')
+    run = manager.interrupted_run()
+    assert run is not None and run.stage == 'archive'
+    assert manager.backup_time == BACKUP_TIME
+
+
+@pytest.mark.parametrize('stage, fingerprint', [('select', None), ('archive', 'settings changed')])
+def test_run_that_cannot_resume_is_discarded(manager, stage, fingerprint):
+    run = interrupt(manager, stage, fingerprint)
+    assert manager.interrupted_run() is None
+    assert not run.directory.exists() and manager.backup_time != BACKUP_TIME
+
+
+def test_run_is_not_resumed_when_checkpoints_are_off(tmp_path):
+    manager = make_manager(tmp_path, resumable=False)
+    interrupt(manager, 'encrypt')
+    assert manager.interrupted_run() is None
+
+
+def test_archive_renamed_before_the_crash_only_needs_finishing(manager, tmp_path):
+    interrupt(manager, 'encrypt', 'settings changed')
+    (tmp_path / 'out' / f"backup_{BACKUP_TIME}.zip.encrypted").write_bytes(b'sealed')
+    run = manager.interrupted_run()
+    assert run is not None and run.stage == 'finish'
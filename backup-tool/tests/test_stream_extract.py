@@ -0,0 +1,65 @@
+import io
+import os
+import zipfile
+import zlib
+
+import pytest
+from parallel_zip import ZIP_STORED, ParallelZipCompressor, ZipEntry, ZipStreamWriter
+from stream_extract import StreamExtractor
+
+
+def blocks(data, size=4096):
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+
+def stored_zip(members):
+    """Streamed zip of stored members, names taken as given"""
+    out = io.BytesIO()
+    writer = ZipStreamWriter(out)
+    for name, data in members.items():
+        entry = ZipEntry(name, 1700000000, 0o100644, len(data), ZIP_STORED)
+        writer.start_member(entry)
+        writer.write_data(entry, data)
+        writer.end_member(entry, zlib.crc32(data), len(data))
+    writer.close()
+    return out.getvalue()
+
+
+def test_extracts_streamed_archive(tmp_path):
+    files = {'a.txt': b'alpha' * 1000, 'sub/b.bin': os.urandom(100000), 'empty': b''}
+    for name, data in files.items():
+        (tmp_path / 'src' / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / 'src' / name).write_bytes(data)
+    out = io.BytesIO()
+    ParallelZipCompressor(2, chunk_size=16384).write_archive(out, [(tmp_path / 'src' / name, name) for name in files])
+
+    extractor = StreamExtractor(str(tmp_path / 'dest'), workers=2)
+    assert extractor.extract(blocks(out.getvalue())) == len(files)
+    for name, data in files.items():
+        assert (tmp_path / 'dest' / name).read_bytes() == data
+
+
+def test_extracts_zipfile_output(tmp_path):
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('x/y.txt', b'zipfile member' * 100)
+        zf.writestr('stored.txt', b'plain', compress_type=zipfile.ZIP_STORED)
+    StreamExtractor(str(tmp_path)).extract(blocks(out.getvalue()))
+    assert (tmp_path / 'x' / 'y.txt').read_bytes() == b'zipfile member' * 100
+    assert (tmp_path / 'stored.txt').read_bytes() == b'plain'
+
+
+@pytest.mark.parametrize('name', ['../escaped.txt', 'ok/../../escaped.txt', '/tmp/escaped.txt'])
+def test_path_traversal_is_rejected(tmp_path, name):
+    dest = tmp_path / 'dest'
+    with pytest.raises(ValueError, match='Unsafe zip entry'):
+        StreamExtractor(str(dest)).extract(blocks(stored_zip({'fine.txt': b'fine', name: b'evil'})))
+    assert not (tmp_path / 'escaped.txt').exists()
+
+
+def test_corrupt_member_is_rejected(tmp_path):
+    archive = bytearray(stored_zip({'a.txt': b'a' * 1000}))
+    archive[100] ^= 0xFF
+    with pytest.raises(ValueError):
+        StreamExtractor(str(tmp_path)).extract(blocks(bytes(archive)))
+
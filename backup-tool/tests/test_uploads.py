@@ -0,0 +1,281 @@
+import io
+import json
+import os
+import random
+import threading
+import time
+
+import pytest
+from backup_tool import BackupConfig, BackupManager
+from uploads import CHECKPOINT_SUFFIX, StreamingUpload, TeeWriter, UploadCheckpoint, Uploader, UploadEngine
+
+PART_SIZE = 1000
+
+
+class StubUploader(Uploader):
+    """
+    In-memory backend: multipart uploads are dicts of parts, finished objects are bytes.
+
+    Each part number in fail_parts fails once, like a dropped connection.
+    """
+
+    label = 'stub'
+
+    def __init__(self, part_size=PART_SIZE, concurrency=4, label='stub', fail_parts=()):
+        super().__init__(part_size, concurrency)
+        self.label = label
+        self.fail_parts = set(fail_parts)
+        self.objects = {}
+        self.open = {}
+        self.aborted = []
+        self.sent_parts = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._uploads = 0
+
+    def _put(self, path, name):
+        with open(path, 'rb') as f:
+            self.objects[name] = f.read()
+
+    def _start(self, name):
+        with self._lock:
+            self._uploads += 1
+            upload_id = f"upload-{self._uploads}"
+        self.open[upload_id] = {}
+        return upload_id
+
+    def _send_part(self, upload_id, name, number, data):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(0.01)
+            if number in self.fail_parts:
+                self.fail_parts.discard(number)
+                raise ConnectionError(f"part {number} lost")
+            ref = f"{name}-{number}-{len(data)}"
+            self.open[upload_id][number] = (ref, data)
+            self.sent_parts.append(number)
+            return ref
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def _complete(self, upload_id, name, refs):
+        parts = self.open.pop(upload_id)
+        assert refs == [parts[number][0] for number in sorted(parts)]
+        self.objects[name] = b''.join(parts[number][1] for number in sorted(parts))
+
+    def _abort(self, upload_id, name):
+        self.open.pop(upload_id, None)
+        self.aborted.append(name)
+
+    def _existing_parts(self, upload_id, name):
+        if upload_id not in self.open:
+            return None
+        return {number: ref for number, (ref, _) in self.open[upload_id].items()}
+
+    def _verify(self, name, size, part_count):
+        if len(self.objects[name]) != size:
+            raise ValueError(f"uploaded object does not match: {len(self.objects[name])} bytes, expected {size}")
+
+
+@pytest.fixture
+def files(tmp_path):
+    rng = random.Random(0)
+    sizes = {'small.bin': 200, 'exact.bin': PART_SIZE, 'large.bin': 10 * PART_SIZE + 7}
+    items = []
+    for name, size in sizes.items():
+        (tmp_path / name).write_bytes(rng.randbytes(size))
+        items.append((str(tmp_path / name), f"backups/{name}"))
+    return items
+
+
+def contents(items):
+    return {name: open(path, 'rb').read() for path, name in items}
+
+
+def test_every_backend_receives_every_object(files):
+    uploaders = [StubUploader(label='first'), StubUploader(label='second', concurrency=1)]
+    assert UploadEngine(uploaders).upload(files)
+    for uploader in uploaders:
+        assert uploader.objects == contents(files)
+        assert uploader.objects_sent == 3 and uploader.bytes_sent == sum(map(len, contents(files).values()))
+        assert not uploader.open
+
+
+def test_parts_are_sent_in_parallel(files):
+    uploader = StubUploader(concurrency=4)
+    assert UploadEngine([uploader]).upload(files)
+    # Only large.bin is multipart: 11 parts, numbered from 1
+    assert sorted(uploader.sent_parts) == list(range(1, 12))
+    assert 1 < uploader.max_in_flight <= 4
+
+
+def test_failed_part_aborts_the_upload_without_checkpoint(files):
+    uploader = StubUploader(fail_parts={3})
+    assert not UploadEngine([uploader]).upload(files)
+    assert uploader.aborted == ['backups/large.bin']
+    assert 'backups/large.bin' not in uploader.objects
+    assert set(uploader.objects) == {'backups/small.bin', 'backups/exact.bin'}
+
+
+def test_one_failing_backend_does_not_stop_the_others(files):
+    good, bad = StubUploader(label='good'), StubUploader(label='bad', fail_parts={1})
+    assert not UploadEngine([good, bad]).upload(files)
+    assert good.objects == contents(files)
+
+
+def test_part_size_grows_to_stay_under_the_part_limit():
+    uploader = StubUploader()
+    uploader.MAX_PARTS = 10
+    assert uploader.choose_part_size(5 * PART_SIZE) == PART_SIZE
+    assert uploader.choose_part_size(100 * PART_SIZE + 1) == 10 * PART_SIZE + 1
+    assert Uploader.plan_parts(2500, 1000) == [(0, 1000), (1000, 1000), (2000, 500)]
+
+
+def test_interrupted_upload_resumes_with_the_missing_parts(files):
+    uploader = StubUploader(fail_parts={3, 7})
+    assert not UploadEngine([uploader]).upload(files, checkpoint=True)
+    path, name = files[2]
+    checkpoint = json.loads(open(path + CHECKPOINT_SUFFIX).read())
+    recorded = {int(number) for number in checkpoint['backends']['stub']['parts']}
+    assert {3, 7}.isdisjoint(recorded) and uploader.open and not uploader.aborted
+    # The small files finished, so only the large one is left to resume
+    assert UploadCheckpoint.pending_items(os.path.dirname(path)) == [(path, name)]
+
+    uploader.fail_parts.clear()
+    uploader.sent_parts.clear()
+    assert UploadEngine([uploader]).upload(UploadCheckpoint.pending_items(os.path.dirname(path)), checkpoint=True)
+    assert sorted(uploader.sent_parts) == sorted(set(range(1, 12)) - recorded)
+    assert uploader.objects[name] == open(path, 'rb').read()
+    assert not os.path.exists(path + CHECKPOINT_SUFFIX)
+
+
+def test_resume_starts_over_when_the_service_lost_the_upload(files):
+    uploader = StubUploader(fail_parts={5})
+    assert not UploadEngine([uploader]).upload(files, checkpoint=True)
+    uploader.open.clear()
+    uploader.fail_parts.clear()
+    uploader.sent_parts.clear()
+    path, name = files[2]
+    assert UploadEngine([uploader]).upload([(path, name)], checkpoint=True)
+    assert sorted(uploader.sent_parts) == list(range(1, 12))
+    assert uploader.objects[name] == open(path, 'rb').read()
+
+
+def test_checkpoint_of_a_changed_file_is_discarded(files):
+    path, name = files[2]
+    UploadCheckpoint(path, name, ['stub']).start('stub', 'upload-1', PART_SIZE)
+    assert UploadCheckpoint(path, name, ['stub']).entry('stub')['state'] == 'upload-1'
+    with open(path, 'ab') as f:
+        f.write(b'more')
+    assert UploadCheckpoint(path, name, ['stub']).entry('stub')['state'] is None
+
+
+def test_backend_that_finished_is_skipped_on_resume(files):
+    good, bad = StubUploader(label='good'), StubUploader(label='bad', fail_parts={2})
+    assert not UploadEngine([good, bad]).upload(files, checkpoint=True)
+    good.sent_parts.clear()
+    bad.fail_parts.clear()
+    path, name = files[2]
+    assert UploadEngine([good, bad]).upload([(path, name)], checkpoint=True)
+    assert good.sent_parts == []
+    assert bad.objects[name] == good.objects[name] == open(path, 'rb').read()
+
+
+def test_resume_uploads_finishes_checkpointed_uploads(files, tmp_path):
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({'backup': {'output_dir': str(tmp_path)}}))
+    manager = BackupManager(BackupConfig(str(config_path)))
+    uploader = StubUploader(fail_parts={4})
+    manager._upload_engine = UploadEngine([uploader])
+    assert not manager.upload(files, checkpoint=True)
+
+    uploader.fail_parts.clear()
+    assert manager.resume_uploads()
+    assert uploader.objects == contents(files)
+    assert UploadCheckpoint.pending_items(str(tmp_path)) == []
+    assert manager.resume_uploads()
+
+
+def test_streaming_upload_sends_parts_while_writing():
+    uploader = StubUploader()
+    stream = StreamingUpload(uploader, 'stream.bin')
+    data = random.Random(1).randbytes(5 * PART_SIZE + 300)
+    for offset in range(0, len(data), 700):
+        stream.write(data[offset:offset + 700])
+    # Every full part was handed off before the stream ended
+    assert len(stream._parts) == 5 and len(stream._buffer) == 300
+    assert stream.finish()
+    assert uploader.objects['stream.bin'] == data
+    assert uploader.objects_sent == 1 and uploader.bytes_sent == len(data)
+
+
+def test_empty_stream_still_completes_the_object():
+    uploader = StubUploader()
+    assert StreamingUpload(uploader, 'empty.bin').finish()
+    assert uploader.objects['empty.bin'] == b''
+
+
+def test_failed_part_aborts_the_stream_but_not_the_writer():
+    uploader = StubUploader(fail_parts={2})
+    stream = StreamingUpload(uploader, 'stream.bin')
+    data = random.Random(2).randbytes(8 * PART_SIZE)
+    assert stream.write(data) == len(data)
+    assert not stream.finish()
+    assert isinstance(stream.error, ConnectionError)
+    assert uploader.aborted == ['stream.bin'] and 'stream.bin' not in uploader.objects
+
+
+def test_stream_over_the_part_limit_fails():
+    uploader = StubUploader()
+    uploader.MAX_PARTS = 3
+    stream = StreamingUpload(uploader, 'stream.bin')
+    stream.write(bytes(4 * PART_SIZE))
+    assert not stream.finish()
+    assert 'raise part_size' in str(stream.error)
+
+
+def test_tee_writer_copies_to_every_sink():
+    sinks = [io.BytesIO(), io.BytesIO()]
+    tee = TeeWriter(sinks)
+    tee.write(b'abc')
+    tee.write(b'def')
+    assert [sink.getvalue() for sink in sinks] == [b'abcdef', b'abcdef'] and tee.bytes_written == 6
+
+
+def streaming_manager(tmp_path, keep_local_copy=True):
+    root = tmp_path / 'root'
+    root.mkdir()
+    (root / 'data.bin').write_bytes(random.Random(3).randbytes(20000))
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({
+        'backup': {'root_path': str(root), 'include_paths': ['.'], 'output_dir': str(tmp_path / 'out')},
+        'encryption': {'kdf_params': {'time_cost': 1, 'memory_cost': 8, 'parallelism': 1}},
+        'storage': {'upload': {'keep_local_copy': keep_local_copy}},
+    }))
+    manager = BackupManager(BackupConfig(str(config_path)))
+    manager.backup_time = '20240101_000000'
+    manager.prompt_password = lambda: 'streaming-password'
+    return manager, [root / 'data.bin']
+
+
+def test_streaming_backup_retries_a_failed_backend_from_the_local_copy(tmp_path):
+    manager, files = streaming_manager(tmp_path)
+    good, flaky = StubUploader(label='good'), StubUploader(label='flaky', fail_parts={2})
+    manager._upload_engine = UploadEngine([good, flaky])
+    local_path = manager.streaming_backup(files)
+    name = '20240101_000000/backup_20240101_000000.zip.encrypted'
+    local = open(local_path, 'rb').read()
+    assert good.objects[name] == local
+    assert flaky.aborted == [name] and flaky.objects[name] == local
+    assert not os.path.exists(local_path + CHECKPOINT_SUFFIX)
+
+
+def test_streaming_without_local_copy_needs_a_backend(tmp_path):
+    manager, files = streaming_manager(tmp_path, keep_local_copy=False)
+    manager._upload_engine = UploadEngine([])
+    with pytest.raises(ValueError, match='needs an enabled storage backend'):
+        manager.streaming_backup(files)
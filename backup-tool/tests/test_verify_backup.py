@@ -0,0 +1,70 @@
+import io
+import os
+
+import pytest
+from backup_format import TAG_SIZE, TRAILER_FOOTER_SIZE, ContainerHeader, EncryptingWriter
+from verify_backup import verify_archive
+
+KEY = bytes(range(32))
+SEGMENT_SIZE = 1024
+SEGMENTS = 8
+
+
+def write_archive(path, hash_tree=True):
+    header = ContainerHeader.create(b'ARGON2ID', SEGMENT_SIZE, hash_tree=hash_tree)
+    out = io.BytesIO()
+    with EncryptingWriter(out, KEY, header) as writer:
+        writer.write(os.urandom(SEGMENTS * SEGMENT_SIZE - 100))
+    path.write_bytes(out.getvalue())
+    return str(path), header
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_intact_archive_verifies(tmp_path, workers):
+    path, _ = write_archive(tmp_path / 'backup.encrypted')
+    report = verify_archive(path, workers=workers)
+    assert report.ok
+    # The header and every segment are leaves
+    assert report.leaves_checked == report.leaves_total == SEGMENTS + 1
+
+
+def test_damaged_segment_is_located(tmp_path):
+    path, header = write_archive(tmp_path / 'backup.encrypted')
+    data = bytearray(open(path, 'rb').read())
+    start = len(header.raw) + 2 * (SEGMENT_SIZE + TAG_SIZE)
+    data[start + 5] ^= 1
+    open(path, 'wb').write(bytes(data))
+    report = verify_archive(path)
+    assert report.corrupted == [('segment 2', start, start + SEGMENT_SIZE + TAG_SIZE)]
+    assert not report.problems
+
+
+def test_sample_always_checks_header_and_last_segment(tmp_path):
+    path, header = write_archive(tmp_path / 'backup.encrypted')
+    data = bytearray(open(path, 'rb').read())
+    # A salt byte: the header still parses but no longer matches its leaf
+    data[data.index(header.salt)] ^= 1
+    data[-TRAILER_FOOTER_SIZE - (SEGMENTS + 1) * 32 - 1] ^= 1
+    open(path, 'wb').write(bytes(data))
+    report = verify_archive(path, sample=2)
+    assert report.leaves_checked == 4
+    assert [what for what, _, _ in report.corrupted] == ['header', f"segment {SEGMENTS - 1}"]
+
+
+@pytest.mark.parametrize('change', ['truncate', 'extend', 'trailer'])
+def test_layout_problems_are_reported(tmp_path, change):
+    path, _ = write_archive(tmp_path / 'backup.encrypted')
+    data = bytearray(open(path, 'rb').read())
+    if change == 'truncate':
+        data = data[:-TRAILER_FOOTER_SIZE - 1]
+    elif change == 'extend':
+        data[-TRAILER_FOOTER_SIZE:-TRAILER_FOOTER_SIZE] = b'extra'
+    else:
+        data[-TRAILER_FOOTER_SIZE - 1] ^= 1
+    open(path, 'wb').write(bytes(data))
+    assert not verify_archive(path).ok
+
+
+def test_archive_without_hash_tree_needs_a_full_decrypt(tmp_path):
+    path, _ = write_archive(tmp_path / 'backup.encrypted', hash_tree=False)
+    assert verify_archive(path).problems == ["Archive has no hash tree; check it with a full decrypt instead"]
@@ -0,0 +1,575 @@
+"""
+Cloud upload engine for backup_tool.py
+
+Each backend gets one client per run, shared by every upload so HTTP
+connections are pooled and reused. Objects larger than the part size are
+split into parts sent in parallel (S3 multipart uploads, Azure block blobs);
+smaller objects, such as repository chunks, are sent whole but still many at
+a time. All backends upload simultaneously, each from its own thread pool,
+and the engine reports per-backend and aggregate throughput.
+
+Archive uploads are checkpointed: the upload id and every completed part
+are recorded in <file>.upload.json as they finish. If a run dies or a part
+fails, the multipart upload is left open and the next attempt (for example
+backup_tool.py --resume) sends only the missing parts, completes the object
+and verifies its size against the local file.
+
+Archives can also be streamed: StreamingUpload is a writable file object
+that ships each part_size block to the multipart upload as soon as it has
+been written, so compression, encryption and the network transfer overlap.
+
+Local stand-ins work for testing: point storage.aws.endpoint_url at a moto
+server or MinIO, and use an Azurite connection string for Azure.
+"""
+
+import base64
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+except ImportError:
+    boto3 = None
+
+try:
+    from azure.storage.blob import BlobServiceClient
+except ImportError:
+    BlobServiceClient = None
+
+logger = logging.getLogger(__name__)
+# The Azure SDK logs every request and response at INFO
+logging.getLogger('azure.core.pipeline.policies.http_logging_policy').setLevel(logging.WARNING)
+
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+DEFAULT_CONCURRENCY = 8
+CHECKPOINT_SUFFIX = '.upload.json'
+CHECKPOINT_VERSION = 1
+
+
+def read_part(path: str, offset: int, length: int) -> bytes:
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+class UploadCheckpoint:
+    """
+    Progress of one file's uploads to every backend, saved after each part.
+
+    A backend's entry is removed once its object is complete and verified;
+    the file is deleted when no backend has anything left to send.
+    """
+
+    def __init__(self, file_path: str, name: str, labels: List[str]):
+        self.file_path = file_path
+        self.path = file_path + CHECKPOINT_SUFFIX
+        self.name = name
+        self._lock = threading.Lock()
+        st = os.stat(file_path)
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.backends: Dict[str, Dict] = {}
+
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                stored = json.load(f)
+            if (stored.get('version') == CHECKPOINT_VERSION and stored.get('name') == name
+                    and stored.get('size') == self.size and stored.get('mtime_ns') == self.mtime_ns):
+                self.backends = stored['backends']
+                return
+            logger.warning(f"Discarding stale upload checkpoint: {self.path}")
+        self.backends = {label: {'state': None, 'part_size': None, 'parts': {}} for label in labels}
+        self._save()
+
+    @staticmethod
+    def pending_items(directory: str) -> List[Tuple[str, str]]:
+        """(file path, object name) of every unfinished checkpointed upload in directory"""
+        items = []
+        for entry in sorted(os.listdir(directory)):
+            if entry.endswith(CHECKPOINT_SUFFIX):
+                with open(os.path.join(directory, entry), 'r') as f:
+                    name = json.load(f)['name']
+                items.append((os.path.join(directory, entry[:-len(CHECKPOINT_SUFFIX)]), name))
+        return items
+
+    def entry(self, label: str) -> Optional[Dict]:
+        return self.backends.get(label)
+
+    def start(self, label: str, state: Any, part_size: int):
+        with self._lock:
+            self.backends[label] = {'state': state, 'part_size': part_size, 'parts': {}}
+            self._save()
+
+    def record_part(self, label: str, number: int, ref: Any):
+        with self._lock:
+            self.backends[label]['parts'][str(number)] = ref
+            self._save()
+
+    def finish(self, label: str):
+        with self._lock:
+            self.backends.pop(label, None)
+            if self.backends:
+                self._save()
+            elif os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': CHECKPOINT_VERSION, 'name': self.name, 'size': self.size,
+                       'mtime_ns': self.mtime_ns, 'backends': self.backends}, f)
+        os.replace(tmp_path, self.path)
+
+
+class Uploader:
+    """
+    Parallel object uploads to one backend.
+
+    Subclasses provide the single-request upload and the three multipart
+    steps (start, send part, complete), plus abort, listing the parts the
+    service already holds (for resuming) and verifying the finished object.
+    Upload state and part references must be JSON-serializable.
+    """
+
+    label = 'storage'
+    MIN_PART_SIZE = 1
+    MAX_PARTS = 10000
+
+    def __init__(self, part_size: int = DEFAULT_PART_SIZE, concurrency: int = DEFAULT_CONCURRENCY):
+        self.part_size = max(part_size, self.MIN_PART_SIZE)
+        self.concurrency = max(1, concurrency)
+        self.objects_sent = 0
+        self.bytes_sent = 0
+        self.seconds = 0.0
+
+    def location(self, name: str) -> str:
+        return name
+
+    def choose_part_size(self, size: int) -> int:
+        """Configured part size, grown if needed to stay under MAX_PARTS"""
+        return max(self.part_size, math.ceil(size / self.MAX_PARTS))
+
+    @staticmethod
+    def plan_parts(size: int, part_size: int) -> List[Tuple[int, int]]:
+        """(offset, length) of each part"""
+        return [(offset, min(part_size, size - offset)) for offset in range(0, size, part_size)]
+
+    def _put(self, path: str, name: str):
+        raise NotImplementedError
+
+    def _start(self, name: str) -> Any:
+        raise NotImplementedError
+
+    def _send_part(self, state: Any, name: str, number: int, data: bytes) -> Any:
+        raise NotImplementedError
+
+    def _complete(self, state: Any, name: str, parts: List[Any]):
+        raise NotImplementedError
+
+    def _abort(self, state: Any, name: str):
+        pass
+
+    def _existing_parts(self, state: Any, name: str) -> Optional[Dict[int, Any]]:
+        """Parts the service holds for an open upload, or None if it no longer exists"""
+        return None
+
+    def _verify(self, name: str, size: int, part_count: int):
+        """Raise ValueError unless the finished object matches the local file"""
+
+    def _upload_part(self, state: Any, name: str, number: int, path: str, offset: int, length: int,
+                     checkpoint: Optional[UploadCheckpoint]) -> Any:
+        # Read inside the worker, so at most `concurrency` parts are in memory
+        ref = self._send_part(state, name, number, read_part(path, offset, length))
+        if checkpoint is not None:
+            checkpoint.record_part(self.label, number, ref)
+        return ref
+
+    def _resume(self, checkpoint: Optional[UploadCheckpoint], name: str) -> Tuple[Any, Optional[int], Dict[int, Any]]:
+        """(state, part size, parts already sent) of a checkpointed upload that is still open"""
+        entry = checkpoint.entry(self.label) if checkpoint else None
+        if not entry or entry['state'] is None:
+            return None, None, {}
+        try:
+            existing = self._existing_parts(entry['state'], name)
+        except Exception as e:
+            logger.warning(f"Cannot resume {self.label} upload of {name}, starting over: {e}")
+            existing = None
+        if existing is None:
+            return None, None, {}
+        done = {int(number): ref for number, ref in entry['parts'].items() if existing.get(int(number)) == ref}
+        return entry['state'], entry['part_size'], done
+
+    def upload(self, items: List[Tuple[str, str]],
+               checkpoints: Optional[Dict[str, UploadCheckpoint]] = None) -> List[str]:
+        """
+        Upload (file path, object name) pairs; returns the names that failed.
+
+        Files with a checkpoint resume where the last attempt stopped, and their
+        multipart uploads are left open on failure so they can resume again.
+        """
+        started = time.perf_counter()
+        failed = []
+        jobs = []
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix=self.label) as pool:
+            for path, name in items:
+                checkpoint = (checkpoints or {}).get(path)
+                if checkpoint is not None and checkpoint.entry(self.label) is None:
+                    continue  # finished by an earlier attempt
+                try:
+                    size = os.path.getsize(path)
+                except OSError as e:
+                    logger.error(f"{self.label} upload failed for {name}: {e}")
+                    failed.append(name)
+                    continue
+                if size <= self.part_size:
+                    jobs.append((name, size, size, None, checkpoint, [pool.submit(self._put, path, name)]))
+                    continue
+                try:
+                    state, part_size, done = self._resume(checkpoint, name)
+                    if state is None:
+                        state, part_size = self._start(name), self.choose_part_size(size)
+                        if checkpoint is not None:
+                            checkpoint.start(self.label, state, part_size)
+                except Exception as e:
+                    logger.error(f"{self.label} upload failed for {name}: {e}")
+                    failed.append(name)
+                    continue
+                plan = self.plan_parts(size, part_size)
+                if done:
+                    logger.info(f"Resuming {self.label} upload of {name}: {len(done)} of {len(plan)} parts already sent")
+                parts = []
+                to_send = size
+                for number, (offset, length) in enumerate(plan, 1):
+                    if number in done:
+                        parts.append(done[number])
+                        to_send -= length
+                    else:
+                        parts.append(pool.submit(self._upload_part, state, name, number, path, offset, length,
+                                                 checkpoint))
+                jobs.append((name, size, to_send, state, checkpoint, parts))
+
+            for name, size, to_send, state, checkpoint, parts in jobs:
+                try:
+                    refs = [part.result() if isinstance(part, Future) else part for part in parts]
+                    if state is not None:
+                        self._complete(state, name, refs)
+                        self._verify(name, size, len(refs))
+                except Exception as e:
+                    logger.error(f"{self.label} upload failed for {name}: {e}")
+                    failed.append(name)
+                    for part in parts:
+                        if isinstance(part, Future):
+                            part.cancel()
+                    if state is not None and checkpoint is None:
+                        try:
+                            self._abort(state, name)
+                        except Exception as abort_error:
+                            logger.warning(f"Could not abort {self.label} upload of {name}: {abort_error}")
+                    continue
+                if checkpoint is not None:
+                    checkpoint.finish(self.label)
+                self.objects_sent += 1
+                self.bytes_sent += to_send
+                logger.debug(f"Uploaded to {self.label}: {self.location(name)}")
+        self.seconds += time.perf_counter() - started
+        return failed
+
+    def summary(self) -> str:
+        rate = self.bytes_sent / 1024 / 1024 / self.seconds if self.seconds else 0.0
+        return (f"{self.label}: {self.objects_sent} objects, {self.bytes_sent / 1024 / 1024:.2f} MB "
+                f"in {self.seconds:.2f}s ({rate:.1f} MB/s)")
+
+
+class S3Uploader(Uploader):
+    """S3 (or S3-compatible) bucket, multipart above the part size"""
+
+    label = 'S3'
+    MIN_PART_SIZE = 5 * 1024 * 1024  # S3 minimum for all but the last part
+
+    def __init__(self, bucket_name: str, region: Optional[str] = None, endpoint_url: Optional[str] = None,
+                 part_size: int = DEFAULT_PART_SIZE, concurrency: int = DEFAULT_CONCURRENCY):
+        if boto3 is None:
+            raise ImportError("boto3 not installed. Install with: pip install boto3")
+        super().__init__(part_size, concurrency)
+        self.bucket_name = bucket_name
+        # boto3 clients are thread-safe; size the pool for one connection per worker
+        self.client = boto3.client('s3', region_name=region, endpoint_url=endpoint_url,
+                                   config=BotoConfig(max_pool_connections=self.concurrency))
+
+    def location(self, name: str) -> str:
+        return f"s3://{self.bucket_name}/{name}"
+
+    def _put(self, path: str, name: str):
+        with open(path, 'rb') as f:
+            self.client.put_object(Bucket=self.bucket_name, Key=name, Body=f)
+
+    def _start(self, name: str) -> str:
+        return self.client.create_multipart_upload(Bucket=self.bucket_name, Key=name)['UploadId']
+
+    def _send_part(self, upload_id: str, name: str, number: int, data: bytes) -> Dict:
+        # Content-MD5 makes S3 reject a part corrupted in transit
+        digest = base64.b64encode(hashlib.md5(data).digest()).decode()
+        response = self.client.upload_part(Bucket=self.bucket_name, Key=name, UploadId=upload_id,
+                                           PartNumber=number, Body=data, ContentMD5=digest)
+        return {'PartNumber': number, 'ETag': response['ETag']}
+
+    def _complete(self, upload_id: str, name: str, parts: List[Dict]):
+        self.client.complete_multipart_upload(Bucket=self.bucket_name, Key=name, UploadId=upload_id,
+                                              MultipartUpload={'Parts': parts})
+
+    def _abort(self, upload_id: str, name: str):
+        self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=name, UploadId=upload_id)
+
+    def _existing_parts(self, upload_id: str, name: str) -> Optional[Dict[int, Dict]]:
+        parts = {}
+        try:
+            for page in self.client.get_paginator('list_parts').paginate(
+                    Bucket=self.bucket_name, Key=name, UploadId=upload_id):
+                for part in page.get('Parts', []):
+                    parts[part['PartNumber']] = {'PartNumber': part['PartNumber'], 'ETag': part['ETag']}
+        except self.client.exceptions.NoSuchUpload:
+            return None
+        return parts
+
+    def _verify(self, name: str, size: int, part_count: int):
+        head = self.client.head_object(Bucket=self.bucket_name, Key=name)
+        # Multipart ETags end in the number of parts
+        if head['ContentLength'] != size or not head['ETag'].strip('"').endswith(f"-{part_count}"):
+            raise ValueError(f"uploaded object does not match: {head['ContentLength']} bytes, ETag {head['ETag']}")
+
+
+class AzureUploader(Uploader):
+    """Azure Blob Storage container, staged blocks above the part size"""
+
+    label = 'Azure'
+    MAX_PARTS = 50000  # committed blocks per blob
+
+    def __init__(self, connection_string: str, container_name: str,
+                 part_size: int = DEFAULT_PART_SIZE, concurrency: int = DEFAULT_CONCURRENCY):
+        if BlobServiceClient is None:
+            raise ImportError("azure-storage-blob not installed. Install with: pip install azure-storage-blob")
+        super().__init__(part_size, concurrency)
+        self.container_name = container_name
+        self.client = BlobServiceClient.from_connection_string(connection_string, transport=self._transport())
+        self.container = self.client.get_container_client(container_name)
+
+    def _transport(self):
+        """requests session whose connection pool fits all workers (the default keeps 10)"""
+        import requests
+        from azure.core.pipeline.transport import RequestsTransport
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return RequestsTransport(session=session, session_owner=False)
+
+    def location(self, name: str) -> str:
+        return f"{self.container_name}/{name}"
+
+    def _put(self, path: str, name: str):
+        with open(path, 'rb') as f:
+            self.container.upload_blob(name, f, overwrite=True)
+
+    def _start(self, name: str) -> str:
+        # Nothing to create up front: blocks are staged against the blob name
+        return name
+
+    @staticmethod
+    def block_id(number: int) -> str:
+        # Block ids must all have the same length within a blob
+        return f"{number:08d}"
+
+    def _send_part(self, state: str, name: str, number: int, data: bytes) -> str:
+        block_id = self.block_id(number)
+        # validate_content sends an MD5 the service checks
+        self.container.get_blob_client(name).stage_block(block_id, data, validate_content=True)
+        return block_id
+
+    def _complete(self, state: str, name: str, block_ids: List[str]):
+        from azure.storage.blob import BlobBlock
+
+        self.container.get_blob_client(name).commit_block_list([BlobBlock(block_id=block_id) for block_id in block_ids])
+
+    # Uncommitted blocks are discarded by the service, so there is nothing to abort
+
+    def _existing_parts(self, state: str, name: str) -> Optional[Dict[int, str]]:
+        _, uncommitted = self.container.get_blob_client(name).get_block_list('uncommitted')
+        return {int(block.id): block.id for block in uncommitted if block.id.isdigit()}
+
+    def _verify(self, name: str, size: int, part_count: int):
+        properties = self.container.get_blob_client(name).get_blob_properties()
+        if properties.size != size:
+            raise ValueError(f"uploaded blob does not match: {properties.size} bytes, expected {size}")
+
+
+class StreamingUpload(io.RawIOBase):
+    """
+    Multipart upload fed by write() calls while the data is still being produced.
+
+    Full parts are handed to a thread pool as they fill up; once concurrency
+    parts are in flight, write() waits for the oldest, so memory stays around
+    (concurrency + 1) * part_size. A failed part does not interrupt the
+    producer: the stream records the error, drops further data and aborts the
+    upload, leaving the caller to retry from a local copy.
+    """
+
+    def __init__(self, uploader: Uploader, name: str):
+        super().__init__()
+        self.uploader = uploader
+        self.name = name
+        self.error: Optional[Exception] = None
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._parts: List[Future] = []
+        self._pool = ThreadPoolExecutor(max_workers=uploader.concurrency,
+                                        thread_name_prefix=f"{uploader.label}-stream")
+        # Size is unknown up front, so use the configured part size (and its MAX_PARTS limit)
+        self._state = uploader._start(name)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.error is None:
+            self._buffer += data
+            while len(self._buffer) >= self.uploader.part_size:
+                self._submit(bytes(self._buffer[:self.uploader.part_size]))
+                del self._buffer[:self.uploader.part_size]
+        self.bytes_written += len(data)
+        return len(data)
+
+    def _submit(self, data: bytes):
+        number = len(self._parts) + 1
+        if number > self.uploader.MAX_PARTS:
+            self._fail(ValueError(f"stream needs more than {self.uploader.MAX_PARTS} parts; raise part_size"))
+            return
+        self._parts.append(self._pool.submit(self.uploader._send_part, self._state, self.name, number, data))
+        failed = next((part for part in self._parts if part.done() and part.exception()), None)
+        if failed is not None:
+            self._fail(failed.exception())
+            return
+        # Backpressure: wait for the oldest part still in flight
+        in_flight = [part for part in self._parts if not part.done()]
+        if len(in_flight) > self.uploader.concurrency:
+            try:
+                in_flight[0].result()
+            except Exception as e:
+                self._fail(e)
+
+    def _fail(self, error: Exception):
+        if self.error is None:
+            self.error = error
+            logger.error(f"{self.uploader.label} streaming upload of {self.name} failed: {error}")
+            self._buffer = bytearray()
+
+    def finish(self) -> bool:
+        """Send the last part, complete and verify the object; False if the upload failed"""
+        started = time.perf_counter()
+        if self.error is None:
+            # Also covers an empty stream: a multipart upload needs at least one part
+            if self._buffer or not self._parts:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+        try:
+            refs = [part.result() for part in self._parts]
+            if self.error is None:
+                self.uploader._complete(self._state, self.name, refs)
+                self.uploader._verify(self.name, self.bytes_written, len(refs))
+        except Exception as e:
+            self._fail(e)
+        self._pool.shutdown(wait=True)
+        if self.error is not None:
+            self.abort()
+            return False
+        self.uploader.objects_sent += 1
+        self.uploader.bytes_sent += self.bytes_written
+        self.uploader.seconds += time.perf_counter() - started
+        logger.debug(f"Uploaded to {self.uploader.label}: {self.uploader.location(self.name)}")
+        return True
+
+    def abort(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        try:
+            self.uploader._abort(self._state, self.name)
+        except Exception as e:
+            logger.warning(f"Could not abort {self.uploader.label} upload of {self.name}: {e}")
+
+
+class TeeWriter(io.RawIOBase):
+    """Write the same stream to several file objects"""
+
+    def __init__(self, sinks: List):
+        super().__init__()
+        self.sinks = sinks
+        self.bytes_written = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        for sink in self.sinks:
+            sink.write(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+
+class UploadEngine:
+    """Upload the same objects to every configured backend at once"""
+
+    def __init__(self, uploaders: List[Uploader]):
+        self.uploaders = uploaders
+
+    def upload(self, items: List[Tuple[str, str]], checkpoint: bool = False,
+               uploaders: Optional[List[Uploader]] = None) -> bool:
+        """
+        Returns True if every object reached every backend (or the given
+        subset). With checkpoint, progress is persisted next to each file and
+        earlier progress resumed.
+        """
+        uploaders = self.uploaders if uploaders is None else uploaders
+        if not uploaders or not items:
+            return True
+        started = time.perf_counter()
+        failures = {}
+        checkpoints = None
+        if checkpoint:
+            labels = [uploader.label for uploader in uploaders]
+            checkpoints = {}
+            for path, name in items:
+                try:
+                    checkpoints[path] = UploadCheckpoint(path, name, labels)
+                except OSError as e:
+                    logger.warning(f"Cannot checkpoint upload of {name}: {e}")
+        bytes_before = {uploader: uploader.bytes_sent for uploader in uploaders}
+        with ThreadPoolExecutor(max_workers=len(uploaders)) as pool:
+            futures = {pool.submit(uploader.upload, items, checkpoints): uploader for uploader in uploaders}
+            for future, uploader in futures.items():
+                try:
+                    failed = future.result()
+                except Exception as e:
+                    logger.error(f"{uploader.label} upload failed: {e}")
+                    failed = [name for _, name in items]
+                if failed:
+                    failures[uploader.label] = failed
+        elapsed = time.perf_counter() - started
+
+        total = sum(uploader.bytes_sent - bytes_before[uploader] for uploader in uploaders)
+        for uploader in uploaders:
+            logger.info(f"Upload {uploader.summary()}")
+        logger.info(f"Uploaded {total / 1024 / 1024:.2f} MB to {len(uploaders)} backend(s) in {elapsed:.2f}s "
+                    f"({total / 1024 / 1024 / elapsed if elapsed else 0.0:.1f} MB/s aggregate)")
+        for label, failed in failures.items():
+            logger.error(f"{label}: {len(failed)} object(s) failed to upload")
+        if failures and checkpoints:
+            logger.error("Progress is checkpointed; run backup_tool.py --resume to send the missing parts")
+        return not failures
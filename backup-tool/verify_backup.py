@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Integrity check for backups created with backup_tool.py
+
+Archives written with a hash tree (encryption.hash_tree, the default) carry a
+SHA-256 hash of the header and of every sealed segment after the final
+segment. Verifying rehashes the ciphertext on all cores and compares, which
+needs no password and names the exact byte ranges that are damaged. A
+sampled check hashes only some segments, for quick routine audits of large
+archives; the header, the last segment and the file length are always checked.
+
+A full decrypt (decrypt_backup.py) remains the proof that the archive
+authenticates under the password.
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from backup_format import TAG_SIZE, ContainerHeader, HashTreeTrailer, leaf_hash, tree_root
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+class VerifyReport:
+    """Outcome of one verification run"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.leaves_total = 0
+        self.leaves_checked = 0
+        self.bytes_checked = 0
+        self.elapsed = 0.0
+        # (what, first byte, last byte + 1)
+        self.corrupted: List[Tuple[str, int, int]] = []
+        self.problems: List[str] = []
+
+    @property
+    def ok(self) -> bool:
+        return not self.corrupted and not self.problems
+
+    def __str__(self):
+        rate = self.bytes_checked / 1024 / 1024 / self.elapsed if self.elapsed else 0.0
+        return (f"{self.leaves_checked} of {self.leaves_total} segments checked, "
+                f"{self.bytes_checked / 1024 / 1024:.2f} MB in {self.elapsed:.2f}s ({rate:.2f} MB/s)")
+
+
+def leaf_ranges(header: ContainerHeader, segments_end: int) -> Optional[List[Tuple[int, int]]]:
+    """(offset, length) of the header and each sealed segment; None if the sizes do not add up"""
+    sealed_size = header.segment_size + TAG_SIZE
+    start = len(header.raw)
+    full, last = divmod(segments_end - start, sealed_size)
+    if last < TAG_SIZE:
+        return None
+    ranges = [(0, start)]
+    ranges += [(start + i * sealed_size, sealed_size) for i in range(full)]
+    ranges.append((start + full * sealed_size, last))
+    return ranges
+
+
+def verify_archive(path: str, sample: Optional[int] = None, workers: int = 0) -> VerifyReport:
+    """
+    Check an archive against its hash tree. With sample, only that many
+    randomly chosen segments are hashed besides the header and last segment.
+    """
+    report = VerifyReport(path)
+    started = time.perf_counter()
+    with open(path, 'rb') as f:
+        try:
+            header = ContainerHeader.read(f)
+        except ValueError as e:
+            report.problems.append(f"Header unreadable: {e}")
+            return report
+        if not header.hash_tree:
+            report.problems.append("Archive has no hash tree; check it with a full decrypt instead")
+            return report
+        try:
+            trailer = HashTreeTrailer.read(f)
+        except ValueError as e:
+            report.problems.append(str(e))
+            return report
+
+    report.leaves_total = len(trailer.leaves)
+    if tree_root(trailer.leaves) != trailer.root:
+        report.problems.append(f"Hash tree trailer is damaged (bytes {trailer.offset}-{os.path.getsize(path)})")
+    ranges = leaf_ranges(header, trailer.offset)
+    if ranges is None or len(ranges) != len(trailer.leaves):
+        report.problems.append("Segment layout does not match the hash tree (archive truncated or extended)")
+        if ranges is None:
+            return report
+        ranges = ranges[:len(trailer.leaves)]
+
+    indexes = list(range(len(ranges)))
+    if sample is not None and sample < len(indexes) - 2:
+        indexes = [0] + sorted(random.sample(indexes[1:-1], sample)) + [indexes[-1]]
+
+    fd = os.open(path, os.O_RDONLY)
+
+    def check(index: int) -> Tuple[int, bool, int]:
+        offset, length = ranges[index]
+        data = os.pread(fd, length, offset)
+        # hashlib releases the GIL on large buffers, so threads hash in parallel
+        return index, len(data) == length and leaf_hash(data) == trailer.leaves[index], len(data)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+            for index, ok, size in pool.map(check, indexes):
+                report.leaves_checked += 1
+                report.bytes_checked += size
+                if not ok:
+                    offset, length = ranges[index]
+                    what = 'header' if index == 0 else f"segment {index - 1}"
+                    report.corrupted.append((what, offset, offset + length))
+    finally:
+        os.close(fd)
+    report.elapsed = time.perf_counter() - started
+    return report
+
+
+def non_negative_int(value: str) -> int:
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be 0 or more, not {number}")
+    return number
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Verify backups created with backup_tool.py against their hash tree (no password needed)'
+    )
+    parser.add_argument('input_file', nargs='+', help='Encrypted backup file(s) to verify')
+    parser.add_argument('-s', '--sample', type=non_negative_int,
+                        help='Spot check: hash only this many random segments (plus header and last segment)')
+    parser.add_argument('-w', '--workers', type=non_negative_int, default=0,
+                        help='Hashing threads (default: one per CPU core)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose logging')
+
+    args = parser.parse_args()
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    failed = 0
+    for input_file in args.input_file:
+        try:
+            report = verify_archive(input_file, args.sample, args.workers)
+        except OSError as e:
+            logger.error(f"{input_file}: {e}")
+            failed += 1
+            continue
+        for problem in report.problems:
+            logger.error(f"{input_file}: {problem}")
+        for what, start, end in report.corrupted:
+            logger.error(f"{input_file}: {what} is corrupted (bytes {start}-{end})")
+        if report.ok:
+            logger.info(f"{input_file}: OK ({report})")
+        else:
+            logger.error(f"{input_file}: FAILED ({report})")
+            failed += 1
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()